@@ -0,0 +1,269 @@
+"""
+Generate synthetic GTFS and GTFS-RT feeds of a configurable size, for benchmarking without downloading real feeds.
+
+The generated feeds resemble the Swedish regional feeds: stations (location_type 1) with platforms, trips which are
+scheduled using calendar_dates.txt only, and departure times past 24:00:00 for trips which run after midnight. One
+station (the hub) is served by every route, which makes it the busiest stop in the feed, while the other stations are
+picked with a skewed distribution, so the feed also contains stops with only a handful of departures. The same seed
+always results in the same feed.
+"""
+import csv
+import logging
+import os
+import random
+import time
+import zipfile
+from datetime import date, timedelta
+
+GTFS_FILENAMES = ["agency.txt", "stops.txt", "routes.txt", "trips.txt", "stop_times.txt", "calendar_dates.txt",
+                  "feed_info.txt"]
+
+# Route types, with their share of the routes
+ROUTE_TYPES = [(700, 0.8), (100, 0.1), (401, 0.05), (900, 0.05)]
+
+# The area in which stops are placed, roughly the Stockholm region
+MIN_LATITUDE, MAX_LATITUDE = 59.0, 59.6
+MIN_LONGITUDE, MAX_LONGITUDE = 17.6, 18.6
+
+
+class SyntheticFeedGenerator:
+
+    def __init__(self, stops: int = 2000, routes: int = 100, trips: int = 20000, stop_times_per_trip: int = 20,
+                 service_days: int = 30, post_midnight_share: float = 0.05, start_date: date = None, seed: int = 1):
+        """
+        :param stops: The number of platforms. Every station has two platforms, so there are half as many stations.
+        :param routes: The number of routes.
+        :param trips: The number of trips.
+        :param stop_times_per_trip: The number of stops every trip calls at.
+        :param service_days: The number of days the feed covers, starting at the start date.
+        :param post_midnight_share: The share of trips which start late in the evening, and continue after midnight.
+        :param start_date: The first day of the feed. Defaults to yesterday, so the current time is covered by the
+                           feed, including trips from the previous service day which run after midnight.
+        :param seed: The seed for the random number generator.
+        """
+        if stops < 4:
+            raise ValueError("A feed needs at least 4 stops")
+        if stop_times_per_trip < 2 or stop_times_per_trip > stops // 2:
+            raise ValueError("A trip needs between 2 stop times and one stop time per station")
+        self._stations = stops // 2
+        self._routes = routes
+        self._trips = trips
+        self._stop_times_per_trip = stop_times_per_trip
+        self._service_days = service_days
+        self._post_midnight_share = post_midnight_share
+        self.start_date = start_date or date.today() - timedelta(days=1)
+        self._seed = seed
+        # The number of stop times per station, filled while the stop times are written
+        self._station_stop_times = [0] * self._stations
+
+    def write(self, directory: str) -> dict:
+        """
+        Write the GTFS files to a directory.
+        :param directory: The directory to write the files to. It is created if it doesn't exist yet.
+        :return: A dict describing the generated feed: the number of stop times, the id of the busiest station and the
+                 id of a quiet station.
+        """
+        start = time.time()
+        os.makedirs(directory, exist_ok=True)
+        random.seed(self._seed)
+        self._station_stop_times = [0] * self._stations
+        self._write_agency(directory)
+        self._write_stops(directory)
+        self._write_routes(directory)
+        services = self._write_calendar_dates(directory)
+        patterns = self._create_route_patterns()
+        stop_times = self._write_trips_and_stop_times(directory, services, patterns)
+        self._write_feed_info(directory)
+        logging.info(f"Generated a feed with {stop_times} stop times in {time.time() - start:.1f}s")
+        served_stations = sorted((station for station, count in enumerate(self._station_stop_times) if count > 0),
+                                 key=self._station_stop_times.__getitem__)
+        return {
+            "stop_times": stop_times,
+            "large_stop_id": self._get_station_id(served_stations[-1]),
+            # The quietest stations might not have any departures on a given day, use a quiet but not the quietest one
+            "small_stop_id": self._get_station_id(served_stations[len(served_stations) // 10]),
+        }
+
+    @staticmethod
+    def write_zip(directory: str, zip_path: str):
+        """
+        Compress GTFS files which were written to a directory into a zip file.
+        :param directory: The directory containing the GTFS files.
+        :param zip_path: The path of the zip file to create.
+        """
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as gtfs_zip:
+            for filename in GTFS_FILENAMES:
+                gtfs_zip.write(os.path.join(directory, filename), filename)
+
+    def write_realtime(self, directory: str, trip_updates_share: float = 0.3, vehicle_positions_share: float = 0.1):
+        """
+        Write a TripUpdates and a VehiclePositions feed matching the trips of the generated GTFS feed, as
+        tripupdates.pb and vehiclepositions.pb.
+        :param directory: The directory to write the files to.
+        :param trip_updates_share: The share of trips which have delays.
+        :param vehicle_positions_share: The share of trips which have a vehicle position.
+        """
+        # Only needed for the realtime feeds, so the GTFS feed can be generated without it
+        from google.transit import gtfs_realtime_pb2
+
+        random.seed(self._seed)
+        timestamp = int(time.time())
+        trip_updates = gtfs_realtime_pb2.FeedMessage()
+        trip_updates.header.gtfs_realtime_version = "2.0"
+        trip_updates.header.timestamp = timestamp
+        vehicle_positions = gtfs_realtime_pb2.FeedMessage()
+        vehicle_positions.header.gtfs_realtime_version = "2.0"
+        vehicle_positions.header.timestamp = timestamp
+        for trip in range(self._trips):
+            trip_id = self._get_trip_id(trip)
+            if random.random() < trip_updates_share:
+                entity = trip_updates.entity.add()
+                entity.id = f"TU{trip}"
+                entity.trip_update.trip.trip_id = trip_id
+                # Stop sequences start at 1, and increase by one for every stop
+                for stop_sequence in sorted(random.sample(range(1, self._stop_times_per_trip + 1),
+                                                          min(3, self._stop_times_per_trip))):
+                    update = entity.trip_update.stop_time_update.add()
+                    update.stop_sequence = stop_sequence
+                    if random.random() < 0.05:
+                        update.schedule_relationship = \
+                            gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.ScheduleRelationship.NO_DATA
+                    else:
+                        update.departure.delay = random.randint(-60, 600)
+            if random.random() < vehicle_positions_share:
+                entity = vehicle_positions.entity.add()
+                entity.id = f"VP{trip}"
+                entity.vehicle.trip.trip_id = trip_id
+                entity.vehicle.position.latitude = random.uniform(MIN_LATITUDE, MAX_LATITUDE)
+                entity.vehicle.position.longitude = random.uniform(MIN_LONGITUDE, MAX_LONGITUDE)
+                entity.vehicle.position.bearing = random.randint(0, 359)
+                entity.vehicle.position.speed = random.uniform(0, 25)
+                entity.vehicle.occupancy_status = random.randint(0, 4)
+        with open(os.path.join(directory, "tripupdates.pb"), "wb") as file:
+            file.write(trip_updates.SerializeToString())
+        with open(os.path.join(directory, "vehiclepositions.pb"), "wb") as file:
+            file.write(vehicle_positions.SerializeToString())
+
+    @staticmethod
+    def _get_station_id(station: int) -> str:
+        return f"9021{station:012d}"
+
+    @staticmethod
+    def _get_platform_id(station: int, platform: int) -> str:
+        return f"9022{station:011d}{platform}"
+
+    @staticmethod
+    def _get_trip_id(trip: int) -> str:
+        return f"14{trip:016d}"
+
+    @staticmethod
+    def _write_csv(directory: str, filename: str, header: list, rows):
+        with open(os.path.join(directory, filename), "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    def _write_agency(self, directory: str):
+        self._write_csv(directory, "agency.txt", ["agency_id", "agency_name", "agency_url", "agency_timezone"],
+                        [["1", "Synthetic Transit", "https://example.com", "Europe/Stockholm"]])
+
+    def _write_feed_info(self, directory: str):
+        self._write_csv(directory, "feed_info.txt", ["feed_publisher_name", "feed_publisher_url", "feed_lang",
+                                                     "feed_start_date", "feed_end_date"],
+                        [["Synthetic Transit", "https://example.com", "sv", self.start_date.strftime("%Y%m%d"),
+                          (self.start_date + timedelta(days=self._service_days - 1)).strftime("%Y%m%d")]])
+
+    def _write_stops(self, directory: str):
+        rows = list()
+        for station in range(self._stations):
+            latitude = f"{random.uniform(MIN_LATITUDE, MAX_LATITUDE):.6f}"
+            longitude = f"{random.uniform(MIN_LONGITUDE, MAX_LONGITUDE):.6f}"
+            name = f"Station {station}"
+            rows.append([self._get_station_id(station), name, latitude, longitude, "1", "", ""])
+            for platform in range(2):
+                rows.append([self._get_platform_id(station, platform), name, latitude, longitude, "0",
+                             self._get_station_id(station), "AB"[platform]])
+        self._write_csv(directory, "stops.txt", ["stop_id", "stop_name", "stop_lat", "stop_lon", "location_type",
+                                                 "parent_station", "platform_code"], rows)
+
+    def _write_routes(self, directory: str):
+        route_types = random.choices([route_type for route_type, _ in ROUTE_TYPES],
+                                     [share for _, share in ROUTE_TYPES], k=self._routes)
+        self._write_csv(directory, "routes.txt", ["route_id", "agency_id", "route_short_name", "route_long_name",
+                                                  "route_type"],
+                        [[f"R{route}", "1", str(route + 1), f"Station {route} - Station {route + 1}", route_type]
+                         for route, route_type in enumerate(route_types)])
+
+    def _write_calendar_dates(self, directory: str) -> list:
+        """
+        Write calendar_dates.txt, with a daily, a weekday and a weekend service, and a few services which only run on
+        random days.
+        :return: The list of service ids.
+        """
+        days = [self.start_date + timedelta(days=day) for day in range(self._service_days)]
+        services = {
+            "DAILY": days,
+            "WEEKDAYS": [day for day in days if day.weekday() < 5],
+            "WEEKENDS": [day for day in days if day.weekday() >= 5],
+        }
+        for service in range(5):
+            services[f"SPECIAL{service}"] = [day for day in days if random.random() < 0.3]
+        self._write_csv(directory, "calendar_dates.txt", ["service_id", "date", "exception_type"],
+                        ([service_id, day.strftime("%Y%m%d"), "1"]
+                         for service_id, service_days in services.items() for day in service_days))
+        return list(services)
+
+    def _create_route_patterns(self) -> list:
+        """
+        Create the list of stations every route calls at. Every route calls at the hub, station 0, while the other
+        stations are picked with a skewed distribution.
+        :return: A list containing a list of stations for every route.
+        """
+        stations = range(1, self._stations)
+        weights = [1 / station for station in stations]
+        patterns = list()
+        for _ in range(self._routes):
+            pattern = set()
+            while len(pattern) < self._stop_times_per_trip - 1:
+                pattern.update(random.choices(stations, weights, k=self._stop_times_per_trip - 1 - len(pattern)))
+            pattern = list(pattern)
+            random.shuffle(pattern)
+            pattern.insert(random.randrange(len(pattern) + 1), 0)
+            patterns.append(pattern)
+        return patterns
+
+    def _write_trips_and_stop_times(self, directory: str, services: list, patterns: list) -> int:
+        """
+        Write trips.txt and stop_times.txt. The stop times are written while they are generated, so large feeds can be
+        generated without keeping them in memory.
+        :return: The number of stop times.
+        """
+        trips = list()
+        stop_times = 0
+        with open(os.path.join(directory, "stop_times.txt"), "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence",
+                             "stop_headsign", "pickup_type", "drop_off_type"])
+            for trip in range(self._trips):
+                trip_id = self._get_trip_id(trip)
+                route = trip % self._routes
+                # Half of the trips run in the opposite direction
+                pattern = patterns[route] if trip % 2 == 0 else patterns[route][::-1]
+                trips.append([f"R{route}", random.choice(services), trip_id, f"Station {pattern[-1]}"])
+                if random.random() < self._post_midnight_share:
+                    # Starts late in the evening, the departure times continue past 24:00:00
+                    seconds = random.randint(23 * 3600, 25 * 3600)
+                else:
+                    seconds = random.randint(5 * 3600, 23 * 3600)
+                platform = trip % 2
+                rows = list()
+                for stop_sequence, station in enumerate(pattern, start=1):
+                    departure_time = f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+                    rows.append([trip_id, departure_time, departure_time, self._get_platform_id(station, platform),
+                                 stop_sequence, "", "0", "0"])
+                    self._station_stop_times[station] += 1
+                    seconds += random.randint(60, 180)
+                writer.writerows(rows)
+                stop_times += len(rows)
+        self._write_csv(directory, "trips.txt", ["route_id", "service_id", "trip_id", "trip_headsign"], trips)
+        return stop_times
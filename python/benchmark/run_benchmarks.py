@@ -0,0 +1,329 @@
+"""
+Benchmark the GTFS examples on a synthetic feed. Everything runs offline: the feed is generated locally, and the
+realtime feeds are served by a local webserver.
+
+Usage: python3 run_benchmarks.py [--trips 20000] [--output results.json] [--baseline previous-results.json]
+
+The following is measured:
+- The time and peak memory usage (RSS) needed to load every GTFS cache, and the complete query engine, both by parsing
+  the GTFS files and from a snapshot. Every cache is loaded in a new process, so the measurements don't influence
+  each other.
+- The time needed to download and parse the realtime feeds.
+- The latency percentiles of create_departures_timetable, for a stop with few departures, for the busiest stop, and for
+  a time window around midnight.
+- The throughput of stops_calculate_average_departures.py, in stop times per second.
+
+Results can be stored as JSON, and compared to the results of an earlier run. When a result is worse than the earlier
+result by more than the tolerance, the script exits with status 1.
+"""
+import argparse
+import contextlib
+import functools
+import http.server
+import io
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, memory usage is not measured there
+    resource = None
+
+# The benchmarked scripts aren't packaged, import them from their directories
+PYTHON_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PYTHON_ROOT, "gtfsToTimetableApi"))
+sys.path.insert(0, PYTHON_ROOT)
+
+from SyntheticFeedGenerator import SyntheticFeedGenerator  # noqa: E402
+
+# The percentiles which are reported for latency measurements
+PERCENTILES = [50, 90, 99]
+
+
+def get_peak_rss_mb():
+    """
+    :return: The peak memory usage (RSS) of this process in megabytes, or None if it can't be measured.
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak_rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def load_cache(name: str, gtfs_root: str, workers: int):
+    """
+    Load a cache, and measure how long it takes and how much memory is used. Runs in a new process.
+    :param name: The name of the cache to load.
+    :param gtfs_root: The directory containing the GTFS files.
+    :param workers: The number of processes to use for loading the query engine.
+    :return: A tuple containing the load time in seconds and the increase in peak memory usage in megabytes.
+    """
+    import GtfsCacheHelpers
+    from GtfsTimeTable import TimeTableQueryEngine
+
+    loaders = {
+        "calendar_dates": lambda: GtfsCacheHelpers.GtfsCalendarDatesCache(gtfs_root),
+        "stops": lambda: GtfsCacheHelpers.GtfsStopsCache(gtfs_root),
+        "routes": lambda: GtfsCacheHelpers.GtfsRoutesCache(gtfs_root),
+        "trips": lambda: GtfsCacheHelpers.GtfsTripsCache(gtfs_root),
+        "stop_times": lambda: GtfsCacheHelpers.GtfsStopTimesCache(gtfs_root),
+        "stop_times_uncached": lambda: GtfsCacheHelpers.GtfsStopTimesCache(gtfs_root, reduce_memory_usage=True),
+        # The first engine parses the GTFS files and stores a snapshot, the second one loads this snapshot
+        "engine_parse": lambda: TimeTableQueryEngine(gtfs_root, None, workers=workers),
+        "engine_snapshot": lambda: TimeTableQueryEngine(gtfs_root, None, workers=workers),
+    }
+    rss_before = get_peak_rss_mb()
+    start = time.perf_counter()
+    cache = loaders[name]()
+    duration = time.perf_counter() - start
+    rss_after = get_peak_rss_mb()
+    del cache
+    return duration, None if rss_before is None else rss_after - rss_before
+
+
+def calculate_average_departures(gtfs_zip_path: str, output_directory: str) -> float:
+    """
+    Run stops_calculate_average_departures.py on a GTFS zip file. Runs in a new process.
+    :return: The time needed in seconds.
+    """
+    import stops_calculate_average_departures
+
+    # The script writes its output to the working directory
+    os.chdir(output_directory)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        stops_calculate_average_departures.create_stops_with_avg_departures(gtfs_zip_path)
+    return time.perf_counter() - start
+
+
+def run_in_new_process(function, *args):
+    """
+    Run a function in a new process, so its memory usage and run time aren't influenced by earlier measurements.
+    :return: The return value of the function.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+
+def get_percentiles(samples: list) -> dict:
+    """
+    :param samples: The measured durations, in seconds.
+    :return: A dict mapping the names of the percentiles to their values in milliseconds.
+    """
+    quantiles = statistics.quantiles(samples, n=100, method="inclusive")
+    results = {f"p{percentile}": quantiles[percentile - 1] * 1000 for percentile in PERCENTILES}
+    results["max"] = max(samples) * 1000
+    return results
+
+
+@contextlib.contextmanager
+def serve_directory(directory: str):
+    """
+    Serve the files in a directory over HTTP on a random local port.
+    :return: The base url of the server.
+    """
+    handler = functools.partial(QuietRequestHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class QuietRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        # Don't print every request in the middle of the benchmark results
+        pass
+
+
+class BenchmarkResults:
+    """
+    The results of a benchmark run. Every result has a unit, which determines whether a higher or lower value is
+    better when comparing runs.
+    """
+    HIGHER_IS_BETTER_UNITS = {"stop_times/s"}
+    # Smaller differences are considered noise, no matter how large they are relative to the earlier result
+    MIN_DIFFERENCES = {"s": 0.05, "ms": 0.5, "MB": 5}
+
+    def __init__(self):
+        self.results = dict()
+
+    def add(self, name: str, value: float, unit: str, compare: bool = True):
+        """
+        Add a result, and print it.
+        :param name: The name of the result.
+        :param value: The measured value. Results without a value are left out.
+        :param unit: The unit of the value.
+        :param compare: Whether the result should be compared to the baseline. Disable this for results which vary
+                        too much between runs, such as the slowest of a series of measurements.
+        """
+        if value is None:
+            return
+        self.results[name] = {"value": value, "unit": unit, "compare": compare}
+        print(f"{name:<45} {value:>12.3f} {unit}")
+        sys.stdout.flush()
+
+    def save(self, path: str, parameters: dict):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"parameters": parameters, "results": self.results}, file, indent=2)
+
+    def compare(self, baseline_path: str, tolerance: float) -> list:
+        """
+        Compare these results to the results of an earlier run.
+        :param baseline_path: The path to the results of the earlier run.
+        :param tolerance: How much worse a result can be, relative to the earlier result, before it is a regression.
+        :return: A list describing the results which regressed.
+        """
+        with open(baseline_path, encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+        regressions = list()
+        for name, result in self.results.items():
+            if not result["compare"] or name not in baseline or baseline[name]["value"] <= 0:
+                continue
+            difference = result["value"] - baseline[name]["value"]
+            if result["unit"] in self.HIGHER_IS_BETTER_UNITS:
+                difference = -difference
+            change = difference / baseline[name]["value"]
+            if change > tolerance and difference > self.MIN_DIFFERENCES.get(result["unit"], 0):
+                regressions.append(f"{name}: {baseline[name]['value']:.3f} -> {result['value']:.3f} {result['unit']}"
+                                   f" ({change:+.0%})")
+        return regressions
+
+
+def benchmark_cache_loading(results: BenchmarkResults, gtfs_root: str, workers: int):
+    for name in ["calendar_dates", "stops", "routes", "trips", "stop_times", "stop_times_uncached", "engine_parse",
+                 "engine_snapshot"]:
+        duration, rss = run_in_new_process(load_cache, name, gtfs_root, workers)
+        results.add(f"load.{name}.seconds", duration, "s")
+        results.add(f"load.{name}.peak_rss", rss, "MB")
+
+
+def benchmark_realtime(results: BenchmarkResults, base_url: str, repeat: int):
+    from RealtimeDataFetcher import RealtimeDataFetcher
+
+    durations = list()
+    for _ in range(repeat):
+        # A new fetcher downloads and parses the feeds again, instead of making a conditional request
+        realtime_fetcher = RealtimeDataFetcher(base_url + "tripupdates.pb", base_url + "vehiclepositions.pb")
+        start = time.perf_counter()
+        realtime_fetcher.refresh()
+        durations.append(time.perf_counter() - start)
+    results.add("realtime.refresh.seconds", statistics.median(durations), "s")
+
+
+def benchmark_departures(results: BenchmarkResults, gtfs_root: str, base_url: str, feed: dict, query_date,
+                         repeat: int):
+    from GtfsTimeTable import TimeTableQueryEngine
+    from RealtimeDataFetcher import RealtimeDataFetcher
+
+    realtime_fetcher = RealtimeDataFetcher(base_url + "tripupdates.pb", base_url + "vehiclepositions.pb")
+    # Refresh in the background like the webserver does, so queries don't include downloads
+    realtime_fetcher.refresh()
+    realtime_fetcher.start_background_refresh()
+    query_engine = TimeTableQueryEngine(gtfs_root, realtime_fetcher)
+    midnight = datetime.combine(query_date, datetime.min.time())
+    scenarios = {
+        "small_stop": (feed["small_stop_id"], midnight + timedelta(hours=8), midnight + timedelta(hours=10)),
+        "large_stop": (feed["large_stop_id"], midnight + timedelta(hours=8), midnight + timedelta(hours=10)),
+        "midnight": (feed["large_stop_id"], midnight + timedelta(hours=23, minutes=30),
+                     midnight + timedelta(days=1, hours=1, minutes=30)),
+    }
+    for name, (stop_id, window_start, window_end) in scenarios.items():
+        # The API uses JSON responses, measure the same code path
+        query_engine.create_departures_timetable(stop_id, window_start, window_end, as_json=True)
+        durations = list()
+        departures = 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = query_engine.create_departures_timetable(stop_id, window_start, window_end, as_json=True)
+            durations.append(time.perf_counter() - start)
+            departures = response.count('"scheduled_departure_time"')
+        print(f"{name}: {departures} departures from {stop_id}")
+        for percentile, value in get_percentiles(durations).items():
+            results.add(f"departures.{name}.{percentile}", value, "ms", compare=percentile != "max")
+    realtime_fetcher.stop_background_refresh()
+
+
+def benchmark_average_departures(results: BenchmarkResults, gtfs_zip_path: str, output_directory: str, feed: dict):
+    duration = run_in_new_process(calculate_average_departures, gtfs_zip_path, output_directory)
+    results.add("average_departures.seconds", duration, "s")
+    results.add("average_departures.throughput", feed["stop_times"] / duration, "stop_times/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the GTFS examples on a synthetic feed")
+    parser.add_argument("--stops", type=int, default=2000, help="the number of platforms in the feed")
+    parser.add_argument("--routes", type=int, default=100, help="the number of routes in the feed")
+    parser.add_argument("--trips", type=int, default=20000, help="the number of trips in the feed")
+    parser.add_argument("--stop-times-per-trip", dest="stop_times_per_trip", type=int, default=20,
+                        help="the number of stops every trip calls at")
+    parser.add_argument("--service-days", dest="service_days", type=int, default=30,
+                        help="the number of days covered by the feed")
+    parser.add_argument("--post-midnight-share", dest="post_midnight_share", type=float, default=0.05,
+                        help="the share of trips which run after midnight")
+    parser.add_argument("--seed", type=int, default=1, help="the seed used to generate the feed")
+    parser.add_argument("--repeat", type=int, default=200, help="how often every departures query is repeated")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="the number of processes used by the query engine to parse the GTFS feed")
+    parser.add_argument("--directory", help="the directory to generate the feed in. Defaults to a temporary directory,"
+                                            " which is removed afterwards.")
+    parser.add_argument("--output", help="store the results as JSON in this file")
+    parser.add_argument("--baseline", help="compare the results to the results stored in this file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="how much worse a result can be than the baseline before it fails, 0.25 being 25%%")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    directory = args.directory or tempfile.mkdtemp(prefix="gtfs-benchmark-")
+    gtfs_root = os.path.join(directory, "gtfs")
+    # Remove the files of earlier runs, including snapshots and indexes
+    shutil.rmtree(gtfs_root, ignore_errors=True)
+    try:
+        # The first day is yesterday, so trips from the previous service day can run after midnight today
+        generator = SyntheticFeedGenerator(args.stops, args.routes, args.trips, args.stop_times_per_trip,
+                                           args.service_days, args.post_midnight_share, seed=args.seed)
+        start = time.perf_counter()
+        feed = generator.write(gtfs_root)
+        gtfs_zip_path = os.path.join(directory, "gtfs.zip")
+        generator.write_zip(gtfs_root, gtfs_zip_path)
+        generator.write_realtime(directory)
+        print(f"Generated a feed with {feed['stop_times']} stop times in {time.perf_counter() - start:.1f}s")
+
+        results = BenchmarkResults()
+        benchmark_cache_loading(results, gtfs_root, args.workers)
+        with serve_directory(directory) as base_url:
+            benchmark_realtime(results, base_url, repeat=5)
+            benchmark_departures(results, gtfs_root, base_url, feed, generator.start_date + timedelta(days=1),
+                                 args.repeat)
+        benchmark_average_departures(results, gtfs_zip_path, directory, feed)
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        results.save(args.output, vars(args))
+    if args.baseline:
+        regressions = results.compare(args.baseline, args.tolerance)
+        if regressions:
+            print("Regressions compared to the baseline:")
+            print("\n".join(regressions))
+            sys.exit(1)
+        print("No regressions compared to the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,210 @@
 import csv
-from collections import defaultdict
-from datetime import datetime
+import logging
+import math
+import os
+import pathlib
+import sqlite3
+import sys
+import threading
+import zipfile
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, OrderedDict, Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from heapq import merge, nsmallest
+from io import TextIOWrapper, StringIO
+from itertools import accumulate
+from operator import itemgetter
+
+from GtfsCacheSnapshot import GtfsCacheSnapshot
+from Metrics import Metrics, Counter as MetricsCounter
+
+STOP_TIMES_SCANNED = MetricsCounter(
+    "gtfs_stop_times_scanned_total",
+    "The number of stop times in the queried time windows, before filtering on service days")
+
+# Larger than any departure time in seconds since midnight, used as the end of open-ended time ranges
+MAX_DEPARTURE_SECONDS = 2 ** 31 - 1
+
+# The mean radius of the earth, in meters
+EARTH_RADIUS_METERS = 6371008.8
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional. Without it, stop times are filtered one by one instead of in bulk.
+    numpy = None
+
+
+@contextmanager
+def open_gtfs_file(gtfs_root, filename):
+    """
+    Open a file from a GTFS feed as text. The feed can either be a directory containing the extracted feed, or a zip
+    file. Files are read directly from a zip file, without extracting them.
+    :param gtfs_root: The directory containing the extracted GTFS feed, or the path to the GTFS zip file.
+    :param filename: The name of the file to open, for example stops.txt.
+    """
+    if os.path.isdir(gtfs_root):
+        with open(os.path.join(gtfs_root, filename), encoding="utf-8-sig") as file:
+            yield file
+    else:
+        with zipfile.ZipFile(gtfs_root) as zip_file:
+            with TextIOWrapper(zip_file.open(filename), encoding="utf-8-sig") as file:
+                yield file
+
+
+def gtfs_file_exists(gtfs_root, filename):
+    """
+    Check if a GTFS feed contains a file. Some files, such as calendar.txt, are optional.
+    :param gtfs_root: The directory containing the extracted GTFS feed, or the path to the GTFS zip file.
+    :param filename: The name of the file to check, for example calendar.txt.
+    """
+    if os.path.isdir(gtfs_root):
+        return os.path.exists(os.path.join(gtfs_root, filename))
+    with zipfile.ZipFile(gtfs_root) as zip_file:
+        return filename in zip_file.namelist()
+
+
+# The approximate size of the parts of stop_times.txt which are parsed in parallel, in bytes
+STOP_TIMES_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def get_stop_time_fields(header):
+    """
+    Get the positions of the fields which are used by GtfsStopTimesCache.
+    :param header: The header row of stop_times.txt.
+    :return: A tuple with the positions of the trip_id, stop_id, departure_time, stop_sequence and stop_headsign
+             fields. The position of stop_headsign is None if the field is not present.
+    """
+    return (header.index('trip_id'),
+            header.index('stop_id'),
+            header.index('departure_time'),
+            header.index('stop_sequence'),
+            header.index('stop_headsign') if 'stop_headsign' in header else None)
+
+
+def parse_stop_time_rows(rows, fields):
+    """
+    Parse stop_times.txt rows into columns. Stop, trip and headsign strings are interned and replaced by small
+    integers, which are indexes in the returned lists of ids.
+    :param rows: The rows to parse, as lists of strings.
+    :param fields: The positions of the fields, as returned by get_stop_time_fields.
+    :return: A tuple containing the stop id, trip id and headsign lists, followed by the stop, trip, departure time
+             (in seconds since midnight), stop sequence and headsign columns.
+    """
+    trip_field, stop_field, departure_field, sequence_field, headsign_field = fields
+    stop_index = dict()
+    trip_index = dict()
+    headsign_index = dict()
+    stop_column = array('i')
+    trip_column = array('i')
+    departure_column = array('i')
+    sequence_column = array('i')
+    headsign_column = array('i')
+    get_seconds_since_midnight = GtfsStopTimesCache.get_seconds_since_midnight
+    for row in rows:
+        stop_column.append(stop_index.setdefault(row[stop_field], len(stop_index)))
+        trip_column.append(trip_index.setdefault(row[trip_field], len(trip_index)))
+        # Perform this "heavy lifting" once, so we can reuse it quickly later on
+        departure_column.append(get_seconds_since_midnight(row[departure_field]))
+        sequence_column.append(int(row[sequence_field]))
+        headsign = row[headsign_field] if headsign_field is not None else ''
+        headsign_column.append(headsign_index.setdefault(headsign, len(headsign_index)))
+    # Dicts keep their insertion order, so the keys are ordered by their interned index
+    return list(stop_index), list(trip_index), list(headsign_index), \
+        stop_column, trip_column, departure_column, sequence_column, headsign_column
+
+
+def parse_stop_times_chunk(path, start, end, fields):
+    """
+    Parse a part of stop_times.txt. This function is executed in a separate process when loading in parallel.
+    :param path: The path to stop_times.txt.
+    :param start: The offset of the first byte of the chunk. This should be the start of a line.
+    :param end: The offset of the end of the chunk (exclusive). This should be the start of a line.
+    :param fields: The positions of the fields, as returned by get_stop_time_fields.
+    :return: The parsed rows, as returned by parse_stop_time_rows.
+    """
+    with open(path, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start).decode("utf-8")
+    return parse_stop_time_rows(csv.reader(StringIO(data), delimiter=','), fields)
+
+
+class GtfsRecord:
+    """
+    A compact, read-only record for a row in a GTFS file. Only the columns listed in __slots__ are kept, and all values
+    are interned, so values which occur in many rows (such as service ids and route ids) are only stored once.
+    Columns can be accessed like dict keys, for example trip['service_id'], just like the rows of a csv.DictReader.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def read_all(cls, gtfs_root, filename):
+        """
+        Read all rows from a GTFS file as records.
+        :param gtfs_root: The directory containing the extracted GTFS feed, or the path to the GTFS zip file.
+        :param filename: The name of the file to read, for example stops.txt.
+        :return: A generator yielding a record for every row.
+        """
+        with open_gtfs_file(gtfs_root, filename) as csv_file:
+            reader = csv.reader(csv_file, delimiter=',')
+            header = next(reader)
+            # Optional columns which are missing in the file point to an empty value which is added to every row
+            positions = [header.index(name) if name in header else len(header) for name in cls.__slots__]
+            get_values = itemgetter(*positions)
+            padding = [''] * (len(header) + 1)
+            for row in reader:
+                if len(row) == len(header):
+                    row.append('')
+                else:
+                    # Short rows are padded with empty values. Values beyond the last column, for example after a
+                    # trailing comma, are dropped, so they never end up in the empty value for missing columns.
+                    row = (row[:len(header)] + padding)[:len(header) + 1]
+                yield cls(*map(sys.intern, get_values(row)))
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + ", ".join(f"{name}={self[name]!r}" for name in self.__slots__) + ")"
+
+
+class GtfsStop(GtfsRecord):
+    __slots__ = ('stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'location_type', 'parent_station', 'platform_code')
+
+    def __init__(self, stop_id, stop_name, stop_lat, stop_lon, location_type, parent_station, platform_code):
+        self.stop_id = stop_id
+        self.stop_name = stop_name
+        self.stop_lat = stop_lat
+        self.stop_lon = stop_lon
+        self.location_type = location_type
+        self.parent_station = parent_station
+        self.platform_code = platform_code
+
+
+class GtfsRoute(GtfsRecord):
+    __slots__ = ('route_id', 'route_short_name', 'route_long_name', 'route_type')
+
+    def __init__(self, route_id, route_short_name, route_long_name, route_type):
+        self.route_id = route_id
+        self.route_short_name = route_short_name
+        self.route_long_name = route_long_name
+        self.route_type = route_type
+
+
+class GtfsTrip(GtfsRecord):
+    __slots__ = ('trip_id', 'route_id', 'service_id')
+
+    def __init__(self, trip_id, route_id, service_id):
+        self.trip_id = trip_id
+        self.route_id = route_id
+        self.service_id = service_id
 
 
 class GtfsStopsCache:
@@ -12,28 +216,113 @@ class GtfsStopsCache:
     def get_stop(self, id):
         return self._stops_by_id[id]
 
+    def has_stop(self, id):
+        return id in self._stops_by_id
+
     def get_all_stops(self):
         return self._stops_by_id.values()
 
+    def get_stop_count(self):
+        return len(self._stops_by_id)
+
     def get_all_quays_in_stop_place(self, parent_id):
         return self._stops_by_parent_id[parent_id]
 
     def _get_stops_by_id(self):
-        stops = dict()
-        with open(self._gtfs_root + "/stops.txt", encoding="utf-8-sig") as csv_file:
-            reader = csv.DictReader(csv_file, delimiter=',')
-            for row in reader:
-                stops[row['stop_id']] = row
-        return stops
+        return {stop.stop_id: stop for stop in GtfsStop.read_all(self._gtfs_root, "stops.txt")}
 
     def _map_stops_by_parent_id(self, stops_by_id):
         stops_by_parent_id = defaultdict(list)
         for stop in stops_by_id.values():
-            if stop['parent_station']:
-                stops_by_parent_id[stop['parent_station']].append(stop)
+            if stop.parent_station:
+                stops_by_parent_id[stop.parent_station].append(stop)
         return stops_by_parent_id
 
 
+class GtfsStopsGridIndex:
+    """
+    This index finds the stops near a location. Stops are divided into a grid of cells of about cell_size meters wide,
+    so a query only needs to calculate the distance to the stops in the few cells around the location, instead of the
+    distance to every stop. The coordinates of every stop are parsed once, when the index is created.
+    """
+
+    def __init__(self, stops, cell_size=500):
+        """
+        :param stops: The GtfsStops to index. Stops without valid coordinates are left out.
+        :param cell_size: The height of a cell in meters. Cells are about as wide as they are high.
+        """
+        self._cells = defaultdict(list)
+        coordinates = list()
+        for stop in stops:
+            try:
+                lat, lon = float(stop['stop_lat']), float(stop['stop_lon'])
+            except ValueError:
+                continue
+            if -90 <= lat <= 90 and -180 <= lon <= 180:
+                coordinates.append((lat, lon, stop))
+        self._cell_height = math.degrees(cell_size / EARTH_RADIUS_METERS)
+        # A degree of longitude becomes shorter away from the equator. Cells are as wide as they are high at the
+        # average latitude of the stops, which keeps them close to square for a national feed.
+        average_lat = sum(lat for lat, _, _ in coordinates) / len(coordinates) if coordinates else 0
+        self._cell_width = self._cell_height / max(math.cos(math.radians(average_lat)), 0.1)
+        self._column_count = math.ceil(360 / self._cell_width)
+        for lat, lon, stop in coordinates:
+            self._cells[self._get_row(lat), self._get_column(lon)].append((lat, lon, stop))
+        self._cells = dict(self._cells)
+
+    def get_stop_count(self):
+        return sum(len(cell) for cell in self._cells.values())
+
+    def find_stops_near(self, lat, lon, radius, limit):
+        """
+        Find the stops closest to a location.
+        :param lat: The latitude of the location.
+        :param lon: The longitude of the location.
+        :param radius: The maximum distance to the location, in meters.
+        :param limit: The maximum number of stops to return.
+        :return: A list of (distance in meters, stop) tuples, sorted by distance. Stops at the same distance are sorted
+                 by their id.
+        """
+        lat_distance = math.degrees(radius / EARTH_RADIUS_METERS)
+        # The longitude difference which equals the radius is largest on the side closest to the pole
+        max_abs_lat = min(abs(lat) + lat_distance, 90)
+        cos_lat = math.cos(math.radians(max_abs_lat))
+        lon_distance = lat_distance / cos_lat if cos_lat > 0 else 360
+        first_row, last_row = self._get_row(max(lat - lat_distance, -90)), self._get_row(min(lat + lat_distance, 90))
+        if 2 * lon_distance >= 360:
+            columns = range(self._column_count)
+        else:
+            # Columns wrap around at the antimeridian
+            first_column = math.floor((lon - lon_distance + 180) / self._cell_width)
+            last_column = math.floor((lon + lon_distance + 180) / self._cell_width)
+            columns = {column % self._column_count for column in range(first_column, last_column + 1)}
+
+        candidates = list()
+        for row in range(first_row, last_row + 1):
+            for column in columns:
+                for stop_lat, stop_lon, stop in self._cells.get((row, column), ()):
+                    distance = self.get_distance(lat, lon, stop_lat, stop_lon)
+                    if distance <= radius:
+                        candidates.append((distance, stop['stop_id'], stop))
+        return [(distance, stop) for distance, _, stop in nsmallest(limit, candidates, key=itemgetter(0, 1))]
+
+    def _get_row(self, lat):
+        return math.floor(lat / self._cell_height)
+
+    def _get_column(self, lon):
+        return math.floor((lon + 180) / self._cell_width) % self._column_count
+
+    @staticmethod
+    def get_distance(lat1, lon1, lat2, lon2):
+        """
+        Calculate the distance between two locations, using the haversine formula.
+        :return: The distance in meters.
+        """
+        lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+        a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+        return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
 class GtfsRoutesCache:
     def __init__(self, gtfs_root):
         self._gtfs_root = gtfs_root
@@ -42,160 +331,694 @@ class GtfsRoutesCache:
     def get_route(self, id):
         return self._routes_by_id[id]
 
+    def get_all_routes(self):
+        return self._routes_by_id.values()
+
+    def get_route_count(self):
+        return len(self._routes_by_id)
+
     def _get_routes_by_id(self):
-        routes = dict()
-        with open(self._gtfs_root + "/routes.txt", encoding="utf-8-sig") as csv_file:
-            reader = csv.DictReader(csv_file, delimiter=',')
-            for row in reader:
-                routes[row['route_id']] = row
-        return routes
+        return {route.route_id: route for route in GtfsRoute.read_all(self._gtfs_root, "routes.txt")}
 
 
 class GtfsTripsCache:
     def __init__(self, gtfs_root):
         self._gtfs_root = gtfs_root
         self._trips_by_id = self._get_trips_by_id()
+        self._trip_ids_by_service_id = self._map_trip_ids_by_service_id(self._trips_by_id)
 
     def get_trip(self, id):
         return self._trips_by_id[id]
 
+    def get_trip_count(self):
+        return len(self._trips_by_id)
+
+    def get_trip_ids_for_service(self, service_id):
+        return self._trip_ids_by_service_id.get(service_id, [])
+
+    def _map_trip_ids_by_service_id(self, trips_by_id):
+        trip_ids_by_service_id = defaultdict(list)
+        for trip in trips_by_id.values():
+            trip_ids_by_service_id[trip.service_id].append(trip.trip_id)
+        return dict(trip_ids_by_service_id)
+
     def _get_trips_by_id(self):
-        trips = dict()
-        with open(self._gtfs_root + "/trips.txt", encoding="utf-8-sig") as csv_file:
-            reader = csv.DictReader(csv_file, delimiter=',')
-            for row in reader:
-                trips[row['trip_id']] = row
-        return trips
+        return {trip.trip_id: trip for trip in GtfsTrip.read_all(self._gtfs_root, "trips.txt")}
+
+
+class GtfsStopTime:
+    """
+    A lightweight, read-only view on a single row in the columnar GtfsStopTimesCache. Values are looked up in the cache
+    columns when they are requested, so no per-row dictionary needs to be kept in memory.
+    """
+    __slots__ = ('_cache', '_row')
+
+    def __init__(self, cache, row):
+        self._cache = cache
+        self._row = row
+
+    def __getitem__(self, key):
+        return self._cache._get_column_value(self._row, key)
+
+    def __repr__(self):
+        return f"GtfsStopTime(trip_id={self['trip_id']!r}, stop_id={self['stop_id']!r}, " \
+               f"departure_time={self['departure_time']!r})"
 
 
 class GtfsStopTimesCache:
-    def __init__(self, gtfs_root, reduce_memory_usage=False):
+    # The attributes containing the stop times columns. These can be stored and loaded as raw binary data.
+    COLUMN_NAMES = ('_stop_column', '_trip_column', '_departure_seconds', '_stop_sequence', '_headsign_column',
+                    '_rows_by_stop_offsets', '_rows_by_trip_offsets', '_rows_by_trip')
+
+    # The columns which are stored in the on-disk index, used when memory usage should be reduced
+    INDEX_COLUMNS = "trip_id, stop_id, departure_time, departure_seconds, stop_sequence, stop_headsign"
+
+    def __init__(self, gtfs_root, reduce_memory_usage=False, executor=None):
         self._gtfs_root = gtfs_root
         self._reduce_memory_usage = reduce_memory_usage
+        self._columns_buffer = None
         if not reduce_memory_usage:
-            self._stop_times = self._get_stop_times()
-            self._stops_by_stop_id = self._map_stop_times_by_stop_id(self._stop_times)
-            self._stops_by_trip_id = self._map_stop_times_by_trip_id(self._stop_times)
+            self._load_stop_times(executor)
+        else:
+            self._index_path = self._create_stop_times_index()
+            # SQLite connections can only be used by the thread which created them
+            self._index_connections = threading.local()
+
+    def __getstate__(self):
+        # The columns are left out when pickling, they are stored separately using get_columns()
+        state = self.__dict__.copy()
+        for name in self.COLUMN_NAMES:
+            state.pop(name, None)
+        state['_columns_buffer'] = None
+        state.pop('_index_connections', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._reduce_memory_usage:
+            self._index_connections = threading.local()
+
+    def get_columns(self):
+        """
+        Get the stop times columns, so they can be stored as raw binary data.
+        :return: A dict mapping column names to arrays (or memoryviews) of integers.
+        """
+        return {name: getattr(self, name) for name in self.COLUMN_NAMES}
+
+    def set_columns(self, columns, columns_buffer=None):
+        """
+        Set the stop times columns, for example after loading them from a memory-mapped file.
+        :param columns: A dict mapping column names to arrays (or memoryviews) of integers.
+        :param columns_buffer: The buffer backing the columns, which needs to be kept open while the columns are in use.
+        """
+        for name in self.COLUMN_NAMES:
+            setattr(self, name, columns[name])
+        self._columns_buffer = columns_buffer
 
     def get_stop_times(self):
-        return self._stop_times
+        if not self._reduce_memory_usage:
+            return [GtfsStopTime(self, row) for row in range(len(self._departure_seconds))]
+        return self._query_index("SELECT " + self.INDEX_COLUMNS + " FROM stop_times ORDER BY rowid")
 
     def get_stop_times_for_trip(self, trip_id):
         if not self._reduce_memory_usage:
-            return self._stops_by_trip_id[trip_id]
+            trip_index = self._trip_index.get(trip_id)
+            if trip_index is None:
+                return []
+            start, end = self._rows_by_trip_offsets[trip_index], self._rows_by_trip_offsets[trip_index + 1]
+            return [GtfsStopTime(self, row) for row in self._rows_by_trip[start:end]]
         else:
-            stop_times = list()
-            with open(self._gtfs_root + "/stop_times.txt", encoding="utf-8-sig") as csv_file:
-                reader = csv.DictReader(csv_file, delimiter=',')
-                for row in reader:
-                    if row['trip_id'] != trip_id:
-                        continue
-                    # Perform this "heavy lifting" once, so we can reuse it quickly later on
-                    row['departure_seconds'] = self.get_seconds_since_midnight(row['departure_time'])
-                    stop_times.append(row)
-            return stop_times
+            return self._query_index("SELECT " + self.INDEX_COLUMNS + " FROM stop_times WHERE trip_id = ? "
+                                     "ORDER BY rowid", (trip_id,))
 
     def get_stop_times_for_stop(self, stop_id):
         if not self._reduce_memory_usage:
-            return self._stops_by_stop_id[stop_id]
+            stop_index = self._stop_index.get(stop_id)
+            if stop_index is None:
+                return []
+            start, end = self._rows_by_stop_offsets[stop_index], self._rows_by_stop_offsets[stop_index + 1]
+            return [GtfsStopTime(self, row) for row in range(start, end)]
         else:
-            stop_times = list()
-            with open(self._gtfs_root + "/stop_times.txt", encoding="utf-8-sig") as csv_file:
-                reader = csv.DictReader(csv_file, delimiter=',')
-                for row in reader:
-                    if row['stop_id'] != stop_id:
-                        continue
-                    # Perform this "heavy lifting" once, so we can reuse it quickly later on
-                    row['departure_seconds'] = self.get_seconds_since_midnight(row['departure_time'])
-                    stop_times.append(row)
-            return stop_times
+            return self._query_index("SELECT " + self.INDEX_COLUMNS + " FROM stop_times WHERE stop_id = ? "
+                                     "ORDER BY departure_seconds", (stop_id,))
 
     def get_stop_times_for_stops(self, stop_ids):
         if not self._reduce_memory_usage:
             stop_time_lists = [self.get_stop_times_for_stop(stop_id) for stop_id in stop_ids]
             return [item for sublist in stop_time_lists for item in sublist]
         else:
-            stop_times = list()
-            with open(self._gtfs_root + "/stop_times.txt", encoding="utf-8-sig") as csv_file:
-                reader = csv.DictReader(csv_file, delimiter=',')
-                for row in reader:
-                    if row['stop_id'] not in stop_ids:
-                        continue
-                    # Perform this "heavy lifting" once, so we can reuse it quickly later on
-                    row['departure_seconds'] = self.get_seconds_since_midnight(row['departure_time'])
-                    stop_times.append(row)
-            return stop_times
-
-    def _get_stop_times(self):
-        stop_times = list()
-        with open(self._gtfs_root + "/stop_times.txt", encoding="utf-8-sig") as csv_file:
-            reader = csv.DictReader(csv_file, delimiter=',')
-            for row in reader:
-                # Perform this "heavy lifting" once, so we can reuse it quickly later on
-                row['departure_seconds'] = self.get_seconds_since_midnight(row['departure_time'])
-                stop_times.append(row)
+            stop_ids = list(stop_ids)
+            placeholders = ",".join("?" * len(stop_ids))
+            return self._query_index("SELECT " + self.INDEX_COLUMNS + " FROM stop_times "
+                                     "WHERE stop_id IN (" + placeholders + ")", stop_ids)
+
+    def get_stop_times_for_stops_between(self, stop_ids, start_seconds, end_seconds):
+        """
+        Get the stop times at the given stops which depart in a time range.
+        :param stop_ids: The stops to get the stop times for.
+        :param start_seconds: The start of the range, in seconds since midnight, inclusive.
+        :param end_seconds: The end of the range, in seconds since midnight, exclusive.
+        :return: The stop times in the range, sorted by departure time.
+        """
+        if not self._reduce_memory_usage:
+            ranges = self.get_rows_for_stops_between(stop_ids, start_seconds, end_seconds)
+            rows = merge(*ranges, key=self._departure_seconds.__getitem__)
+            stop_times = [GtfsStopTime(self, row) for row in rows]
+        else:
+            stop_ids = list(stop_ids)
+            placeholders = ",".join("?" * len(stop_ids))
+            stop_times = self._query_index("SELECT " + self.INDEX_COLUMNS + " FROM stop_times "
+                                           "WHERE stop_id IN (" + placeholders + ") "
+                                           "AND departure_seconds >= ? AND departure_seconds < ? "
+                                           "ORDER BY departure_seconds", stop_ids + [start_seconds, end_seconds])
+        STOP_TIMES_SCANNED.inc(len(stop_times))
         return stop_times
 
-    def _map_stop_times_by_stop_id(self, _stop_times):
-        stop_times_by_stop = defaultdict(list)
-        for stop in _stop_times:
-            stop_times_by_stop[stop['stop_id']].append(stop)
-        return stop_times_by_stop
+    def iterate_stop_times_for_stops_from(self, stop_ids, start_seconds):
+        """
+        Iterate over the stop times at the given stops which depart at or after a given time. The stop times are read
+        lazily, so only the stop times which are actually used are looked up.
+        :param stop_ids: The stops to get the stop times for.
+        :param start_seconds: The start of the range, in seconds since midnight, inclusive.
+        :return: An iterator over the stop times, sorted by departure time.
+        """
+        if not self._reduce_memory_usage:
+            ranges = self.get_rows_for_stops_between(stop_ids, start_seconds, MAX_DEPARTURE_SECONDS)
+            return (GtfsStopTime(self, row) for row in merge(*ranges, key=self._departure_seconds.__getitem__))
+        else:
+            # Every stop is read in index order, so SQLite doesn't need to sort all remaining stop times of the day
+            # before returning the first one
+            cursors = [self._iterate_index("SELECT " + self.INDEX_COLUMNS + " FROM stop_times "
+                                           "WHERE stop_id = ? AND departure_seconds >= ? "
+                                           "ORDER BY departure_seconds", (stop_id, start_seconds))
+                       for stop_id in stop_ids]
+            return merge(*cursors, key=lambda row: row['departure_seconds'])
+
+    def get_rows_for_stops_between(self, stop_ids, start_seconds, end_seconds):
+        """
+        Get the rows of the stop times at the given stops which depart in a time range. Only available when the stop
+        times are kept in memory.
+        :param stop_ids: The stops to get the rows for.
+        :param start_seconds: The start of the range, in seconds since midnight, inclusive.
+        :param end_seconds: The end of the range, in seconds since midnight, exclusive.
+        :return: A list containing a range of rows for every known stop, in the order of the given stops. The rows in
+                 each range are sorted by departure time.
+        """
+        ranges = list()
+        for stop_id in stop_ids:
+            stop_index = self._stop_index.get(stop_id)
+            if stop_index is None:
+                continue
+            # The rows of every stop are sorted by departure time, so the range can be found with a binary search
+            first_row = self._rows_by_stop_offsets[stop_index]
+            last_row = self._rows_by_stop_offsets[stop_index + 1]
+            ranges.append(range(bisect_left(self._departure_seconds, start_seconds, first_row, last_row),
+                                bisect_left(self._departure_seconds, end_seconds, first_row, last_row)))
+        return ranges
+
+    def get_stop_time(self, row):
+        """
+        Get the stop time at a row. Only available when the stop times are kept in memory.
+        :param row: The row, as returned by get_rows_for_stops_between.
+        :return: The stop time.
+        """
+        return GtfsStopTime(self, row)
+
+    def get_trip_ids(self):
+        """
+        Get the ids of all trips in the stop times. The position of a trip in this list is the value used for that trip
+        in the trip column. Only available when the stop times are kept in memory.
+        :return: A list of trip ids.
+        """
+        return self._trip_ids
+
+    def get_stop_time_count(self):
+        """
+        :return: The number of stop times, or None if the stop times aren't kept in memory.
+        """
+        if self._reduce_memory_usage:
+            return None
+        return len(self._departure_seconds)
+
+    def is_kept_in_memory(self):
+        """
+        :return: Whether the stop times are kept in memory, rather than being read from an on-disk index.
+        """
+        return not self._reduce_memory_usage
+
+    def _create_stop_times_index(self):
+        """
+        Create an on-disk SQLite index of stop_times.txt, if it doesn't exist yet for this feed. Queries can seek
+        straight to the relevant rows in this index, without keeping the stop times in memory.
+        :return: The path to the index.
+        """
+        index_directory = GtfsCacheSnapshot.get_cache_directory(self._gtfs_root)
+        index_path = os.path.join(index_directory, "stop_times-" + GtfsCacheSnapshot.get_feed_hash(self._gtfs_root)
+                                  + ".sqlite")
+        if os.path.exists(index_path):
+            return index_path
+
+        logging.info("Creating stop times index, this is only needed once per GTFS feed")
+        # Write to a temporary file first, so another process never uses a partially written index
+        temporary_path = index_path + ".tmp"
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        connection = sqlite3.connect(temporary_path)
+        try:
+            connection.execute("PRAGMA journal_mode = OFF")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.execute("CREATE TABLE stop_times (trip_id TEXT, stop_id TEXT, departure_time TEXT, "
+                               "departure_seconds INTEGER, stop_sequence INTEGER, stop_headsign TEXT)")
+            with open_gtfs_file(self._gtfs_root, "stop_times.txt") as csv_file:
+                reader = csv.DictReader(csv_file, delimiter=',')
+                connection.executemany("INSERT INTO stop_times VALUES (?, ?, ?, ?, ?, ?)",
+                                       ((row['trip_id'], row['stop_id'], row['departure_time'],
+                                         # Perform this "heavy lifting" once, so we can reuse it quickly later on
+                                         self.get_seconds_since_midnight(row['departure_time']),
+                                         int(row['stop_sequence']), row.get('stop_headsign', ''))
+                                        for row in reader))
+            connection.execute("CREATE INDEX stop_times_by_stop ON stop_times (stop_id, departure_seconds)")
+            connection.execute("CREATE INDEX stop_times_by_trip ON stop_times (trip_id)")
+            connection.commit()
+        finally:
+            connection.close()
+        # Indexes of older versions of the feed might still be in use, they are removed together with their version
+        os.replace(temporary_path, index_path)
+        logging.info("Created stop times index")
+        return index_path
 
-    def _map_stop_times_by_trip_id(self, _stop_times):
-        stop_times_by_trip = defaultdict(list)
-        for stop in _stop_times:
-            stop_times_by_trip[stop['trip_id']].append(stop)
-        return stop_times_by_trip
+    def _query_index(self, query, parameters=()):
+        return self._iterate_index(query, parameters).fetchall()
 
-    def get_seconds_since_midnight(self, time_str):
+    def _iterate_index(self, query, parameters=()):
+        connection = getattr(self._index_connections, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(pathlib.Path(os.path.abspath(self._index_path)).as_uri() + "?mode=ro",
+                                         uri=True)
+            # Rows can be accessed by column name, just like the rows in the in-memory cache
+            connection.row_factory = sqlite3.Row
+            self._index_connections.connection = connection
+        # The cursor fetches rows from the index while it is being iterated
+        return connection.execute(query, parameters)
+
+    def _load_stop_times(self, executor=None):
+        """
+        Read stop_times.txt into a columnar format. Stop, trip and headsign strings are interned and replaced by small
+        integers, and every column is stored in a compact array instead of keeping one dictionary per row.
+        Rows are ordered by stop, so the stop times for a stop are a contiguous range of rows.
+        :param executor: An optional process pool executor. If given, parts of the file are parsed in parallel.
+        """
+        if executor is not None and os.path.isdir(self._gtfs_root):
+            chunks = self._parse_stop_times_in_parallel(executor)
+        else:
+            with open_gtfs_file(self._gtfs_root, "stop_times.txt") as csv_file:
+                reader = csv.reader(csv_file, delimiter=',')
+                chunks = [parse_stop_time_rows(reader, get_stop_time_fields(next(reader)))]
+        stop_index, trip_index, headsign_index, stop_column, trip_column, departure_column, sequence_column, \
+            headsign_column = self._merge_stop_time_chunks(chunks)
+
+        # Dicts keep their insertion order, so the keys are ordered by their interned index
+        self._stop_ids = list(stop_index)
+        self._stop_index = stop_index
+        self._trip_ids = list(trip_index)
+        self._trip_index = trip_index
+        self._headsigns = list(headsign_index)
+
+        # Reorder all columns by stop, and by departure time within every stop. Every stop maps to a contiguous range
+        # of rows, in which time windows can be looked up using a binary search.
+        # Sorting is stable, so sorting by departure time first and by stop afterwards results in this order.
+        rows_by_stop = sorted(range(len(stop_column)), key=departure_column.__getitem__)
+        rows_by_stop.sort(key=stop_column.__getitem__)
+        rows_by_stop = array('i', rows_by_stop)
+        self._rows_by_stop_offsets = self._get_group_offsets(stop_column, len(self._stop_ids))
+        self._stop_column = array('i', map(stop_column.__getitem__, rows_by_stop))
+        self._trip_column = array('i', map(trip_column.__getitem__, rows_by_stop))
+        self._departure_seconds = array('i', map(departure_column.__getitem__, rows_by_stop))
+        self._stop_sequence = array('i', map(sequence_column.__getitem__, rows_by_stop))
+        self._headsign_column = array('i', map(headsign_column.__getitem__, rows_by_stop))
+        # Trips are looked up through an index, since the rows are already ordered by stop.
+        # Group the rows in their original order, then translate them to their new position.
+        # Sorting the original row numbers by their new position results in the new position of every original row.
+        new_positions = sorted(range(len(rows_by_stop)), key=rows_by_stop.__getitem__)
+        rows_by_trip = sorted(range(len(trip_column)), key=trip_column.__getitem__)
+        self._rows_by_trip_offsets = self._get_group_offsets(trip_column, len(self._trip_ids))
+        self._rows_by_trip = array('i', map(new_positions.__getitem__, rows_by_trip))
+
+    def _parse_stop_times_in_parallel(self, executor):
+        """
+        Split stop_times.txt into chunks of rows, and parse these chunks in parallel.
+        A quoted field can contain a newline, so not every line starts a new row. Quotes in a quoted field always come
+        in pairs (a quote inside the field is escaped by doubling it), so a newline ends a row when the number of quotes
+        before it is even. This assumes quotes are only used to quote fields, as required by the GTFS specification.
+        :param executor: The process pool executor to parse the chunks on.
+        :return: The parsed chunks, in the same order as in the file.
+        """
+        path = os.path.join(self._gtfs_root, "stop_times.txt")
+        file_size = os.path.getsize(path)
+        # Use many small chunks rather than one chunk per process, so all processes stay busy until the end
+        chunk_count = max(1, file_size // STOP_TIMES_CHUNK_SIZE)
+        with open(path, "rb") as file:
+            header = next(csv.reader([file.readline().decode("utf-8-sig")]))
+            offsets = [file.tell()]
+            # The number of quotes between the end of the header and the current position in the file
+            quote_count = 0
+            for chunk in range(1, chunk_count):
+                # Move every chunk boundary to the start of the next row
+                boundary = max(offsets[-1], file_size * chunk // chunk_count)
+                while file.tell() < boundary:
+                    quote_count += file.read(min(boundary - file.tell(), 1024 * 1024)).count(b'"')
+                line = file.readline()
+                quote_count += line.count(b'"')
+                while quote_count % 2 and line:
+                    # This newline is part of a quoted field, the row continues on the next line
+                    line = file.readline()
+                    quote_count += line.count(b'"')
+                offsets.append(file.tell())
+            offsets.append(file_size)
+        fields = get_stop_time_fields(header)
+        ranges = [(start, end) for start, end in zip(offsets, offsets[1:]) if end > start]
+        return list(executor.map(parse_stop_times_chunk, [path] * len(ranges),
+                                 [start for start, _ in ranges], [end for _, end in ranges], [fields] * len(ranges)))
+
+    @staticmethod
+    def _merge_stop_time_chunks(chunks):
+        """
+        Merge parsed chunks of stop_times.txt. Every chunk has its own interned ids, which are translated to ids which
+        are shared by all chunks.
+        :param chunks: The parsed chunks, as returned by parse_stop_time_rows.
+        :return: The merged (stop index, trip index, headsign index) dicts and (stop, trip, departure, sequence and
+                 headsign) columns.
+        """
+        if len(chunks) == 1:
+            # Nothing to translate, the chunk ids can be used as they are
+            stop_ids, trip_ids, headsigns, *columns = chunks[0]
+            return ({stop_id: i for i, stop_id in enumerate(stop_ids)},
+                    {trip_id: i for i, trip_id in enumerate(trip_ids)},
+                    {headsign: i for i, headsign in enumerate(headsigns)},
+                    *columns)
+
+        stop_index = dict()
+        trip_index = dict()
+        headsign_index = dict()
+        stop_column = array('i')
+        trip_column = array('i')
+        departure_column = array('i')
+        sequence_column = array('i')
+        headsign_column = array('i')
+        for stop_ids, trip_ids, headsigns, chunk_stops, chunk_trips, chunk_departures, chunk_sequences, \
+                chunk_headsigns in chunks:
+            stop_translation = [stop_index.setdefault(stop_id, len(stop_index)) for stop_id in stop_ids]
+            trip_translation = [trip_index.setdefault(trip_id, len(trip_index)) for trip_id in trip_ids]
+            headsign_translation = [headsign_index.setdefault(headsign, len(headsign_index)) for headsign in headsigns]
+            stop_column.extend(map(stop_translation.__getitem__, chunk_stops))
+            trip_column.extend(map(trip_translation.__getitem__, chunk_trips))
+            departure_column.extend(chunk_departures)
+            sequence_column.extend(chunk_sequences)
+            headsign_column.extend(map(headsign_translation.__getitem__, chunk_headsigns))
+        return stop_index, trip_index, headsign_index, stop_column, trip_column, departure_column, sequence_column, \
+            headsign_column
+
+    @staticmethod
+    def _get_group_offsets(keys, key_count):
+        """
+        Get the offsets of every group of rows, for rows which are sorted by key.
+        :param keys: An array containing the (interned) key for every row.
+        :param key_count: The number of distinct keys.
+        :return: An array of offsets. The sorted rows for key k are rows[offsets[k]:offsets[k + 1]].
+        """
+        counts = Counter(keys)
+        return array('i', accumulate((counts[key] for key in range(key_count)), initial=0))
+
+    def _get_column_value(self, row, key):
+        if key == 'departure_seconds':
+            return self._departure_seconds[row]
+        if key == 'trip_id':
+            return self._trip_ids[self._trip_column[row]]
+        if key == 'stop_id':
+            return self._stop_ids[self._stop_column[row]]
+        if key == 'stop_sequence':
+            return self._stop_sequence[row]
+        if key == 'stop_headsign':
+            return self._headsigns[self._headsign_column[row]]
+        if key == 'departure_time':
+            return self.get_time_string(self._departure_seconds[row])
+        raise KeyError(key)
+
+    @staticmethod
+    def get_seconds_since_midnight(time_str):
         """Get Seconds from time, for faster calculations later on."""
         h = time_str[0:2]
         m = time_str[3:5]
         s = time_str[6:8]
         return int(h) * 3600 + int(m) * 60 + int(s)
 
+    @staticmethod
+    def get_time_string(seconds_since_midnight):
+        """Convert seconds since midnight back to a hh:mm:ss string. Hours can exceed 23, like in the GTFS data."""
+        m, s = divmod(seconds_since_midnight, 60)
+        h, m = divmod(m, 60)
+        return f'{h:02d}:{m:02d}:{s:02d}'
+
 
 class GtfsCalendarDatesCache:
+    """
+    This cache contains the days on which every service runs. Services are read from calendar.txt, which contains weekly
+    patterns, and calendar_dates.txt, which contains added and removed dates. Both files are optional, but a feed
+    contains at least one of them.
+    The days of every service are stored as a bitmap over the days in the feed, where bit n is set if the service runs
+    on the n-th day after the first date in the feed.
+    """
+
+    # The columns in calendar.txt containing whether a service runs on a weekday, with monday first
+    WEEKDAY_COLUMNS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
     def __init__(self, gtfs_root):
         self._gtfs_root = gtfs_root
-        self._calendar_dates = self._get_calendar_dates()
-        self._dates_by_service = self._map_operating_days_by_service(self._calendar_dates)
-        self._services_by_date = self._map_services_by_date(self._calendar_dates)
-        self._trip_serviced_on_date_cache = dict()  # Filled during use
+        calendar = self._get_calendar() if gtfs_file_exists(gtfs_root, "calendar.txt") else []
+        calendar_dates = self._get_calendar_dates() if gtfs_file_exists(gtfs_root, "calendar_dates.txt") else []
+        # The first date in the feed is bit 0 in every bitmap
+        self._first_date = min([row['start_date'] for row in calendar] + [row['date'] for row in calendar_dates],
+                               default=None)
+        self._days_by_service = self._map_days_by_service(calendar, calendar_dates)
 
+    def _get_calendar(self):
+        rows = list()
+        with open_gtfs_file(self._gtfs_root, "calendar.txt") as csv_file:
+            reader = csv.DictReader(csv_file, delimiter=',')
+            for row in reader:
+                row['start_date'] = datetime.strptime(row['start_date'], '%Y%m%d').date()
+                row['end_date'] = datetime.strptime(row['end_date'], '%Y%m%d').date()
+                rows.append(row)
+        return rows
 
     def _get_calendar_dates(self):
         dates = list()
-        with open(self._gtfs_root + "/calendar_dates.txt", encoding="utf-8-sig") as csv_file:
+        with open_gtfs_file(self._gtfs_root, "calendar_dates.txt") as csv_file:
             reader = csv.DictReader(csv_file, delimiter=',')
             for row in reader:
                 row['date'] = datetime.strptime(row['date'], '%Y%m%d').date()
                 dates.append(row)
         return dates
 
-    def _map_operating_days_by_service(self, dates):
-        dates_by_id = defaultdict(list)
-        for row in dates:
+    def _map_days_by_service(self, calendar, calendar_dates):
+        days_by_service = defaultdict(int)
+        for row in calendar:
+            start_day = self._get_day(row['start_date'])
+            day_count = (row['end_date'] - row['start_date']).days + 1
+            if day_count <= 0:
+                continue
+            # Repeat the weekly pattern from the start date up to the end date. The bitmap is built as a string of
+            # ones and zeros, which is much faster than setting every bit separately.
+            week = ['1' if row[column] == '1' else '0' for column in self.WEEKDAY_COLUMNS]
+            first_weekday = row['start_date'].weekday()
+            week = week[first_weekday:] + week[:first_weekday]
+            days = ("".join(week) * (day_count // 7 + 1))[:day_count]
+            # The first day is the lowest bit, so the string needs to be reversed
+            days_by_service[sys.intern(row['service_id'])] |= int(days[::-1], 2) << start_day
+        for row in calendar_dates:
+            service_id = sys.intern(row['service_id'])
+            day = self._get_day(row['date'])
             if row['exception_type'] == '1':
-                dates_by_id[row['service_id']].append(row['date'])
-        return dates_by_id
+                days_by_service[service_id] |= 1 << day
+            elif row['exception_type'] == '2':
+                days_by_service[service_id] &= ~(1 << day)
+        return dict(days_by_service)
 
-    def _map_services_by_date(self, dates):
-        dates_by_id = defaultdict(list)
-        for row in dates:
-            if row['exception_type'] == '1':
-                dates_by_id[row['date']].append(row['service_id'])
-        return dates_by_id
+    def _get_day(self, date):
+        """
+        :return: The bit for a date in the bitmaps, or -1 if the date is before the first date in the feed.
+        """
+        if self._first_date is None or date < self._first_date:
+            return -1
+        return (date - self._first_date).days
 
     def get_service_operating_days(self, service_id):
-        return self._dates_by_service[service_id]
+        """
+        :return: The dates on which a service runs. A service without calendar or calendar dates never runs.
+        """
+        days = self._days_by_service.get(service_id, 0)
+        return [self._first_date + timedelta(days=day) for day in range(days.bit_length()) if days >> day & 1]
 
     def get_operating_services(self, date):
-        return self._services_by_date[date]
+        """
+        Get the services which run on a date. This goes through all services, callers which need the services for the
+        same date repeatedly should keep the result.
+        :param date: The date.
+        :return: A set containing the ids of the services which run on the given date.
+        """
+        day = self._get_day(date)
+        if day < 0:
+            return set()
+        return {service_id for service_id, days in self._days_by_service.items() if days >> day & 1}
 
     def is_serviced(self, service_id, date):
-        key = (service_id, date)
-        if key not in self._trip_serviced_on_date_cache:
-            self._trip_serviced_on_date_cache[key] = service_id in self._services_by_date[date]
-        return self._trip_serviced_on_date_cache[key]
+        day = self._get_day(date)
+        return day >= 0 and bool(self._days_by_service.get(service_id, 0) >> day & 1)
+
+
+class GtfsStopTimesWindowFilter:
+    """
+    This class filters the stop times at a set of stops on a time window and on the services which are active, using
+    NumPy to evaluate all candidate stop times at once instead of one by one. Every trip is mapped to the index of its
+    service, so the trips which run on a date follow from a small boolean array with the active services on that date.
+    The results are identical to filtering the stop times one by one.
+    Only available when NumPy is installed and the stop times are kept in memory, see is_supported.
+    """
+
+    def __init__(self, stop_times_cache, trips_cache, calendar_dates_cache, max_dates=4):
+        """
+        :param stop_times_cache: The GtfsStopTimesCache containing the stop times to filter.
+        :param trips_cache: The GtfsTripsCache to get the service of every trip from.
+        :param calendar_dates_cache: The GtfsCalendarDatesCache to get the services for each date from.
+        :param max_dates: The maximum number of dates to keep the active services for.
+        """
+        self._stop_times_cache = stop_times_cache
+        self._calendar_dates_cache = calendar_dates_cache
+        self._max_dates = max_dates
+        columns = stop_times_cache.get_columns()
+        # Views on the existing columns, no data is copied
+        self._departure_seconds = numpy.frombuffer(columns['_departure_seconds'], dtype=numpy.intc)
+        self._trip_column = numpy.frombuffer(columns['_trip_column'], dtype=numpy.intc)
+        self._service_index = dict()
+        service_indices = list()
+        for trip_id in stop_times_cache.get_trip_ids():
+            try:
+                service_id = trips_cache.get_trip(trip_id)['service_id']
+                service_indices.append(self._service_index.setdefault(service_id, len(self._service_index)))
+            except KeyError:
+                # A trip which isn't listed in trips.txt never runs. It gets an extra service which is never active.
+                service_indices.append(-1)
+        # Every index of -1 is replaced with an index right after the last service
+        self._trip_service_indices = numpy.array(service_indices, dtype=numpy.intc)
+        self._trip_service_indices[self._trip_service_indices < 0] = len(self._service_index)
+        self._active_services_by_date = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_supported(stop_times_cache):
+        """
+        :param stop_times_cache: The GtfsStopTimesCache containing the stop times to filter.
+        :return: Whether the stop times can be filtered by this class.
+        """
+        return numpy is not None and stop_times_cache.is_kept_in_memory()
+
+    def get_stop_times_between(self, stop_ids, service_day_windows, first_service_date):
+        """
+        Get the stop times at the given stops which depart in a time window, on a day on which the trip runs.
+        :param stop_ids: The stops for which the stop times should be retrieved.
+        :param service_day_windows: The time window, as a list of (service date, start seconds, end seconds) tuples.
+                                    The start and end are in seconds since midnight on the service date.
+        :param first_service_date: The date to which the departure times are relative when sorting.
+        :return: The stop times in the time window, sorted by their departure time. Departures at the same time are
+                 sorted by service date, by the order of the given stops and by the order in the stop times cache.
+        """
+        filtered_rows = list()
+        filtered_departures = list()
+        for service_date, start_secs, end_secs in service_day_windows:
+            ranges = self._stop_times_cache.get_rows_for_stops_between(stop_ids, start_secs, end_secs)
+            if not ranges:
+                continue
+            if Metrics.is_enabled():
+                STOP_TIMES_SCANNED.inc(sum(map(len, ranges)))
+            rows = numpy.concatenate([numpy.arange(r.start, r.stop, dtype=numpy.intp) for r in ranges])
+            # Evaluate the service day for all rows at once, by looking up the service of the trip of every row
+            active_services = self._get_active_services(service_date)
+            rows = rows[active_services[self._trip_service_indices[self._trip_column[rows]]]]
+            service_day_offset = (service_date - first_service_date).days * 24 * 3600
+            filtered_rows.append(rows)
+            filtered_departures.append(self._departure_seconds[rows].astype(numpy.int64) + service_day_offset)
+        if not filtered_rows:
+            return []
+        departures = numpy.concatenate(filtered_departures)
+        # A stable sort keeps the order of departures at the same time, which makes the result identical to merging
+        rows = numpy.concatenate(filtered_rows)[numpy.argsort(departures, kind='stable')]
+        return [self._stop_times_cache.get_stop_time(row) for row in rows.tolist()]
+
+    def _get_active_services(self, date):
+        """
+        Get the services which are active on a date.
+        :param date: The date.
+        :return: A boolean array, containing whether the service with that index is active, for every service index.
+        """
+        with self._lock:
+            active_services = self._active_services_by_date.get(date)
+            if active_services is not None:
+                self._active_services_by_date.move_to_end(date)
+                return active_services
+
+        # The last element is used for trips without a known service, it's always False
+        active_services = numpy.zeros(len(self._service_index) + 1, dtype=bool)
+        for service_id in self._calendar_dates_cache.get_operating_services(date):
+            service_index = self._service_index.get(service_id)
+            if service_index is not None:
+                active_services[service_index] = True
+        with self._lock:
+            self._active_services_by_date[date] = active_services
+            self._active_services_by_date.move_to_end(date)
+            while len(self._active_services_by_date) > self._max_dates:
+                self._active_services_by_date.popitem(last=False)
+        return active_services
+
+
+class GtfsActiveTripsCache:
+    """
+    This cache keeps the set of trips which are active on a date, for the few dates which are being queried.
+    The set for a date is calculated once, when it is first needed. Only the most recently used dates are retained,
+    which keeps memory usage constant in long-running processes.
+    """
+
+    def __init__(self, trips_cache, calendar_dates_cache, max_dates=4):
+        """
+        :param trips_cache: The GtfsTripsCache to get the trips for each service from.
+        :param calendar_dates_cache: The GtfsCalendarDatesCache to get the services for each date from.
+        :param max_dates: The maximum number of dates to keep active trips for. Queries need the active trips for the
+                          day before, the day itself and the next day.
+        """
+        self._trips_cache = trips_cache
+        self._calendar_dates_cache = calendar_dates_cache
+        self._max_dates = max_dates
+        self._active_trips_by_date = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_active_trips(self, date):
+        """
+        Get the ids of all trips which run on a given date.
+        :param date: The date.
+        :return: A frozenset containing the ids of the trips which run on the given date.
+        """
+        with self._lock:
+            active_trips = self._active_trips_by_date.get(date)
+            if active_trips is not None:
+                self._active_trips_by_date.move_to_end(date)
+                return active_trips
+
+        active_trips = frozenset(trip_id
+                                 for service_id in self._calendar_dates_cache.get_operating_services(date)
+                                 for trip_id in self._trips_cache.get_trip_ids_for_service(service_id))
+        with self._lock:
+            self._active_trips_by_date[date] = active_trips
+            self._active_trips_by_date.move_to_end(date)
+            # Remove the dates which haven't been used for the longest time
+            while len(self._active_trips_by_date) > self._max_dates:
+                self._active_trips_by_date.popitem(last=False)
+        return active_trips
@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+
+# Increase this number whenever the data stored in the caches changes, so older snapshots are no longer used.
+SNAPSHOT_VERSION = 4
+
+# The GTFS files which are read by the caches. A change in one of these files results in a new snapshot.
+SNAPSHOT_SOURCE_FILES = ["calendar.txt", "calendar_dates.txt", "stops.txt", "stop_times.txt", "routes.txt", "trips.txt"]
+
+# The files derived from a GTFS feed are named <prefix>-<feed hash>.<extension>: snapshots and stop times indexes.
+DERIVED_FILE_PREFIXES = {"cache", "stop_times"}
+
+
+class GtfsCacheSnapshot:
+    """
+    This is a helper class to store parsed GTFS caches in a binary snapshot next to the GTFS feed, so they
+    don't need to be parsed again when the application is restarted. A snapshot consists of two files:
+    - A pickle file containing the caches, except for the large stop times columns.
+    - A file containing the raw stop times columns. This file is memory-mapped when the snapshot is loaded, so the
+      columns are available immediately and only the parts which are actually used are read from disk.
+    Snapshots are keyed by a hash of the GTFS files, a new feed will never use an older snapshot.
+    """
+
+    @staticmethod
+    def load(gtfs_root: str):
+        """
+        Load the caches from a snapshot, if a snapshot exists for the current feed.
+        :param gtfs_root: The directory containing the extracted GTFS feed, or the path to the GTFS zip file.
+        :return: A dict containing the caches, or None if no (valid) snapshot is available.
+        """
+        caches_path, columns_path = GtfsCacheSnapshot._get_snapshot_paths(gtfs_root)
+        if not os.path.exists(caches_path) or not os.path.exists(columns_path):
+            logging.info("No GTFS cache snapshot found")
+            return None
+        try:
+            with open(caches_path, "rb") as caches_file:
+                caches = pickle.load(caches_file)
+                column_layout = pickle.load(caches_file)
+            with open(columns_path, "rb") as columns_file:
+                # The mapping stays open as long as the columns are in use, it is closed when the cache is discarded
+                columns_buffer = mmap.mmap(columns_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+            logging.warning(f"Failed to load GTFS cache snapshot, caches will be rebuilt: {e}")
+            return None
+
+        columns_view = memoryview(columns_buffer)
+        columns = dict()
+        for name, typecode, offset, size in column_layout:
+            columns[name] = columns_view[offset:offset + size].cast(typecode)
+        caches["stop_times"].set_columns(columns, columns_buffer)
+        logging.info("Loaded GTFS caches from snapshot")
+        return caches
+
+    @staticmethod
+    def save(gtfs_root: str, caches: dict):
+        """
+        Store the caches in a snapshot. Snapshots of older versions of the feed might still be in use, they are removed
+        using remove_unused_files once they are no longer needed.
+        :param gtfs_root: The directory containing the extracted GTFS feed, or the path to the GTFS zip file.
+        :param caches: A dict containing the caches. The stop times cache should be stored under the stop_times key.
+        """
+        caches_path, columns_path = GtfsCacheSnapshot._get_snapshot_paths(gtfs_root)
+        column_layout = list()
+        try:
+            # Write to temporary files first, so another process never reads a partially written snapshot
+            with open(columns_path + ".tmp", "wb") as columns_file:
+                for name, column in caches["stop_times"].get_columns().items():
+                    offset = columns_file.tell()
+                    columns_file.write(column)
+                    column_layout.append((name, memoryview(column).format, offset, columns_file.tell() - offset))
+            with open(caches_path + ".tmp", "wb") as caches_file:
+                pickle.dump(caches, caches_file, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(column_layout, caches_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(columns_path + ".tmp", columns_path)
+            os.replace(caches_path + ".tmp", caches_path)
+        except OSError as e:
+            logging.warning(f"Failed to store GTFS cache snapshot: {e}")
+            return
+        logging.info("Stored GTFS caches in snapshot")
+
+    @staticmethod
+    def get_feed_hash(gtfs_root: str) -> str:
+        """
+        Calculate a hash which identifies the GTFS feed. The name, size and modification time of the files are used
+        instead of their contents, so calculating the hash is fast even for large feeds.
+        :param gtfs_root: The directory containing the extracted GTFS feed, or the path to the GTFS zip file.
+        :return: The hash as a hexadecimal string.
+        """
+        feed_hash = hashlib.sha1(str(SNAPSHOT_VERSION).encode())
+        if not os.path.isdir(gtfs_root):
+            source_paths = [gtfs_root]
+        else:
+            source_paths = [os.path.join(gtfs_root, filename) for filename in SNAPSHOT_SOURCE_FILES]
+        for path in source_paths:
+            if not os.path.exists(path):
+                continue
+            stat = os.stat(path)
+            feed_hash.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        return feed_hash.hexdigest()
+
+    @staticmethod
+    def get_cache_directory(gtfs_root: str) -> str:
+        """
+        Get the directory in which files derived from the GTFS feed, such as snapshots, should be stored.
+        :param gtfs_root: The directory containing the extracted GTFS feed, or the path to the GTFS zip file.
+        :return: The directory containing the extracted feed, or the directory containing the zip file.
+        """
+        if os.path.isdir(gtfs_root):
+            return gtfs_root
+        return os.path.dirname(os.path.abspath(gtfs_root))
+
+    @staticmethod
+    def _get_snapshot_paths(gtfs_root: str):
+        feed_hash = GtfsCacheSnapshot.get_feed_hash(gtfs_root)
+        cache_directory = GtfsCacheSnapshot.get_cache_directory(gtfs_root)
+        return os.path.join(cache_directory, f"cache-{feed_hash}.pickle"), \
+               os.path.join(cache_directory, f"cache-{feed_hash}.columns")
+
+    @staticmethod
+    def remove_unused_files(gtfs_roots: list):
+        """
+        Remove the files derived from GTFS feeds, such as snapshots and stop times indexes, which don't belong to one
+        of the given feeds. Feeds read from zip files share the directory in which these files are stored, so this
+        should only be called once the other feeds are no longer in use.
+        :param gtfs_roots: The feeds which are still in use. Every feed is a directory containing an extracted GTFS
+                           feed, or the path to a GTFS zip file.
+        """
+        feed_hashes_by_directory = dict()
+        for gtfs_root in gtfs_roots:
+            feed_hashes_by_directory.setdefault(GtfsCacheSnapshot.get_cache_directory(gtfs_root), set()) \
+                .add(GtfsCacheSnapshot.get_feed_hash(gtfs_root))
+        for cache_directory, feed_hashes in feed_hashes_by_directory.items():
+            for filename in os.listdir(cache_directory):
+                # Derived files are named <type>-<feed hash>.<extension>, possibly followed by .tmp
+                prefix, _, rest = filename.partition("-")
+                if prefix not in DERIVED_FILE_PREFIXES or rest.partition(".")[0] in feed_hashes:
+                    continue
+                logging.info(f"Removing unused GTFS cache file {filename}")
+                try:
+                    os.remove(os.path.join(cache_directory, filename))
+                except OSError:
+                    pass
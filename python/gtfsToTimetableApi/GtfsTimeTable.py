@@ -1,18 +1,44 @@
 import argparse
 import datetime
+import json
 import logging
+import multiprocessing
 import os
+import shutil
 import sys
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from io import BytesIO
+from heapq import heappush, heappop, heapreplace
+from itertools import islice
 
 import requests
 import urllib3
 
-from GtfsCacheHelpers import GtfsStopsCache, GtfsRoutesCache, GtfsTripsCache, GtfsStopTimesCache, GtfsCalendarDatesCache
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, it's only used to serialize API responses faster
+    orjson = None
+
+from GtfsCacheHelpers import GtfsStopsCache, GtfsRoutesCache, GtfsTripsCache, GtfsStopTimesCache, \
+    GtfsCalendarDatesCache, GtfsActiveTripsCache, GtfsStopTimesWindowFilter, GtfsStopsGridIndex, STOP_TIMES_SCANNED
+from GtfsCacheSnapshot import GtfsCacheSnapshot
+from Metrics import Metrics, Counter, Histogram
 from RealtimeDataFetcher import RealtimeDataFetcher
 
+# The number of days after the start date in which next departures are searched. Searching stops after this many days,
+# even if fewer departures than requested were found.
+MAX_NEXT_DEPARTURES_DAYS = 7
+
+QUERY_STAGE_SECONDS = Histogram("timetable_query_stage_seconds",
+                                "The time spent in every stage of a timetable query, in seconds", ["stage"])
+DEPARTURES_RETURNED = Counter("timetable_departures_returned_total",
+                              "The number of departures returned by timetable queries")
+CACHE_LOAD_SECONDS = Histogram("gtfs_cache_load_seconds",
+                               "The time needed to load the GTFS caches, from a snapshot or by parsing the feed",
+                               ["source"])
+
 ROUTE_TYPE_NAMES = {
     100: "TRAIN",
     401: "METRO",
@@ -23,18 +49,33 @@ ROUTE_TYPE_NAMES = {
 }
 
 
+def to_json(value) -> str:
+    """
+    Serialize a value to JSON. orjson is used when it's installed, otherwise the standard json module is used.
+    :param value: The value to serialize.
+    :return: The JSON string.
+    """
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+
 class GtfsArchiveFetcher:
     """
     This is a helper class to download and extract GTFS archives.
     """
 
     @staticmethod
-    def fetch_and_extract(url: str, directory: str) -> str:
+    def fetch_and_extract(url: str, directory: str, extract: bool = True) -> str:
         """
-        Fetch a GTFS file if it hasn't been fetched recently, and extract it.
+        Fetch a GTFS file if it hasn't been fetched recently, and extract it. Every new archive is extracted into a new
+        versioned directory, so files which are still in use by an older version are never overwritten.
         :param url: The url to download the archive from in case this is needed.
         :param directory: Where to extract the archive to
-        :return: The directory containing the extracted archive
+        :param extract: Whether the archive should be extracted. If False, the GTFS files are read directly from the
+                        zip file instead.
+        :return: The directory containing the most recently extracted archive, or the path to the most recent zip file
+                 if the archive isn't extracted.
         """
         filename = os.path.basename(urllib3.util.parse_url(url).path)[0:-4]  # Get the filename from the URL
         directory_path = os.path.join(os.getcwd(), directory, filename)
@@ -43,15 +84,76 @@ class GtfsArchiveFetcher:
             os.makedirs(directory_path)
 
         # Check if a download is needed
-        if not GtfsArchiveFetcher.archive_exists(directory_path) \
-                or GtfsArchiveFetcher.is_archive_outdated(directory_path):
+        version_path = GtfsArchiveFetcher.get_latest_version(directory_path, extract)
+        if version_path is None or GtfsArchiveFetcher.is_archive_outdated(version_path):
             logging.info("Updating GTFS archive")
-            r = requests.get(url, allow_redirects=True)
-            zipdata = BytesIO()
-            zipdata.write(r.content)
-            with zipfile.ZipFile(zipdata) as zip_ref:
-                zip_ref.extractall(directory_path)
-        return directory_path
+            version = datetime.now().strftime("%Y%m%d%H%M%S")
+            zip_path = os.path.join(directory_path, version + ".zip")
+            GtfsArchiveFetcher.download(url, zip_path)
+            if not extract:
+                return zip_path
+            version_path = os.path.join(directory_path, version)
+            # Extract to a temporary directory first, so a partially extracted archive is never used
+            with zipfile.ZipFile(zip_path) as zip_ref:
+                zip_ref.extractall(version_path + ".tmp")
+            os.rename(version_path + ".tmp", version_path)
+            os.remove(zip_path)
+        return version_path
+
+    @staticmethod
+    def download(url: str, path: str):
+        """
+        Download a file to disk. The file is streamed to disk in chunks, so it is never kept in memory completely.
+        It is written under a temporary name first, and renamed once the download is complete.
+        :param url: The url to download.
+        :param path: The path to store the file at.
+        """
+        with requests.get(url, allow_redirects=True, stream=True) as r:
+            r.raise_for_status()
+            with open(path + ".tmp", "wb") as file:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    file.write(chunk)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def get_latest_version(directory, extracted: bool = True):
+        """
+        Get the most recently downloaded version of a GTFS archive.
+        :param directory: The directory containing all versions of the archive.
+        :param extracted: Whether to look for extracted archives, or zip files.
+        :return: The directory or zip file containing the most recent version, or None if no version is available yet.
+        """
+        if extracted:
+            versions = sorted(name for name in os.listdir(directory)
+                              if name.isdigit() and GtfsArchiveFetcher.archive_exists(os.path.join(directory, name)))
+        else:
+            versions = sorted(name for name in os.listdir(directory)
+                              if name[0:-4].isdigit() and name.endswith(".zip"))
+        if not versions:
+            return None
+        return os.path.join(directory, versions[-1])
+
+    @staticmethod
+    def remove_old_versions(version_directory, keep: int = 2):
+        """
+        Remove older versions of a GTFS archive, and the snapshots and indexes derived from them. Only call this once
+        the current version is in use, since the files of all other versions except the kept ones are removed.
+        :param version_directory: The directory (or zip file) containing the current version of the archive.
+        :param keep: The number of most recent versions to keep. The previous version is kept by default, since
+                     requests which started before switching to a new version might still be using it.
+        """
+        directory = os.path.dirname(version_directory)
+        versions = sorted(name for name in os.listdir(directory)
+                          if name.isdigit() or (name[0:-4].isdigit() and name.endswith(".zip")))
+        for name in versions[:-keep]:
+            logging.info(f"Removing old GTFS archive version {name}")
+            if name.endswith(".zip"):
+                os.remove(os.path.join(directory, name))
+            else:
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+        # Zip files share the directory in which derived files are stored, extracted versions might contain derived
+        # files of an older snapshot format
+        GtfsCacheSnapshot.remove_unused_files([os.path.join(directory, name) for name in versions[-keep:]])
 
     @staticmethod
     def archive_exists(directory):
@@ -63,10 +165,13 @@ class GtfsArchiveFetcher:
     def is_archive_outdated(directory):
         """
         Determine if the GTFS feed in a directory is outdated based on the creation time of the feed_info.txt file.
-        :param directory: The directory containing the extracted GTFS feed.
+        :param directory: The directory containing the extracted GTFS feed, or the GTFS zip file.
         :return: True if outdated, False otherwise.
         """
-        modification_time_epoch = os.path.getmtime(os.path.join(directory, "feed_info.txt"))
+        if os.path.isdir(directory):
+            modification_time_epoch = os.path.getmtime(os.path.join(directory, "feed_info.txt"))
+        else:
+            modification_time_epoch = os.path.getmtime(directory)
         creation_time = datetime.fromtimestamp(modification_time_epoch)
         is_outdated = datetime.now() - creation_time > timedelta(days=1)
         if is_outdated:
@@ -78,7 +183,19 @@ class GtfsArchiveFetcher:
 
 class TimeTableQueryEngine:
 
-    def __init__(self, gtfs_root: str, realtime_fetcher: RealtimeDataFetcher, reduce_memory_usage: bool = False):
+    def __init__(self, gtfs_root: str, realtime_fetcher: RealtimeDataFetcher, reduce_memory_usage: bool = False,
+                 use_snapshot: bool = True, workers: int = 1):
+        """
+        :param gtfs_root: The directory containing the extracted GTFS feed, or the path to the GTFS zip file.
+        :param realtime_fetcher: The fetcher to obtain realtime data from.
+        :param reduce_memory_usage: Whether memory usage should be reduced, at the cost of slower queries.
+        :param use_snapshot: Whether the parsed caches should be stored in, and loaded from, a binary snapshot next to
+                             the GTFS feed. This reduces the startup time after the first start significantly.
+                             Snapshots are not used when reduce_memory_usage is enabled.
+        :param workers: The number of processes to use for parsing the GTFS files. When more than one process is used,
+                        all files are parsed at the same time, and stop_times.txt is split into parts which are parsed
+                        in parallel.
+        """
         logging.info("Initializing TimeTableQueryEngine")
         if reduce_memory_usage:
             logging.warning("Reduced memory usage is enabled."
@@ -86,49 +203,241 @@ class TimeTableQueryEngine:
         # Initialize all caches here
         self._realtime_fetcher = realtime_fetcher
         self._gtfs_root = gtfs_root
-        self._calendar_dates_cache = GtfsCalendarDatesCache(self._gtfs_root)
-        self._stops_cache = GtfsStopsCache(self._gtfs_root)
+        use_snapshot = use_snapshot and not reduce_memory_usage
+        caches = None
+        if use_snapshot:
+            with CACHE_LOAD_SECONDS.time("snapshot"):
+                caches = GtfsCacheSnapshot.load(self._gtfs_root)
+        if caches is None:
+            with CACHE_LOAD_SECONDS.time("parse"):
+                caches = self._load_caches(reduce_memory_usage, workers)
+            if use_snapshot:
+                GtfsCacheSnapshot.save(self._gtfs_root, caches)
+        self._calendar_dates_cache = caches["calendar_dates"]
+        self._stops_cache = caches["stops"]
+        self._stop_times_cache = caches["stop_times"]
+        self._routes_cache = caches["routes"]
+        self._trips_cache = caches["trips"]
+        self._active_trips_cache = GtfsActiveTripsCache(self._trips_cache, self._calendar_dates_cache)
+        # The stops and routes in the API responses never change, serialize them once so JSON responses can be
+        # assembled from these fragments
+        self._stop_fragments = {stop['stop_id']: to_json(self._gtfs_stop_to_api_stop(stop))
+                                for stop in self._stops_cache.get_all_stops()}
+        self._route_fragments = {route['route_id']: self._create_route_fragment(route)
+                                 for route in self._routes_cache.get_all_routes()
+                                 if int(route['route_type']) in ROUTE_TYPE_NAMES}
+        # Index the locations of the stops which can be searched for, so the stops near a location can be found
+        # without calculating the distance to every stop
+        self._stops_grid_index = GtfsStopsGridIndex(stop for stop in self._stops_cache.get_all_stops()
+                                                    if stop['location_type'] == '1')
+        # Filter stop times in bulk when NumPy is available, otherwise they are filtered one by one
+        self._window_filter = None
+        if GtfsStopTimesWindowFilter.is_supported(self._stop_times_cache):
+            self._window_filter = GtfsStopTimesWindowFilter(self._stop_times_cache, self._trips_cache,
+                                                            self._calendar_dates_cache)
+        logging.info("Initialized TimeTableQueryEngine")
+
+    def _load_caches(self, reduce_memory_usage: bool, workers: int) -> dict:
+        """
+        Parse the GTFS files into caches.
+        :param reduce_memory_usage: Whether memory usage should be reduced, at the cost of slower queries.
+        :param workers: The number of processes to use for parsing the GTFS files.
+        :return: A dict containing all caches.
+        """
+        if workers > 1:
+            return self._load_caches_in_parallel(reduce_memory_usage, workers)
+        caches = dict()
+        caches["calendar_dates"] = GtfsCalendarDatesCache(self._gtfs_root)
+        caches["stops"] = GtfsStopsCache(self._gtfs_root)
         logging.debug("Initializing stop times cache, this can take a while...")
-        self._stop_times_cache = GtfsStopTimesCache(self._gtfs_root, reduce_memory_usage=reduce_memory_usage)
+        caches["stop_times"] = GtfsStopTimesCache(self._gtfs_root, reduce_memory_usage=reduce_memory_usage)
         logging.debug("Initialized stop times cache")
-        self._routes_cache = GtfsRoutesCache(self._gtfs_root)
-        self._trips_cache = GtfsTripsCache(self._gtfs_root)
-        logging.info("Initialized TimeTableQueryEngine")
+        caches["routes"] = GtfsRoutesCache(self._gtfs_root)
+        caches["trips"] = GtfsTripsCache(self._gtfs_root)
+        return caches
+
+    def _load_caches_in_parallel(self, reduce_memory_usage: bool, workers: int) -> dict:
+        """
+        Parse the GTFS files into caches, using multiple processes. The smaller files are parsed in separate processes,
+        while the stop times are split into parts which are parsed by the other processes.
+        :param reduce_memory_usage: Whether memory usage should be reduced, at the cost of slower queries.
+        :param workers: The number of processes to use.
+        :return: A dict containing all caches.
+        """
+        logging.debug(f"Initializing caches using {workers} processes, this can take a while...")
+        # Feeds are reloaded on a background thread while other threads handle requests. Forking a process with running
+        # threads can deadlock the child on a lock which was held at that moment, so start the processes from scratch.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {
+                "calendar_dates": executor.submit(GtfsCalendarDatesCache, self._gtfs_root),
+                "stops": executor.submit(GtfsStopsCache, self._gtfs_root),
+                "routes": executor.submit(GtfsRoutesCache, self._gtfs_root),
+                "trips": executor.submit(GtfsTripsCache, self._gtfs_root),
+            }
+            caches = dict()
+            caches["stop_times"] = GtfsStopTimesCache(self._gtfs_root, reduce_memory_usage=reduce_memory_usage,
+                                                      executor=executor)
+            for name, future in futures.items():
+                caches[name] = future.result()
+        logging.debug("Initialized caches")
+        return caches
+
+    def get_gtfs_root(self) -> str:
+        """
+        :return: The directory containing the GTFS feed used by this engine.
+        """
+        return self._gtfs_root
 
-    def list_queryable_stops(self):
+    def list_queryable_stops(self, as_json: bool = False):
         """
         Get a list of all stops a user would want to search for (stations only, no quays or entrances)
+        :param as_json: Whether to return the list as a JSON string, assembled from the precomputed stop fragments.
         :return: A list of all stops a user would want to search for.
         """
+        if as_json:
+            return '[' + ', '.join(self._stop_fragments[stop['stop_id']] for stop in self._stops_cache.get_all_stops()
+                                   if stop['location_type'] == '1') + ']'
         return [self._gtfs_stop_to_api_stop(stop) for stop in self._stops_cache.get_all_stops() if
                 stop['location_type'] == '1']
 
+    def find_stops_near(self, lat: float, lon: float, radius: float, limit: int, as_json: bool = False):
+        """
+        Find the stops a user would want to search for (stations only, no quays or entrances) near a location.
+        :param lat: The latitude of the location.
+        :param lon: The longitude of the location.
+        :param radius: The maximum distance between the stops and the location, in meters.
+        :param limit: The maximum number of stops to return.
+        :param as_json: Whether to return the list as a JSON string.
+        :return: A list of stops, sorted by their distance to the location. Every stop contains its distance in meters.
+        """
+        stops = [dict(self._gtfs_stop_to_api_stop(stop), distance=round(distance))
+                 for distance, stop in self._stops_grid_index.find_stops_near(lat, lon, radius, limit)]
+        if as_json:
+            return to_json(stops)
+        return stops
+
     def create_departures_timetable(self,
                                     query_stop_id: str,
-                                    window_start: datetime = datetime.now() - timedelta(minutes=10),
-                                    window_end: datetime = datetime.now() + timedelta(hours=2)) -> object:
+                                    window_start: datetime = None,
+                                    window_end: datetime = None,
+                                    as_json: bool = False) -> object:
         """
         Create a TimeTable with departure information for a given stop.
         :param query_stop_id:  The id of the stop to search for. All quays in this stop will be automatically included.
-        :param window_start: The start date/time of the time window in which to search.
-        :param window_end: The end date/time of the time window in which to search.
+        :param window_start: The start date/time of the time window in which to search. Defaults to 10 minutes ago.
+        :param window_end: The end date/time of the time window in which to search. Defaults to 2 hours from now.
                            Must be within 24h after after window_start.
+        :param as_json: Whether to return the timetable as a JSON string, which is faster than serializing the object.
         :return: An object containing information about the stops for which the timetable was constructed,
                  and the departures in the requested time frame.
         """
+        now = datetime.now()
+        window_start = window_start if window_start is not None else now - timedelta(minutes=10)
+        window_end = window_end if window_end is not None else now + timedelta(hours=2)
         assert window_start < window_end
         assert (window_end - window_start) < timedelta(days=1)  # The max interval is one day
         # Get the queried stop ids (stopplace + platforms)
-        query_stop_ids = self._get_queried_stop_ids(query_stop_id)
-        # Get the stop times at these stops
-        stop_times = self._get_stop_times_for_stops(query_stop_ids)
-        # Only retain stop times in the time window
-        stop_times_in_window = self._filter_stop_times_window(stop_times, window_start, window_end)
-        # Sort the stop times
-        # Only sort when we have filtered out the interesting ones, to prevent wasting time on unnecessary sorting
-        stop_times_in_window.sort(key=lambda item: item['departure_seconds'])
+        with QUERY_STAGE_SECONDS.time("stop_ids"):
+            query_stop_ids = self._get_queried_stop_ids(query_stop_id)
+        # Get the stop times at these stops in the time window, sorted by their departure time
+        with QUERY_STAGE_SECONDS.time("filter"):
+            stop_times_in_window = self._filter_stop_times_window(query_stop_ids, window_start, window_end)
+        DEPARTURES_RETURNED.inc(len(stop_times_in_window))
         # Compile a response based on the stop times and query ids.
-        return self._compile_results(stop_times_in_window, query_stop_ids)
+        with QUERY_STAGE_SECONDS.time("compile"):
+            if as_json:
+                return self._compile_json_results(stop_times_in_window, query_stop_ids)
+            return self._compile_results(stop_times_in_window, query_stop_ids)
+
+    def create_next_departures_timetable(self, query_stop_id: str, limit: int, start: datetime = None,
+                                         as_json: bool = False) -> object:
+        """
+        Create a TimeTable with the next departures from a given stop, however far ahead they are. Departures are read
+        in order of their departure time, and reading stops as soon as enough departures have been found. The amount of
+        work therefore depends on the limit, not on the length of a time window.
+        :param query_stop_id:  The id of the stop to search for. All quays in this stop will be automatically included.
+        :param limit: The number of departures to return.
+        :param start: The date/time from which to search. Defaults to now.
+        :param as_json: Whether to return the timetable as a JSON string, which is faster than serializing the object.
+        :return: An object containing information about the stops for which the timetable was constructed,
+                 and the next departures. Fewer departures are returned when there are no more departures in the next
+                 MAX_NEXT_DEPARTURES_DAYS days.
+        """
+        assert limit > 0
+        start = start if start is not None else datetime.now()
+        # Get the queried stop ids (stopplace + platforms)
+        with QUERY_STAGE_SECONDS.time("stop_ids"):
+            query_stop_ids = self._get_queried_stop_ids(query_stop_id)
+        with QUERY_STAGE_SECONDS.time("next_departures"):
+            next_stop_times = list(islice(self._iterate_stop_times_from(query_stop_ids, start), limit))
+        DEPARTURES_RETURNED.inc(len(next_stop_times))
+        with QUERY_STAGE_SECONDS.time("compile"):
+            if as_json:
+                return self._compile_json_results(next_stop_times, query_stop_ids)
+            return self._compile_results(next_stop_times, query_stop_ids)
+
+    def create_departures_timetables(self,
+                                     query_stop_ids: list,
+                                     window_start: datetime = None,
+                                     window_end: datetime = None,
+                                     as_json: bool = False) -> dict:
+        """
+        Create TimeTables with departure information for multiple stops at once. This is considerably faster than
+        creating the timetables one by one, since the stop times for all stops are looked up in one pass, and trip,
+        route, stop and realtime information is only looked up once for the entire batch.
+        :param query_stop_ids: The ids of the stops to search for. All quays in these stops will be automatically
+                               included.
+        :param window_start: The start date/time of the time window in which to search. Defaults to 10 minutes ago.
+        :param window_end: The end date/time of the time window in which to search. Defaults to 2 hours from now.
+                           Must be within 24h after after window_start.
+        :param as_json: Whether to return the timetables as JSON strings, which is faster than serializing the objects.
+        :return: A dict containing the timetable for every queried stop id. Every timetable is identical to the
+                 result of create_departures_timetable for that stop.
+        """
+        now = datetime.now()
+        window_start = window_start if window_start is not None else now - timedelta(minutes=10)
+        window_end = window_end if window_end is not None else now + timedelta(hours=2)
+        assert window_start < window_end
+        assert (window_end - window_start) < timedelta(days=1)  # The max interval is one day
+        # Multiple queried stops can share the same parent stop, every parent stop is only calculated once
+        with QUERY_STAGE_SECONDS.time("stop_ids"):
+            parent_stop_ids = {query_stop_id: self.get_parent_stop_id(query_stop_id)
+                               for query_stop_id in query_stop_ids}
+            stop_ids_by_parent = {parent_stop_id: self._get_queried_stop_ids(parent_stop_id)
+                                  for parent_stop_id in dict.fromkeys(parent_stop_ids.values())}
+            parent_by_stop_id = {stop_id: parent_stop_id for parent_stop_id, stop_ids in stop_ids_by_parent.items()
+                                 for stop_id in stop_ids}
+        # Get the stop times at all stops in one pass, and distribute them over the parent stops. The stop times are
+        # sorted by departure time, so the stop times of every parent stop remain sorted as well.
+        with QUERY_STAGE_SECONDS.time("filter"):
+            stop_times_in_window = self._filter_stop_times_window(list(parent_by_stop_id), window_start, window_end)
+            stop_times_by_parent = {parent_stop_id: list() for parent_stop_id in stop_ids_by_parent}
+            for stop_time in stop_times_in_window:
+                stop_times_by_parent[parent_by_stop_id[stop_time['stop_id']]].append(stop_time)
+        DEPARTURES_RETURNED.inc(len(stop_times_in_window))
+        # Share the trip, route, stop and realtime information between all timetables in this batch
+        with QUERY_STAGE_SECONDS.time("compile"):
+            lookups = self._create_lookups()
+            compile_results = self._compile_json_results if as_json else self._compile_results
+            timetables = {parent_stop_id: compile_results(stop_times_by_parent[parent_stop_id], stop_ids, lookups)
+                          for parent_stop_id, stop_ids in stop_ids_by_parent.items()}
+        return {query_stop_id: timetables[parent_stop_id] for query_stop_id, parent_stop_id in parent_stop_ids.items()}
+
+    def has_stop(self, stop_id: str) -> bool:
+        """
+        :param stop_id: Parent location or quay id
+        :return: Whether the stop exists in the GTFS feed used by this engine.
+        """
+        return self._stops_cache.has_stop(stop_id)
+
+    def get_parent_stop_id(self, stop_id: str) -> str:
+        """
+        Get the id of the top-level stop for a stop. Departures are always calculated for the top-level stop.
+        :param stop_id: Parent location or quay id
+        :return: The id of the parent location, or the given id if the stop has no parent.
+        """
+        stop = self._stops_cache.get_stop(stop_id)
+        return stop['parent_station'] if stop['parent_station'] else stop['stop_id']
 
     def _get_queried_stop_ids(self, query_id: str) -> list:
         """
@@ -137,152 +446,306 @@ class TimeTableQueryEngine:
         :return:  The ids of the parent location and all quays
         """
         logging.debug("Getting related stops")
-        stop = self._stops_cache.get_stop(query_id)
-        if stop['parent_station']:
-            # Ensure we always search from the top-level stop
-            stop = self._stops_cache.get_stop(stop['parent_station'])
-        return [stop['stop_id']] + \
-               [stop['stop_id'] for stop in self._stops_cache.get_all_quays_in_stop_place(stop['stop_id'])]
-
-    def _get_stop_times_for_stops(self, stop_ids):
-        logging.debug("Getting stop times for stops")
-        # Get a list of all the stop times at the given stop_ids
-        return self._stop_times_cache.get_stop_times_for_stops(stop_ids)
-
-    def _filter_stop_times_window(self, stop_times: list, window_start: datetime, window_end: datetime) -> list:
-        """
-        This method will only retain the stop times in the given time window
-        :param stop_times: The list of stop times to filter.
+        # Ensure we always search from the top-level stop
+        parent_stop_id = self.get_parent_stop_id(query_id)
+        return [parent_stop_id] + \
+               [stop['stop_id'] for stop in self._stops_cache.get_all_quays_in_stop_place(parent_stop_id)]
+
+    def _filter_stop_times_window(self, stop_ids: list, window_start: datetime, window_end: datetime) -> list:
+        """
+        Get the stop times at the given stops which depart in the given time window, on a day on which the trip runs.
+        :param stop_ids: The stops for which the stop times should be retrieved.
         :param window_start: The start of the time window.
         :param window_end: End of the time window
-        :return: The filtered list
+        :return: The stop times in the time window, sorted by their departure time.
         """
         logging.debug("Filtering stop times")
+        service_day_windows = self._get_service_day_windows(window_start, window_end)
+        if self._window_filter is not None:
+            return self._window_filter.get_stop_times_between(stop_ids, service_day_windows, window_start.date())
+        filtered_stop_times = list()
+        for service_date, start_secs, end_secs in service_day_windows:
+            # The number of seconds between midnight on the window start date, and midnight on the service date.
+            # This is used to sort departures from different service days by their actual departure time.
+            service_day_offset = (service_date - window_start.date()).days * 24 * 3600
+            # The trips which run on this service day. This set is only calculated once per day.
+            active_trips = self._active_trips_cache.get_active_trips(service_date)
+            # The stop times cache keeps the stop times per stop sorted by departure time, so only the stop times
+            # in the time window are returned, without going through all stop times at these stops.
+            for stop_time in self._stop_times_cache.get_stop_times_for_stops_between(stop_ids, start_secs, end_secs):
+                # Alright, so the time is valid. Is the trip actually ran on that day?
+                if stop_time['trip_id'] in active_trips:
+                    filtered_stop_times.append((service_day_offset + stop_time['departure_seconds'], stop_time))
+        # The stop times of every service day are already sorted, so sorting them by departure time is cheap.
+        filtered_stop_times.sort(key=lambda item: item[0])
+        return [stop_time for _, stop_time in filtered_stop_times]
+
+    def _iterate_stop_times_from(self, stop_ids: list, start: datetime):
+        """
+        Iterate over the stop times at the given stops which depart at or after a given time, on a day on which the
+        trip runs. This is a k-way merge over service days: every service day is a sorted stream of stop times, and a
+        service day is only added to the merge once the merged stream reaches the start of that day. Departures at the
+        same time are returned in the same order as _filter_stop_times_window returns them.
+        :param stop_ids: The stops for which the stop times should be retrieved.
+        :param start: The time from which to search.
+        :return: An iterator over the stop times, sorted by their departure time.
+        """
+        start_date = start.date()
+        start_secs = int((start - datetime.combine(start_date, datetime.min.time())).total_seconds())
+        # A heap of (departure, day, stop time, iterator) tuples, containing the next stop time of every open service day.
+        # The departure is in seconds since midnight on the start date. There's only one entry per day in the heap, so
+        # the stop times themselves are never compared.
+        heap = list()
+        # Start the day before the start date, needed to include trips that started the day before.
+        next_day = -1
+        while True:
+            # Open every service day that can contain departures before the next departure in the heap. Departure times
+            # are never negative, so service day d has no departures before d * 24h.
+            while next_day <= MAX_NEXT_DEPARTURES_DAYS and (not heap or heap[0][0] >= next_day * 24 * 3600):
+                day_offset = next_day * 24 * 3600
+                stop_times = self._iterate_serviced_stop_times(stop_ids, start_date + timedelta(days=next_day),
+                                                               max(0, start_secs - day_offset))
+                stop_time = next(stop_times, None)
+                if stop_time is not None:
+                    heappush(heap, (day_offset + stop_time['departure_seconds'], next_day, stop_time, stop_times))
+                next_day += 1
+            if not heap:
+                return
+            departure, day, stop_time, stop_times = heap[0]
+            yield stop_time
+            next_stop_time = next(stop_times, None)
+            if next_stop_time is None:
+                heappop(heap)
+            else:
+                heapreplace(heap, (day * 24 * 3600 + next_stop_time['departure_seconds'], day, next_stop_time,
+                                   stop_times))
+
+    def _iterate_serviced_stop_times(self, stop_ids: list, service_date, start_secs: int):
+        """
+        Iterate over the stop times at the given stops which depart at or after a given time on a service day, for the
+        trips which run on that service day.
+        :param stop_ids: The stops for which the stop times should be retrieved.
+        :param service_date: The service day.
+        :param start_secs: The time from which to search, in seconds since midnight on the service day.
+        :return: An iterator over the stop times, sorted by their departure time.
+        """
+        # Check the service of every candidate trip, instead of building the set of all active trips on the service
+        # day. Only a few stop times are read for most service days, and the active trips of the dates used by time
+        # window queries aren't evicted from the active trips cache.
+        is_serviced_by_trip = dict()
+        scanned = 0
+        try:
+            for stop_time in self._stop_times_cache.iterate_stop_times_for_stops_from(stop_ids, start_secs):
+                scanned += 1
+                trip_id = stop_time['trip_id']
+                is_serviced = is_serviced_by_trip.get(trip_id)
+                if is_serviced is None:
+                    is_serviced = is_serviced_by_trip[trip_id] = self._is_trip_serviced(trip_id, service_date)
+                if is_serviced:
+                    yield stop_time
+        finally:
+            # The iteration usually stops early, once enough departures have been found
+            STOP_TIMES_SCANNED.inc(scanned)
+
+    def _is_trip_serviced(self, trip_id: str, service_date) -> bool:
+        """
+        :return: Whether a trip runs on a service day. Trips which aren't listed in trips.txt never run.
+        """
+        try:
+            service_id = self._trips_cache.get_trip(trip_id)['service_id']
+        except KeyError:
+            return False
+        return self._calendar_dates_cache.is_serviced(service_id, service_date)
 
-        # Check if the time window spans across midnight
-        window_crosses_midnight = window_end.date() > window_start.date()
-        # Calculate the seconds from midnight. This way we can do all later comparisons using integers
-        window_start_secs_since_midnight = window_start.time().hour * 3600 \
-                                           + window_start.time().minute * 60 \
-                                           + window_start.time().second
-
-        window_end_secs_since_midnight = window_end.time().hour * 3600 \
-                                         + window_end.time().minute * 60 \
-                                         + window_end.time().second
-
-        # Get the day before the start date, needed to check if a trip that spans multiple days was active on this day.
-        day_before_start = window_start.date() - timedelta(days=1)
+    def _get_service_day_windows(self, window_start: datetime, window_end: datetime) -> list:
+        """
+        Split a time window into time ranges per service day. Departure times in GTFS are relative to the start of the
+        service day, and can be 24:00:00 or later for trips that continue after midnight. A trip which started the day
+        before the window can therefore still depart in the time window, and a window that crosses midnight
+        also contains departures from the next service day.
+        :param window_start: The start of the time window.
+        :param window_end: End of the time window, less than 24h after the start.
+        :return: A list of (service date, start seconds, end seconds) tuples. The start and end are in seconds since
+                 midnight on the service date, the start is inclusive and the end is exclusive.
+        """
+        windows = list()
+        # Start the day before the start date, needed to include trips that started the day before.
+        service_date = window_start.date() - timedelta(days=1)
+        while service_date <= window_end.date():
+            service_day_start = datetime.combine(service_date, datetime.min.time())
+            # Seconds since midnight on the service day. Only whole seconds are compared, like the GTFS times.
+            start_secs = max(0, int((window_start - service_day_start).total_seconds()))
+            end_secs = int((window_end - service_day_start).total_seconds())
+            windows.append((service_date, start_secs, end_secs))
+            service_date += timedelta(days=1)
+        return windows
+
+    def get_cache_sizes(self) -> dict:
+        """
+        Get the number of items in every cache.
+        :return: A dict mapping cache names to the number of items, or None if the number is unknown.
+        """
+        return {
+            "stops": self._stops_cache.get_stop_count(),
+            "stops_grid_index": self._stops_grid_index.get_stop_count(),
+            "routes": self._routes_cache.get_route_count(),
+            "trips": self._trips_cache.get_trip_count(),
+            "stop_times": self._stop_times_cache.get_stop_time_count(),
+        }
 
-        filtered_stop_times = list()
-        for stop_time in stop_times:
-            # We already calculated the seconds from midnight in the StopTimesCache.
-            secs_since_midnight = stop_time['departure_seconds']
-            # The first, easy, check is to see if the time lies between the start and end time.
-            # If this fails, we can skip all other checks
-            if not self._is_time_in_window(secs_since_midnight,
-                                           window_start_secs_since_midnight,
-                                           window_end_secs_since_midnight):
-                continue
-
-            # Alright, so the time is valid. Is the trip actually ran on that day? Get the service id so we can check
-            trip = self._trips_cache.get_trip(stop_time['trip_id'])
-            service_id = trip['service_id']
-
-            # Get the hour part from the time. If it is more than 23, it is a trip that started the day before.
-            hour_int = secs_since_midnight // 3600
-
-            # This is a trip that started the same day
-            if hour_int < 24:
-                # If the window doesn't cross midnight, the departure date is the same as the date of the window start.
-                # Check if the service_id is active that day
-                if not window_crosses_midnight \
-                        and self._calendar_dates_cache.is_serviced(service_id, window_start.date()):
-                    filtered_stop_times.append(stop_time)
-                # If it crosses midnight, we need to determine the departure date first
-                elif window_crosses_midnight:
-                    # We have constrained the time window to no more than 24h. This means that, if the time window
-                    # crosses midnight, the end time will lie before the start time. This simplifies the following tests
-                    if secs_since_midnight >= window_start_secs_since_midnight:
-                        if self._calendar_dates_cache.is_serviced(service_id, window_start.date()):
-                            filtered_stop_times.append(stop_time)
-                    else:
-                        if self._calendar_dates_cache.is_serviced(service_id, window_start.date()):
-                            filtered_stop_times.append(stop_time)
-            # This is a trip that started the day before (it's past midnight),
-            # check if it was active on the day it started
-            elif hour_int >= 24:
-                if not window_crosses_midnight and self._calendar_dates_cache.is_serviced(service_id,
-                                                                                          day_before_start):
-                    filtered_stop_times.append(stop_time)
-                # Alright, so the window crosses midnight and this trip started the day before.
-                # Since this trip planner is restricted to 1-day intervals, we know the day before is start date
-                elif window_crosses_midnight:
-                    # We have constrained the time window to no more than 24h. This means that, if the time window
-                    # crosses midnight, the end time will lie before the start time. This simplifies the following tests
-                    # First day. Comparison corrects for the 24h offset since the hour part is larger than 24h
-                    if secs_since_midnight - 86400 >= window_start_secs_since_midnight:
-                        if self._calendar_dates_cache.is_serviced(service_id, day_before_start):
-                            filtered_stop_times.append(stop_time)
-                    # Second day
-                    else:
-                        if self._calendar_dates_cache.is_serviced(service_id, window_start.date()):
-                            filtered_stop_times.append(stop_time)
-        return filtered_stop_times
-
-    def _is_time_in_window(self,
-                           seconds_since_midnight: int,
-                           window_start_since_midnight: int,
-                           window_end_since_midnight: int
-                           ) -> bool:
-        """
-        Check if a time (in seconds from midnight) lies in a window. window_end can lie before window_start if
-        window_end is on the next day. This only works with the 24h constraint on the time window.
-        :param seconds_since_midnight: Time to check in seconds from midnight
-        :param window_start_since_midnight: Start of the window
-        :param window_end_since_midnight:  End of the window, less than 24h after the start. Can be smaller than
-                                           window_start_since_midnight if it is a time during the next day.
-        :return: True if the timestamp lies in the window.
-        """
-        return window_start_since_midnight <= seconds_since_midnight < window_end_since_midnight \
-               or (window_start_since_midnight > window_end_since_midnight > seconds_since_midnight >= 0) \
-               or (window_end_since_midnight < window_start_since_midnight <= seconds_since_midnight < 24 * 3600)
-
-    def _compile_results(self, stop_times: list, searched_stop_ids: list) -> object:
+    def _compile_results(self, stop_times: list, searched_stop_ids: list, lookups: dict = None) -> object:
         """
         Inflate a list of stop times (which are already filtered on location and time) to an API response.
         :param stop_times:  The stop times to include in the API response.
         :param searched_stop_ids:  The stop ids for which departures were calculated.
+        :param lookups: The lookups created by _create_lookups, which can be shared between multiple responses.
+                        New lookups are created when omitted.
         :return: The API response
         """
         logging.debug("Compiling results")
+        if lookups is None:
+            lookups = self._create_lookups()
+        trip_info_by_id = lookups["trips"]
+        delays = lookups["delays"]
         entries = list()
         for stop_time in stop_times:
-            # Get additional information for each stop
-            trip = self._trips_cache.get_trip(stop_time['trip_id'])
-            route = self._routes_cache.get_route(trip['route_id'])
-            stop = self._gtfs_stop_id_to_api_stop(stop_time['stop_id'])
-            # Get realtime information
-            delay = self._realtime_fetcher.get_delay_for_trip_stop(trip['trip_id'], stop_time['stop_sequence'])
-            position = self._realtime_fetcher.get_position_for_trip(trip['trip_id'])
-            occupancy = self._realtime_fetcher.get_occupancy_for_trip(trip['trip_id'])
+            trip_id = stop_time['trip_id']
+            # Get additional information for each trip. Most trips depart multiple times in a batch, so the trip, route
+            # and realtime vehicle information is only looked up once per trip.
+            trip_info = trip_info_by_id.get(trip_id)
+            if trip_info is None:
+                trip = self._trips_cache.get_trip(trip_id)
+                route = self._routes_cache.get_route(trip['route_id'])
+                trip_info = trip_info_by_id[trip_id] = (ROUTE_TYPE_NAMES[int(route['route_type'])],
+                                                        route['route_long_name'],
+                                                        route['route_short_name'],
+                                                        self._realtime_fetcher.get_position_for_trip(trip_id),
+                                                        self._realtime_fetcher.get_occupancy_for_trip(trip_id))
+            route_type, route_long, route_short, position, occupancy = trip_info
+            stop = self._get_api_stop(stop_time['stop_id'], lookups)
+            # The delay can be different for every stop of the trip
+            delay = self._realtime_fetcher.get_delay_for_trip_stop(trip_id, stop_time['stop_sequence'], delays)
+            departure_time = stop_time['departure_time']
+            if delay:
+                # The departure time has already been parsed, there's no need to parse the time string again
+                realtime_departure_time = GtfsStopTimesCache.get_time_string(stop_time['departure_seconds'] + delay)
+            else:
+                realtime_departure_time = departure_time
 
             entries.append({
                 "direction": stop_time['stop_headsign'],
-                "scheduled_departure_time": stop_time['departure_time'],
-                "realtime_departure_time": self._add_seconds(stop_time['departure_time'], delay),
+                "scheduled_departure_time": departure_time,
+                "realtime_departure_time": realtime_departure_time,
                 "stop": stop,
-                "type": ROUTE_TYPE_NAMES[int(route['route_type'])],
-                "route_long": route['route_long_name'],
-                "route_short": route['route_short_name'],
+                "type": route_type,
+                "route_long": route_long,
+                "route_short": route_short,
                 "delay": delay,
                 "position": position,
                 "occupancy": occupancy
             })
 
         # Wrap departures and stops in one object
-        return {"stops": [self._gtfs_stop_id_to_api_stop(stop_id) for stop_id in searched_stop_ids],
+        return {"stops": [self._get_api_stop(stop_id, lookups) for stop_id in searched_stop_ids],
                 "departures": entries}
 
+    def _compile_json_results(self, stop_times: list, searched_stop_ids: list, lookups: dict = None) -> str:
+        """
+        Inflate a list of stop times (which are already filtered on location and time) to a serialized API response.
+        The response is assembled from the precomputed stop and route fragments and the serialized realtime data of
+        every trip, so only the fields which differ per departure are serialized. Without orjson, the result is
+        identical to serializing the result of _compile_results with json.dumps.
+        :param stop_times:  The stop times to include in the API response.
+        :param searched_stop_ids:  The stop ids for which departures were calculated.
+        :param lookups: The lookups created by _create_lookups, which can be shared between multiple responses.
+                        New lookups are created when omitted.
+        :return: The API response as a JSON string
+        """
+        logging.debug("Compiling results")
+        if lookups is None:
+            lookups = self._create_lookups()
+        trip_fragments = lookups["trip_fragments"]
+        delays = lookups["delays"]
+        strings = lookups["strings"]
+        entries = list()
+        for stop_time in stop_times:
+            trip_id = stop_time['trip_id']
+            trip_fragment = trip_fragments.get(trip_id)
+            if trip_fragment is None:
+                # Route information and the realtime vehicle information are the same for every departure of a trip
+                trip = self._trips_cache.get_trip(trip_id)
+                trip_fragment = trip_fragments[trip_id] = (
+                    self._get_route_fragment(trip['route_id']),
+                    ', "position": ' + to_json(self._realtime_fetcher.get_position_for_trip(trip_id)) +
+                    ', "occupancy": ' + to_json(self._realtime_fetcher.get_occupancy_for_trip(trip_id)) + '}')
+            route_fragment, vehicle_fragment = trip_fragment
+            # The delay can be different for every stop of the trip
+            delay = self._realtime_fetcher.get_delay_for_trip_stop(trip_id, stop_time['stop_sequence'], delays)
+            departure_time = stop_time['departure_time']
+            if delay:
+                realtime_departure_time = GtfsStopTimesCache.get_time_string(stop_time['departure_seconds'] + delay)
+            else:
+                realtime_departure_time = departure_time
+            headsign = stop_time['stop_headsign']
+            headsign_json = strings.get(headsign)
+            if headsign_json is None:
+                headsign_json = strings[headsign] = to_json(headsign)
+
+            entries.append('{"direction": ' + headsign_json +
+                           ', "scheduled_departure_time": "' + departure_time +
+                           '", "realtime_departure_time": "' + realtime_departure_time +
+                           '", "stop": ' + self._get_stop_fragment(stop_time['stop_id']) +
+                           ', ' + route_fragment +
+                           ', "delay": ' + str(delay) +
+                           vehicle_fragment)
+
+        # Wrap departures and stops in one object
+        return '{"stops": [' + ', '.join(self._get_stop_fragment(stop_id) for stop_id in searched_stop_ids) + \
+               '], "departures": [' + ', '.join(entries) + ']}'
+
+    def _get_stop_fragment(self, stop_id: str) -> str:
+        fragment = self._stop_fragments.get(stop_id)
+        if fragment is None:
+            # Raises a KeyError for unknown stops, just like _gtfs_stop_id_to_api_stop
+            fragment = to_json(self._gtfs_stop_id_to_api_stop(stop_id))
+        return fragment
+
+    def _get_route_fragment(self, route_id: str) -> str:
+        fragment = self._route_fragments.get(route_id)
+        if fragment is None:
+            # Routes with an unknown type aren't precomputed, this raises a KeyError just like _compile_results
+            fragment = self._create_route_fragment(self._routes_cache.get_route(route_id))
+        return fragment
+
+    @staticmethod
+    def _create_route_fragment(route) -> str:
+        """
+        Serialize the route fields of a departure.
+        :param route: The GTFS route.
+        :return: The type, route_long and route_short fields of a departure, as a partial JSON object.
+        """
+        return '"type": ' + to_json(ROUTE_TYPE_NAMES[int(route['route_type'])]) + \
+               ', "route_long": ' + to_json(route['route_long_name']) + \
+               ', "route_short": ' + to_json(route['route_short_name'])
+
+    def _create_lookups(self) -> dict:
+        """
+        Create empty lookups for _compile_results and _compile_json_results. Information about trips and stops is
+        stored in these lookups once it has been looked up, so it can be reused for the other departures in the same
+        request. The realtime delays are obtained once, so all departures in a request use the same realtime data.
+        :return: A dict containing dicts for trip information, API stops, serialized trip information and serialized
+                 strings, and the realtime delays.
+        """
+        return {"trips": dict(), "stops": dict(), "trip_fragments": dict(), "strings": dict(),
+                "delays": self._realtime_fetcher.get_delays()}
+
+    def _get_api_stop(self, stop_id, lookups: dict):
+        stops = lookups["stops"]
+        stop = stops.get(stop_id)
+        if stop is None:
+            stop = stops[stop_id] = self._gtfs_stop_id_to_api_stop(stop_id)
+        return stop
+
     def _gtfs_stop_id_to_api_stop(self, stop_id):
         # This is just a helper metod to wrap the get_stop method call
         return self._gtfs_stop_to_api_stop(self._stops_cache.get_stop(stop_id))
@@ -301,24 +764,6 @@ class TimeTableQueryEngine:
             "longitude": stop["stop_lon"],
         }
 
-    def _add_seconds(self, time: str, seconds: int) -> str:
-        """
-        Add seconds to a time string
-        :param time: A time in hh:mm:ss
-        :param seconds: Seconds to add (or subtract) to the given time
-        :return: The time with seconds added in hh:mm:ss format
-        """
-        if seconds == 0:
-            return time
-        time_seconds = self.get_seconds_since_midnight(time)
-        if time_seconds < 0:
-            time_seconds += 24 * 3600  # + 1 day in case the delay was negative and we got below zero
-        time_seconds += seconds
-        # Seconds to hh:mm:ss
-        m, s = divmod(time_seconds, 60)  # Get quotient and modulo in one operation
-        h, m = divmod(m, 60)
-        return f'{h:02d}:{m:02d}:{s:02d}'
-
     def get_seconds_since_midnight(self, time_str: str) -> int:
         """Get Seconds from time, for faster calculations later on."""
         h, m, s = time_str.split(':')
@@ -0,0 +1,207 @@
+"""
+Lightweight metrics which can be exported in the Prometheus text format.
+
+Metrics are disabled by default. While they are disabled, recording a value returns immediately, so instrumented code
+costs close to nothing when nobody scrapes the metrics. Call Metrics.enable() to start recording.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+# The default histogram buckets, in seconds. These cover everything from a cached lookup to loading a large feed.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Metrics:
+    """
+    The registry containing all metrics. Metrics register themselves when they are created.
+    """
+    _enabled = False
+    _metrics = list()
+
+    @staticmethod
+    def enable():
+        """
+        Start recording metrics.
+        """
+        Metrics._enabled = True
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """
+        :return: Whether metrics are being recorded. Check this before calculating values which are only needed for
+                 metrics.
+        """
+        return Metrics._enabled
+
+    @staticmethod
+    def register(metric):
+        Metrics._metrics.append(metric)
+
+    @staticmethod
+    def render() -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+        :return: The metrics, as text.
+        """
+        lines = list()
+        for metric in Metrics._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        """
+        :param name: The name of the metric.
+        :param documentation: A description of the metric.
+        :param label_names: The names of the labels of this metric. Values are recorded separately per combination of
+                            label values.
+        """
+        self.name = name
+        self.documentation = documentation
+        self._label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        Metrics.register(self)
+
+    def _format_labels(self, label_values, extra_labels=()) -> str:
+        labels = list(zip(self._label_names, label_values)) + list(extra_labels)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{name}="{self._escape(value)}"' for name, value in labels) + "}"
+
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def render(self) -> list:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    """
+    A value which only increases, such as the number of handled requests.
+    """
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._values = dict()
+
+    def inc(self, amount=1, *label_values):
+        """
+        Increase the counter.
+        :param amount: The amount to increase the counter by.
+        :param label_values: The values of the labels of this metric, in the same order as the label names.
+        """
+        if not Metrics._enabled:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{self._format_labels(label_values)} {value}" for label_values, value in values]
+
+
+class Gauge(Metric):
+    """
+    A value which is read when the metrics are rendered, such as the age of the realtime data. Since the value is only
+    calculated when the metrics are scraped, a gauge costs nothing at all in between.
+    """
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str, function, label_names=()):
+        """
+        :param name: The name of the metric.
+        :param documentation: A description of the metric.
+        :param function: A function returning the current value. If the metric has labels, it should return a dict
+                         mapping tuples of label values to values. None values are left out.
+        :param label_names: The names of the labels of this metric.
+        """
+        super().__init__(name, documentation, label_names)
+        self._function = function
+
+    def render(self) -> list:
+        values = self._function()
+        if not self._label_names:
+            values = {(): values}
+        return [f"{self.name}{self._format_labels(label_values)} {value}" for label_values, value in values.items()
+                if value is not None]
+
+
+class Histogram(Metric):
+    """
+    A distribution of values, such as the duration of a query, counted in buckets.
+    """
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self._buckets = tuple(buckets)
+        # Maps label values to a [bucket counts, sum, count] list
+        self._values = dict()
+
+    def observe(self, value, *label_values):
+        """
+        Record a value.
+        :param value: The value to record.
+        :param label_values: The values of the labels of this metric, in the same order as the label names.
+        """
+        if not Metrics._enabled:
+            return
+        bucket = bisect_left(self._buckets, value)
+        with self._lock:
+            values = self._values.get(label_values)
+            if values is None:
+                # One count per bucket, plus one for values larger than the largest bucket
+                values = self._values[label_values] = [[0] * (len(self._buckets) + 1), 0, 0]
+            values[0][bucket] += 1
+            values[1] += value
+            values[2] += 1
+
+    def time(self, *label_values):
+        """
+        Measure the duration of a block of code, for example `with histogram.time("stage"):`.
+        :param label_values: The values of the labels of this metric, in the same order as the label names.
+        :return: A context manager which records the duration of the block in seconds.
+        """
+        return _Timer(self, label_values)
+
+    def render(self) -> list:
+        with self._lock:
+            values = [(label_values, list(buckets), total, count)
+                      for label_values, (buckets, total, count) in self._values.items()]
+        lines = list()
+        for label_values, buckets, total, count in values:
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(self._buckets + ("+Inf",), buckets):
+                cumulative_count += bucket_count
+                labels = self._format_labels(label_values, [("le", upper_bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative_count}")
+            lines.append(f"{self.name}_sum{self._format_labels(label_values)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(label_values)} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_label_values', '_start')
+
+    def __init__(self, histogram, label_values):
+        self._histogram = histogram
+        self._label_values = label_values
+        self._start = None
+
+    def __enter__(self):
+        if Metrics._enabled:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._start is not None:
+            self._histogram.observe(time.perf_counter() - self._start, *self._label_values)
@@ -1,8 +1,16 @@
+import asyncio
+import logging
+import math
+import threading
 import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from google.transit import gtfs_realtime_pb2
 
+from Metrics import Counter, Histogram
+
 # This map describes the GTFS Occupancy enum, and is used to convert numeric values to their string representation.
 OCCUPANCY_STATUS_MAP = ["EMPTY",
                         "MANY_SEATS_AVAILABLE",
@@ -12,11 +20,37 @@ OCCUPANCY_STATUS_MAP = ["EMPTY",
                         "FULL",
                         "NOT_ACCEPTING_PASSENGERS"]
 
+# The schedule relationship of a stop time update for which no realtime information is available
+NO_DATA = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.NO_DATA
+
+DOWNLOAD_SECONDS = Histogram("realtime_download_seconds", "The time needed to download a realtime feed", ["feed"])
+PARSE_SECONDS = Histogram("realtime_parse_seconds", "The time needed to parse and index a realtime feed", ["feed"])
+NOT_MODIFIED = Counter("realtime_not_modified_total",
+                       "The number of downloads which were skipped because the realtime feed wasn't modified", ["feed"])
+REFRESH_ERRORS = Counter("realtime_refresh_errors_total", "The number of failed realtime feed refreshes", ["feed"])
+
+# The maximum age of the data, in seconds, before it is refreshed.
+TRIP_UPDATES_MAX_AGE = 60
+VEHICLE_POSITIONS_MAX_AGE = 15
+FEED_MAX_AGES = {"trip_updates": TRIP_UPDATES_MAX_AGE, "vehicle_positions": VEHICLE_POSITIONS_MAX_AGE}
+# The maximum time, in seconds, to wait for a realtime feed to respond.
+REQUEST_TIMEOUT = 30
+# The maximum time, in seconds, to wait before retrying a feed which failed to refresh. After a failure, a feed is
+# retried after its maximum age. This time doubles after every consecutive failure, up to this limit.
+MAX_RETRY_DELAY = 600
+
 
 class RealtimeDataFetcher:
     """
     This class fetches TripUpdates.pb and VehicleUpdates.pb files, and converts them into dictionaries. Data is cached
-    and refreshed when needed.
+    and refreshed when needed. By default, data is refreshed on demand when it is requested after it expired.
+    When background refreshing is started, data is refreshed periodically on a separate thread instead. New data is
+    prepared in new dictionaries, which then replace the old ones in a single assignment. Readers therefore never
+    need to wait for a download, and always see a complete set of data.
+
+    Feeds which need to be refreshed are downloaded concurrently. Every feed is downloaded through its own session, so
+    connections are kept alive and reused. Feeds are downloaded using conditional requests, a feed which hasn't been
+    modified since the previous download is not downloaded and parsed again.
     """
     def __init__(self, tripupdates_url, vehicle_positions_url):
         self._tripupdates_url = tripupdates_url
@@ -26,15 +60,147 @@ class RealtimeDataFetcher:
         self._positions = dict()
         self._occupancies = dict()
         self._positions_last_updated = None
+        # These numbers are increased every time new data is loaded, so users of the data can detect changes
+        self._delays_version = 0
+        self._positions_version = 0
+        self._background_refresh_stopped = None
+        # Use one session per feed, so connections are kept alive and reused between refreshes
+        self._sessions = {url: requests.Session() for url in [tripupdates_url, vehicle_positions_url]}
+        # The headers needed to make a conditional request for a feed, based on the response of the last download
+        self._conditional_request_headers = dict()
+        # Downloading and parsing feeds is done on these threads, so multiple feeds can be refreshed concurrently
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="realtime-refresh")
+        # The number of consecutive failed refreshes and the time of the next attempt, for every feed which failed
+        self._failed_refreshes = dict()
+        self._retry_at = dict()
+
+    def start_background_refresh(self):
+        """
+        Refresh the data periodically on a background thread, instead of on demand while handling a request.
+        """
+        if self._background_refresh_stopped is not None:
+            return
+        self._background_refresh_stopped = threading.Event()
+        thread = threading.Thread(target=asyncio.run,
+                                  args=(self._refresh_periodically(self._background_refresh_stopped),),
+                                  name="realtime-background-refresh", daemon=True)
+        thread.start()
+        logging.info("Started refreshing realtime data in the background")
+
+    def stop_background_refresh(self):
+        """
+        Stop refreshing the data in the background. Data will be refreshed on demand again.
+        """
+        if self._background_refresh_stopped is None:
+            return
+        self._background_refresh_stopped.set()
+        self._background_refresh_stopped = None
+
+    def refresh(self):
+        """
+        Refresh all outdated feeds concurrently, and wait until they are refreshed.
+        """
+        asyncio.run(self.refresh_async(
+            delays=self._is_outdated(self._delays_last_updated, TRIP_UPDATES_MAX_AGE),
+            positions=self._is_outdated(self._positions_last_updated, VEHICLE_POSITIONS_MAX_AGE)))
+
+    async def refresh_async(self, delays=True, positions=True):
+        """
+        Refresh the given feeds concurrently.
+        :param delays: Whether the TripUpdates feed should be refreshed.
+        :param positions: Whether the VehiclePositions feed should be refreshed.
+        """
+        loop = asyncio.get_running_loop()
+        refresh_methods = dict()
+        if delays:
+            refresh_methods["trip_updates"] = self._refresh_delays
+        if positions:
+            refresh_methods["vehicle_positions"] = self._refresh_vehicle_position_data
+        results = await asyncio.gather(*[loop.run_in_executor(self._executor, refresh_method)
+                                         for refresh_method in refresh_methods.values()], return_exceptions=True)
+        errors = list()
+        for feed, result in zip(refresh_methods, results):
+            if isinstance(result, Exception):
+                REFRESH_ERRORS.inc(1, feed)
+                errors.append(result)
+                self._failed_refreshes[feed] = self._failed_refreshes.get(feed, 0) + 1
+                retry_delay = min(FEED_MAX_AGES[feed] * 2 ** (self._failed_refreshes[feed] - 1), MAX_RETRY_DELAY)
+                self._retry_at[feed] = time.time() + retry_delay
+            else:
+                self._failed_refreshes.pop(feed, None)
+                self._retry_at.pop(feed, None)
+        if errors:
+            # A failure of one feed doesn't prevent the other feeds from being refreshed
+            raise errors[0]
+
+    async def _refresh_periodically(self, stopped):
+        loop = asyncio.get_running_loop()
+        while not stopped.is_set():
+            try:
+                await self.refresh_async(
+                    delays=self._get_seconds_until_refresh("trip_updates", self._delays_last_updated) == 0,
+                    positions=self._get_seconds_until_refresh("vehicle_positions", self._positions_last_updated) == 0)
+            except Exception:
+                # Keep serving the previous data, and try again once the feed which failed is due for a retry
+                logging.exception("Failed to refresh realtime data")
+            # Wait until the first feed needs to be refreshed again, or until background refreshing is stopped.
+            # Every feed was just refreshed or scheduled for a retry, but always wait a little to never busy-loop.
+            next_refresh = max(1, min(self._get_seconds_until_refresh("trip_updates", self._delays_last_updated),
+                                      self._get_seconds_until_refresh("vehicle_positions",
+                                                                      self._positions_last_updated)))
+            await loop.run_in_executor(None, stopped.wait, next_refresh)
+
+    def _get_seconds_until_refresh(self, feed, last_updated):
+        """
+        Get the time until a feed should be refreshed in the background.
+        :param feed: The name of the feed, trip_updates or vehicle_positions.
+        :param last_updated: The time at which the feed was last updated, or None if it was never updated.
+        :return: The number of seconds until the feed should be refreshed, or 0 if it should be refreshed now.
+        """
+        retry_at = self._retry_at.get(feed)
+        if retry_at is not None:
+            # The last refresh failed, wait until the retry delay has passed
+            return max(0, math.ceil(retry_at - time.time()))
+        return self._get_seconds_until_outdated(last_updated, FEED_MAX_AGES[feed])
+
+    def get_delays_age(self):
+        """
+        Get the age of the current TripUpdates data.
+        :return: The number of seconds since the data was fetched, or None if the data was never fetched.
+        """
+        if self._delays_last_updated is None:
+            return None
+        return int(time.time()) - self._delays_last_updated
+
+    def get_positions_age(self):
+        """
+        Get the age of the current VehiclePositions data.
+        :return: The number of seconds since the data was fetched, or None if the data was never fetched.
+        """
+        if self._positions_last_updated is None:
+            return None
+        return int(time.time()) - self._positions_last_updated
+
+    def get_versions(self):
+        """
+        Get the version of the current data. The version changes every time new data is loaded.
+        Outdated data is refreshed first, unless data is refreshed in the background.
+        :return: a tuple containing the TripUpdates version and the VehiclePositions version.
+        """
+        if self._are_delays_outdated() or self._are_positions_outdated():
+            self.refresh()
+        return self._delays_version, self._positions_version
 
     def get_delays(self):
         """
         Get the data. Cached data if it was fetched recently,
         or a fresh copy if the stored data is expired.
-        :return: a dict mapping (trip id, stop sequence) tuples to the delay for that departure.
+        :return: a dict mapping trip ids to a (stop sequences, delays) tuple. The stop sequences are sorted, and every
+                 delay is the delay from that stop onwards, or None if the delay is unknown from that stop onwards.
         """
         if self._are_delays_outdated():
-            self._refresh_delays()
+            # Refresh all outdated feeds at once, so they are downloaded concurrently
+            self.refresh()
         return self._delays
 
     def get_positions(self):
@@ -44,7 +210,8 @@ class RealtimeDataFetcher:
         :return: a dict mapping trip_ids to vehicle positions.
         """
         if self._are_positions_outdated():
-            self._refresh_vehicle_position_data()
+            # Refresh all outdated feeds at once, so they are downloaded concurrently
+            self.refresh()
         return self._positions
 
     def get_occupancies(self):
@@ -55,66 +222,148 @@ class RealtimeDataFetcher:
         """
         if self._are_positions_outdated():
             # Occupancies are obtained from vehiclepositions.txt
-            self._refresh_vehicle_position_data()
+            self.refresh()
         return self._occupancies
 
     def _are_delays_outdated(self):
-        now = int(time.time())
-        # Data never fetched or data older than x seconds
-        return self._delays_last_updated is None or now - self._delays_last_updated > 60
+        if self._background_refresh_stopped is not None:
+            # The data is refreshed in the background, never make the caller wait for it
+            return False
+        return self._is_outdated(self._delays_last_updated, TRIP_UPDATES_MAX_AGE)
 
     def _are_positions_outdated(self):
+        if self._background_refresh_stopped is not None:
+            # The data is refreshed in the background, never make the caller wait for it
+            return False
+        return self._is_outdated(self._positions_last_updated, VEHICLE_POSITIONS_MAX_AGE)
+
+    @staticmethod
+    def _is_outdated(last_updated, max_age):
         now = int(time.time())
         # Data never fetched or data older than x seconds
-        return self._positions_last_updated is None or now - self._positions_last_updated > 15
+        return last_updated is None or now - last_updated > max_age
+
+    @staticmethod
+    def _get_seconds_until_outdated(last_updated, max_age):
+        if last_updated is None:
+            return 0
+        return max(0, last_updated + max_age + 1 - int(time.time()))
+
+    def _download(self, url):
+        """
+        Download a feed, using a conditional request if the feed has been downloaded before.
+        :param url: The url of the feed.
+        :return: The contents of the feed, or None if the feed wasn't modified since the previous download.
+        """
+        response = self._sessions[url].get(url, headers=self._conditional_request_headers.get(url, {}),
+                                           timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        conditional_request_headers = dict()
+        if 'ETag' in response.headers:
+            conditional_request_headers['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            conditional_request_headers['If-Modified-Since'] = response.headers['Last-Modified']
+        self._conditional_request_headers[url] = conditional_request_headers
+        return response.content
 
     def _refresh_delays(self):
-        delays = dict()
-        feed = gtfs_realtime_pb2.FeedMessage()
-        response = requests.get(self._tripupdates_url).content
-        feed.ParseFromString(response)
-        for entity in feed.entity:
-            if entity.HasField('trip_update'):
-                # Handle
-                trip_id = entity.trip_update.trip.trip_id
-                for update in entity.trip_update.stop_time_update:
-                    stop_sequence = update.stop_sequence  # ambiguous, need stop_sequence!
-                    if not update.HasField('departure'):
-                        continue
-                    delay = update.departure.delay
-                    delays[(trip_id, stop_sequence)] = delay
+        with DOWNLOAD_SECONDS.time("trip_updates"):
+            response = self._download(self._tripupdates_url)
+        if response is None:
+            # The feed hasn't changed, the current data is still up-to-date
+            NOT_MODIFIED.inc(1, "trip_updates")
+            self._delays_last_updated = int(time.time())
+            return
+        with PARSE_SECONDS.time("trip_updates"):
+            delays = dict()
+            feed = gtfs_realtime_pb2.FeedMessage()
+            feed.ParseFromString(response)
+            for entity in feed.entity:
+                if entity.HasField('trip_update'):
+                    # Handle
+                    trip_id = entity.trip_update.trip.trip_id
+                    trip_delays = list()
+                    for update in entity.trip_update.stop_time_update:
+                        if not update.HasField('stop_sequence'):
+                            # Updates are matched to departures by their stop sequence, a stop id alone is ambiguous
+                            continue
+                        if update.schedule_relationship == NO_DATA:
+                            # The delay is unknown from this stop onwards, the previous delay shouldn't be propagated
+                            delay = None
+                        elif update.HasField('departure') and update.departure.HasField('delay'):
+                            delay = update.departure.delay
+                        elif update.HasField('arrival') and update.arrival.HasField('delay'):
+                            # Vehicles are assumed to depart as soon as they arrive
+                            delay = update.arrival.delay
+                        else:
+                            # For example skipped stops, the previous delay is propagated past these stops
+                            continue
+                        trip_delays.append((update.stop_sequence, delay))
+                    if trip_delays:
+                        # Sort the updates once, so the delay for any stop can be found using a binary search
+                        trip_delays.sort(key=lambda trip_delay: trip_delay[0])
+                        delays[trip_id] = (tuple(stop_sequence for stop_sequence, _ in trip_delays),
+                                           tuple(delay for _, delay in trip_delays))
+        # Replace the data in a single assignment, so readers either see the old or the new data
         self._delays = delays
+        self._delays_version += 1
         self._delays_last_updated = int(time.time())
 
     def _refresh_vehicle_position_data(self):
-        positions = dict()
-        occupancies = dict()
-        feed = gtfs_realtime_pb2.FeedMessage()
-        response = requests.get(self._positions_url).content
-        feed.ParseFromString(response)
-        for entity in feed.entity:
-            if entity.HasField('vehicle'):
-                # Handle
-                position = entity.vehicle.position
-                trip_id = entity.vehicle.trip.trip_id
-                positions[trip_id] = {
-                    "latitude": position.latitude,
-                    "longitude": position.longitude,
-                    "bearing": position.bearing,
-                    "speed": position.speed * 3.6,  # m/s to kph
-                }
-                occupancies[trip_id] = entity.vehicle.occupancy_status
+        with DOWNLOAD_SECONDS.time("vehicle_positions"):
+            response = self._download(self._positions_url)
+        if response is None:
+            # The feed hasn't changed, the current data is still up-to-date
+            NOT_MODIFIED.inc(1, "vehicle_positions")
+            self._positions_last_updated = int(time.time())
+            return
+        with PARSE_SECONDS.time("vehicle_positions"):
+            positions = dict()
+            occupancies = dict()
+            feed = gtfs_realtime_pb2.FeedMessage()
+            feed.ParseFromString(response)
+            for entity in feed.entity:
+                if entity.HasField('vehicle'):
+                    # Handle
+                    position = entity.vehicle.position
+                    trip_id = entity.vehicle.trip.trip_id
+                    positions[trip_id] = {
+                        "latitude": position.latitude,
+                        "longitude": position.longitude,
+                        "bearing": position.bearing,
+                        "speed": position.speed * 3.6,  # m/s to kph
+                    }
+                    occupancies[trip_id] = entity.vehicle.occupancy_status
+        # Replace the data in single assignments, so readers either see the old or the new data
         self._occupancies = occupancies
         self._positions = positions
+        self._positions_version += 1
         self._positions_last_updated = int(time.time())
 
-    def get_delay_for_trip_stop(self, trip_id, stop_sequence):
-        data = self.get_delays()
-        # Convert to int to match the data type from protobuf
-        stop_sequence = int(stop_sequence)
-        if (trip_id, stop_sequence) not in data:
+    def get_delay_for_trip_stop(self, trip_id, stop_sequence, delays=None):
+        """
+        Get the delay of a trip at a stop. Following the GTFS-RT specification, the delay of an updated stop is
+        propagated to the following stops of the trip, until the next updated stop.
+        :param trip_id: The id of the trip.
+        :param stop_sequence: The stop sequence of the stop in the trip, as an int.
+        :param delays: The delays, as returned by get_delays. Pass these when getting the delays for many stops, so the
+                       data is only checked for freshness once, and all delays come from the same version of the data.
+        :return: The delay in seconds, or 0 if the delay is unknown.
+        """
+        if delays is None:
+            delays = self.get_delays()
+        trip_delays = delays.get(trip_id)
+        if trip_delays is None:
+            return 0
+        stop_sequences, stop_delays = trip_delays
+        # The last updated stop at or before this stop
+        index = bisect_right(stop_sequences, stop_sequence) - 1
+        if index < 0 or stop_delays[index] is None:
+            # The trip has no delay before the first updated stop
             return 0
-        return data[(trip_id, stop_sequence)]
+        return stop_delays[index]
 
     def get_position_for_trip(self, trip_id):
         data = self.get_positions()
@@ -0,0 +1,87 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    A thread-safe least-recently-used cache for serialized API responses. Entries expire after a fixed time, and the
+    least recently used entries are removed when the total size of the cached responses exceeds the memory budget.
+    Responses are stored UTF-8 encoded, so they can be sent without encoding them again, and every response is charged
+    for the memory used by its bytes object.
+    """
+
+    def __init__(self, max_size_bytes: int, ttl_seconds: float):
+        """
+        :param max_size_bytes: The maximum total memory used by all cached responses, in bytes.
+        :param ttl_seconds: The number of seconds after which a cached response expires.
+        """
+        self._max_size_bytes = max_size_bytes
+        self._ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # Maps keys to (expiry time, response) tuples, least recently used first
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Get a cached response.
+        :param key: The key of the response.
+        :return: The cached response, or None if the response isn't cached or has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, response: bytes):
+        """
+        Store a response in the cache.
+        :param key: The key of the response.
+        :param response: The serialized response, encoded as UTF-8.
+        """
+        size = sys.getsizeof(response)
+        if size > self._max_size_bytes:
+            # This response would evict all other responses, don't cache it
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self._ttl_seconds, response)
+            self._size_bytes += size
+            # Remove the least recently used responses until the cache fits in its memory budget again
+            while self._size_bytes > self._max_size_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        """
+        Remove all cached responses.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size_bytes = 0
+
+    def get_statistics(self) -> dict:
+        """
+        Get statistics about the usage of this cache.
+        :return: A dict containing the number of hits, misses, cached entries and the size of the cached responses.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "size_bytes": self._size_bytes,
+            }
+
+    def _remove(self, key):
+        _, response = self._entries.pop(key)
+        self._size_bytes -= sys.getsizeof(response)
@@ -5,7 +5,12 @@ A JSON HTTP API for realtime timetables. Requires a static GTFS feed, VehiclePos
 import argparse
 import json
 import logging
+import math
+import os
 import sys
+import threading
+import time
+from datetime import datetime, timedelta
 
 import flask
 
@@ -21,50 +26,297 @@ root.addHandler(handler)
 
 # Initialize the logger before importing our other module. This way we see the output for the other module as well.
 from GtfsTimeTable import TimeTableQueryEngine, GtfsArchiveFetcher
+from Metrics import Metrics, Gauge, Histogram
 from RealtimeDataFetcher import RealtimeDataFetcher
+from ResponseCache import ResponseCache
 
 app = flask.Flask(__name__)
 
+# The maximum number of next departures which can be requested at once
+MAX_DEPARTURES_LIMIT = 1000
+
+# The maximum radius in meters and number of stops for the stops near a location
+MAX_STOPS_NEAR_RADIUS = 5000
+MAX_STOPS_NEAR_LIMIT = 100
+
+REQUEST_SECONDS = Histogram("timetable_api_request_duration_seconds", "The time needed to handle a request",
+                            ["endpoint"])
+REALTIME_DATA_AGE = Gauge("timetable_api_realtime_data_age_seconds",
+                          "The time since the realtime data was last updated, in seconds",
+                          lambda: {("trip_updates",): realtime_data_fetcher.get_delays_age(),
+                                   ("vehicle_positions",): realtime_data_fetcher.get_positions_age()},
+                          ["feed"])
+CACHE_SIZE = Gauge("timetable_api_gtfs_cache_items", "The number of items in the GTFS caches",
+                   lambda: {(cache,): size for cache, size in query_engine.get_cache_sizes().items()},
+                   ["cache"])
+RESPONSE_CACHE = Gauge("timetable_api_response_cache", "Statistics about the departures response cache",
+                       lambda: {(statistic,): value for statistic, value in response_cache.get_statistics().items()},
+                       ["statistic"])
+
+
+def reload_periodically():
+    """
+    Check periodically if a new GTFS feed is available. When it is, a new query engine is created for the new feed,
+    while requests are still being handled by the current engine. The new engine replaces the current one once it is
+    completely initialized.
+    """
+    global query_engine
+    while True:
+        time.sleep(args.reload_interval_minutes * 60)
+        try:
+            new_gtfs_path = GtfsArchiveFetcher.fetch_and_extract(args.gtfs_url, "gtfs/",
+                                                                 extract=not args.read_from_zip)
+            if new_gtfs_path == query_engine.get_gtfs_root():
+                continue
+            logging.info(f"Loading new GTFS feed from {new_gtfs_path}")
+            new_query_engine = TimeTableQueryEngine(new_gtfs_path, realtime_data_fetcher,
+                                                    reduce_memory_usage=args.uncached, workers=args.workers)
+            # Replacing the engine is a single assignment. Requests which are still using the previous engine can
+            # finish, after which the previous engine is freed.
+            query_engine = new_query_engine
+            response_cache.clear()
+            GtfsArchiveFetcher.remove_old_versions(new_gtfs_path)
+            logging.info("Switched to new GTFS feed")
+        except Exception:
+            # Keep using the current feed, and try again later
+            logging.exception("Failed to load a new GTFS feed")
+
+
+def get_time_bucket_start() -> datetime:
+    """
+    Round the current time down to the start of its time bucket. All requests in the same time bucket get the same
+    response, which can be cached until the bucket ends or the realtime data changes.
+    :return: The start of the current time bucket.
+    """
+    now = datetime.now().timestamp()
+    return datetime.fromtimestamp(now - now % args.cache_bucket_seconds)
+
+
+def get_departures_cache_key(engine: TimeTableQueryEngine, stop_id: str, bucket_start: datetime, realtime_versions,
+                             limit: int = None):
+    """
+    Get the key under which the departures for a stop are cached. Quays share the cached response of their parent stop.
+    :param engine: The engine which is used to calculate the departures.
+    :param stop_id: The queried stop id.
+    :param bucket_start: The start of the current time bucket.
+    :param realtime_versions: The versions of the realtime data.
+    :param limit: The number of next departures, or None for the departures in the default time window.
+    :return: The cache key.
+    """
+    return engine.get_gtfs_root(), engine.get_parent_stop_id(stop_id), bucket_start, realtime_versions, limit
+
+
+@app.before_request
+def start_request_timer():
+    if Metrics.is_enabled():
+        flask.g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request_duration(response):
+    start = flask.g.pop('request_start', None)
+    if start is not None:
+        # Label by the route instead of the path, so every stop doesn't get its own label
+        endpoint = flask.request.url_rule.rule if flask.request.url_rule else "unknown"
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint)
+    return response
+
 
 @app.route('/departures/<stop_id>', methods=['GET'])
 def departures(stop_id):
-    resp = flask.Response(json.dumps(query_engine.create_departures_timetable(stop_id)))
+    """
+    Get the departures for a stop. By default, the departures from the past 10 minutes to the next 2 hours are returned.
+    When a limit is given, for example /departures/<stop_id>?limit=10, the next departures are returned instead,
+    however far ahead they are.
+    """
+    limit = flask.request.args.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or not 0 < int(limit) <= MAX_DEPARTURES_LIMIT:
+            flask.abort(400, f"The limit parameter should be a number between 1 and {MAX_DEPARTURES_LIMIT}")
+        limit = int(limit)
+    # The engine can be replaced when a new GTFS feed is loaded, use the same engine for the entire request
+    engine = query_engine
+    if not engine.has_stop(stop_id):
+        flask.abort(404, f"Unknown stop id: {stop_id}")
+    bucket_start = get_time_bucket_start()
+    cache_key = get_departures_cache_key(engine, stop_id, bucket_start, realtime_data_fetcher.get_versions(), limit)
+    response = response_cache.get(cache_key)
+    if response is None:
+        if limit is not None:
+            response = engine.create_next_departures_timetable(stop_id, limit, bucket_start, as_json=True)
+        else:
+            response = engine.create_departures_timetable(stop_id,
+                                                          bucket_start - timedelta(minutes=10),
+                                                          bucket_start + timedelta(hours=2),
+                                                          as_json=True)
+        # Responses are cached encoded, so they're only encoded once
+        response = response.encode("utf-8")
+        response_cache.put(cache_key, response)
+    resp = flask.Response(response)
     resp.headers['Content-encoding'] = 'UTF-8'
     resp.headers['Content-type'] = 'Application/json'
     return resp
 
 
+@app.route('/departures', methods=['GET'])
+def departures_for_multiple_stops():
+    """
+    Get the departures for multiple stops at once, for example /departures?stop_id=a,b,c. The response contains the
+    departures for every stop, keyed by stop id. Stops which aren't cached yet are calculated in a single batch.
+    When one of the stops doesn't exist, a 404 response listing the unknown stop ids is returned.
+    """
+    stop_ids = list(dict.fromkeys(stop_id for stop_id in flask.request.args.get('stop_id', '').split(',') if stop_id))
+    if not stop_ids:
+        flask.abort(400, "The stop_id parameter should contain one or more comma-separated stop ids")
+    engine = query_engine
+    unknown_stop_ids = [stop_id for stop_id in stop_ids if not engine.has_stop(stop_id)]
+    if unknown_stop_ids:
+        flask.abort(404, "Unknown stop ids: " + ", ".join(unknown_stop_ids))
+    bucket_start = get_time_bucket_start()
+    realtime_versions = realtime_data_fetcher.get_versions()
+    cache_keys = {stop_id: get_departures_cache_key(engine, stop_id, bucket_start, realtime_versions)
+                  for stop_id in stop_ids}
+    responses = {stop_id: response_cache.get(cache_key) for stop_id, cache_key in cache_keys.items()}
+    uncached_stop_ids = [stop_id for stop_id, response in responses.items() if response is None]
+    if uncached_stop_ids:
+        timetables = engine.create_departures_timetables(uncached_stop_ids,
+                                                         bucket_start - timedelta(minutes=10),
+                                                         bucket_start + timedelta(hours=2),
+                                                         as_json=True)
+        for stop_id in uncached_stop_ids:
+            responses[stop_id] = timetables[stop_id].encode("utf-8")
+            response_cache.put(cache_keys[stop_id], responses[stop_id])
+    # The responses are already serialized, combine them into one JSON object without parsing them again
+    response = b"{" + b", ".join(json.dumps(stop_id).encode("utf-8") + b": " + responses[stop_id]
+                                 for stop_id in stop_ids) + b"}"
+    resp = flask.Response(response)
+    resp.headers['Content-encoding'] = 'UTF-8'
+    resp.headers['Content-type'] = 'Application/json'
+    return resp
+
+
+@app.route('/status/', methods=['GET'])
+def status():
+    resp = flask.Response(json.dumps({
+        "trip_updates_age": realtime_data_fetcher.get_delays_age(),
+        "vehicle_positions_age": realtime_data_fetcher.get_positions_age(),
+        "response_cache": response_cache.get_statistics(),
+    }))
+    resp.headers['Content-encoding'] = 'UTF-8'
+    resp.headers['Content-type'] = 'Application/json'
+    return resp
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Get the metrics in the Prometheus text format. Only available when the API is started with --metrics.
+    """
+    if not Metrics.is_enabled():
+        flask.abort(404)
+    resp = flask.Response(Metrics.render())
+    resp.headers['Content-type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return resp
+
+
 @app.route('/stops/', methods=['GET'])
 def stops():
-    resp = flask.Response(json.dumps(query_engine.list_queryable_stops()))
+    resp = flask.Response(query_engine.list_queryable_stops(as_json=True))
+    resp.headers['Content-encoding'] = 'UTF-8'
+    resp.headers['Content-type'] = 'Application/json'
+    return resp
+
+
+@app.route('/stops/near', methods=['GET'])
+def stops_near():
+    """
+    Get the stops near a location, for example /stops/near?lat=55.7003&lon=13.1918&radius=500&limit=10. The stops are
+    sorted by their distance to the location. The radius defaults to 500 meters and the limit to 10 stops.
+    """
+    lat = get_float_argument('lat', -90, 90)
+    lon = get_float_argument('lon', -180, 180)
+    radius = get_float_argument('radius', 0, MAX_STOPS_NEAR_RADIUS, 500)
+    limit = flask.request.args.get('limit', '10')
+    if not limit.isdigit() or not 0 < int(limit) <= MAX_STOPS_NEAR_LIMIT:
+        flask.abort(400, f"The limit parameter should be a number between 1 and {MAX_STOPS_NEAR_LIMIT}")
+    resp = flask.Response(query_engine.find_stops_near(lat, lon, radius, int(limit), as_json=True))
     resp.headers['Content-encoding'] = 'UTF-8'
     resp.headers['Content-type'] = 'Application/json'
     return resp
 
 
-parser = argparse.ArgumentParser(
-    description="Start a JSON HTTP API based on GTFS and GTFS-RT data"
-)
-parser._action_groups.pop()
-required = parser.add_argument_group('required arguments')
-optional = parser.add_argument_group('optional arguments')
-required.add_argument("--gtfs", dest="gtfs_url",
-                      help="the url to the gtfs zip file. Include an API key if the gtfs feed requires this.",
-                      required=True)
-required.add_argument("--trip-updates",
-                      help="the url to the tripupdates.pb file. Include an API key if the realtime feed requires this.",
-                      dest="trip_updates", required=True)
-required.add_argument("--vehicle-positions",
-                      help="the url to the vehiclepositions.pb file. Include an API key if the realtime feed requires this.",
-                      dest="vehicle_positions", required=True)
-optional.add_argument("--uncached", help="this option will reduce memory significantly, but queries will be slow",
-                      action='store_true')
-args = parser.parse_args()
-
-realtime_data_fetcher = RealtimeDataFetcher(args.trip_updates, args.vehicle_positions)
-# The Archive fetcher will only fetch a new file when needed
-gtfs_path = GtfsArchiveFetcher.fetch_and_extract(args.gtfs_url, "gtfs/")
-query_engine = TimeTableQueryEngine(gtfs_path, realtime_data_fetcher, reduce_memory_usage=args.uncached)
-
-app.config["DEBUG"] = False
-app.run()
+def get_float_argument(name: str, minimum: float, maximum: float, default: float = None) -> float:
+    """
+    Get a number from the query string, or abort the request when it's missing or invalid.
+    :param name: The name of the parameter.
+    :param minimum: The minimum value.
+    :param maximum: The maximum value.
+    :param default: The value to use when the parameter is missing. The parameter is required when this is None.
+    :return: The value of the parameter.
+    """
+    value = flask.request.args.get(name)
+    if value is None and default is not None:
+        return default
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        value = math.nan
+    # NaN fails every comparison, so it's rejected here as well
+    if not minimum <= value <= maximum:
+        flask.abort(400, f"The {name} parameter should be a number between {minimum} and {maximum}")
+    return value
+
+
+# The process pool used to load the GTFS feed imports this module again, only start the API in the main process
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Start a JSON HTTP API based on GTFS and GTFS-RT data"
+    )
+    parser._action_groups.pop()
+    required = parser.add_argument_group('required arguments')
+    optional = parser.add_argument_group('optional arguments')
+    required.add_argument("--gtfs", dest="gtfs_url",
+                          help="the url to the gtfs zip file. Include an API key if the gtfs feed requires this.",
+                          required=True)
+    required.add_argument("--trip-updates",
+                          help="the url to the tripupdates.pb file. Include an API key if the realtime feed requires this.",
+                          dest="trip_updates", required=True)
+    required.add_argument("--vehicle-positions",
+                          help="the url to the vehiclepositions.pb file. Include an API key if the realtime feed requires this.",
+                          dest="vehicle_positions", required=True)
+    optional.add_argument("--uncached", help="this option will reduce memory significantly, but queries will be slow",
+                          action='store_true')
+    optional.add_argument("--read-from-zip", dest="read_from_zip", action='store_true',
+                          help="read the GTFS files directly from the downloaded zip file, instead of extracting it")
+    optional.add_argument("--reload-interval", dest="reload_interval_minutes", type=int, default=60,
+                          help="how often to check for a new GTFS feed, in minutes. A new feed is downloaded once per day.")
+    optional.add_argument("--cache-bucket", dest="cache_bucket_seconds", type=int, default=30,
+                          help="the length of a time bucket in seconds. Departure responses are cached for this long.")
+    optional.add_argument("--cache-size", dest="cache_size_mb", type=int, default=64,
+                          help="the maximum memory usage for cached departure responses, in megabytes.")
+    optional.add_argument("--workers", type=int, default=os.cpu_count(),
+                          help="the number of processes used to parse the GTFS feed. Defaults to the number of CPUs.")
+    optional.add_argument("--metrics", action='store_true',
+                          help="record timing metrics and expose them in the Prometheus format on the /metrics endpoint")
+    args = parser.parse_args()
+
+    if args.metrics:
+        # Enable metrics before loading the GTFS feed, so the time needed to load it is recorded as well
+        Metrics.enable()
+
+    response_cache = ResponseCache(args.cache_size_mb * 1024 * 1024, args.cache_bucket_seconds)
+
+    realtime_data_fetcher = RealtimeDataFetcher(args.trip_updates, args.vehicle_positions)
+    # Refresh realtime data periodically, so requests never have to wait for realtime data to be downloaded
+    realtime_data_fetcher.start_background_refresh()
+    # The Archive fetcher will only fetch a new file when needed
+    gtfs_path = GtfsArchiveFetcher.fetch_and_extract(args.gtfs_url, "gtfs/", extract=not args.read_from_zip)
+    query_engine = TimeTableQueryEngine(gtfs_path, realtime_data_fetcher, reduce_memory_usage=args.uncached,
+                                        workers=args.workers)
+    # Remove the versions and derived files left behind by earlier runs, now that no other engine can be using them
+    GtfsArchiveFetcher.remove_old_versions(gtfs_path)
+    # Load new GTFS feeds in the background, without interrupting the API
+    threading.Thread(target=reload_periodically, name="gtfs-reload", daemon=True).start()
+
+    app.config["DEBUG"] = False
+    app.run()
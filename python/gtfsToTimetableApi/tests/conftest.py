@@ -0,0 +1,88 @@
+import csv
+import os
+import sys
+import time
+import zipfile
+from datetime import date, timedelta
+
+import pytest
+
+# The modules of the timetable API are imported by their file name, just like they import each other
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from RealtimeDataFetcher import RealtimeDataFetcher
+
+
+def get_default_feed_files():
+    """
+    Get the files of a small GTFS feed: two stations with one quay each, and one bus trip per day which departs from
+    the first station at 08:00 and arrives at the second station at 08:10. The trip runs every day, from a week ago
+    until a month from now.
+    :return: A dict mapping file names to a list of rows, the first row being the header.
+    """
+    start_date = (date.today() - timedelta(days=7)).strftime("%Y%m%d")
+    end_date = (date.today() + timedelta(days=30)).strftime("%Y%m%d")
+    return {
+        "feed_info.txt": [["feed_id", "feed_publisher_name"], ["1", "Test"]],
+        "stops.txt": [["stop_id", "stop_name", "stop_lat", "stop_lon", "location_type", "parent_station",
+                       "platform_code"],
+                      ["S1", "Lund Centralstation", "55.705", "13.187", "1", "", ""],
+                      ["Q1", "Lund Centralstation", "55.705", "13.187", "0", "S1", "A"],
+                      ["S2", "Malmö Centralstation", "55.609", "13.000", "1", "", ""],
+                      ["Q2", "Malmö Centralstation", "55.609", "13.000", "0", "S2", "B"]],
+        "routes.txt": [["route_id", "route_short_name", "route_long_name", "route_type"],
+                       ["R1", "1", "Lund - Malmö", "700"]],
+        "trips.txt": [["route_id", "service_id", "trip_id", "trip_headsign"],
+                      ["R1", "DAILY", "T1", "Malmö"]],
+        "calendar.txt": [["service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+                          "start_date", "end_date"],
+                         ["DAILY", "1", "1", "1", "1", "1", "1", "1", start_date, end_date]],
+        "calendar_dates.txt": [["service_id", "date", "exception_type"]],
+        "stop_times.txt": [["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence", "stop_headsign"],
+                           ["T1", "08:00:00", "08:00:00", "Q1", "1", ""],
+                           ["T1", "08:10:00", "08:10:00", "Q2", "2", ""]],
+    }
+
+
+@pytest.fixture
+def write_feed():
+    """
+    Write a GTFS feed to a directory. Files can be replaced by passing their rows, see get_default_feed_files.
+    """
+
+    def write(directory, **files):
+        os.makedirs(directory, exist_ok=True)
+        feed_files = get_default_feed_files()
+        feed_files.update({name.replace("_txt", ".txt"): rows for name, rows in files.items()})
+        for filename, rows in feed_files.items():
+            with open(os.path.join(directory, filename), "w", encoding="utf8", newline="") as file:
+                csv.writer(file, lineterminator="\n").writerows(rows)
+        return str(directory)
+
+    return write
+
+
+@pytest.fixture
+def zip_feed():
+    """
+    Compress an extracted GTFS feed into a zip file.
+    """
+
+    def compress(directory, zip_path):
+        with zipfile.ZipFile(zip_path, "w") as zip_file:
+            for filename in sorted(os.listdir(directory)):
+                zip_file.write(os.path.join(directory, filename), filename)
+        return str(zip_path)
+
+    return compress
+
+
+@pytest.fixture
+def realtime_fetcher():
+    """
+    A realtime fetcher without realtime data, which never downloads anything.
+    """
+    fetcher = RealtimeDataFetcher("http://127.0.0.1:1/TripUpdates.pb", "http://127.0.0.1:1/VehiclePositions.pb")
+    # Mark the empty data as fresh, so it's never refreshed
+    fetcher._delays_last_updated = fetcher._positions_last_updated = int(time.time()) + 24 * 3600
+    return fetcher
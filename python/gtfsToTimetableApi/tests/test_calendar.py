@@ -0,0 +1,42 @@
+from datetime import date, datetime, time, timedelta
+
+import pytest
+
+from GtfsCacheHelpers import GtfsCalendarDatesCache
+from GtfsTimeTable import TimeTableQueryEngine
+
+
+@pytest.fixture
+def gtfs_root(tmp_path, write_feed):
+    """
+    A feed with an extra trip, T2, whose service isn't listed in calendar.txt or calendar_dates.txt.
+    """
+    return write_feed(tmp_path / "gtfs",
+                      trips_txt=[["route_id", "service_id", "trip_id", "trip_headsign"],
+                                 ["R1", "DAILY", "T1", "Malmö"],
+                                 ["R1", "UNKNOWN", "T2", "Malmö"]],
+                      stop_times_txt=[["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"],
+                                      ["T1", "08:00:00", "08:00:00", "Q1", "1"],
+                                      ["T1", "08:10:00", "08:10:00", "Q2", "2"],
+                                      ["T2", "08:30:00", "08:30:00", "Q1", "1"],
+                                      ["T2", "08:40:00", "08:40:00", "Q2", "2"]])
+
+
+def test_service_without_calendar_never_runs(gtfs_root):
+    calendar_dates_cache = GtfsCalendarDatesCache(gtfs_root)
+    assert calendar_dates_cache.get_service_operating_days("UNKNOWN") == []
+    assert not calendar_dates_cache.is_serviced("UNKNOWN", date.today())
+    assert "UNKNOWN" not in calendar_dates_cache.get_operating_services(date.today())
+    assert date.today() in calendar_dates_cache.get_service_operating_days("DAILY")
+
+
+@pytest.mark.parametrize("reduce_memory_usage", [False, True])
+def test_trips_of_service_without_calendar_are_skipped(gtfs_root, realtime_fetcher, reduce_memory_usage):
+    engine = TimeTableQueryEngine(gtfs_root, realtime_fetcher, reduce_memory_usage=reduce_memory_usage,
+                                  use_snapshot=False)
+    today = datetime.combine(date.today(), time(0))
+    timetable = engine.create_departures_timetable("S1", today + timedelta(hours=7), today + timedelta(hours=10))
+    assert [departure["scheduled_departure_time"] for departure in timetable["departures"]] == ["08:00:00"]
+    next_departures = engine.create_next_departures_timetable("S1", 3, today + timedelta(hours=7))
+    assert [departure["scheduled_departure_time"] for departure in next_departures["departures"]] == \
+           ["08:00:00", "08:00:00", "08:00:00"]
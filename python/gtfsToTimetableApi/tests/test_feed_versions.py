@@ -0,0 +1,75 @@
+import os
+import threading
+from datetime import datetime, time
+
+import pytest
+
+from GtfsCacheSnapshot import GtfsCacheSnapshot
+from GtfsTimeTable import GtfsArchiveFetcher, TimeTableQueryEngine
+
+
+def get_derived_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith(("cache-", "stop_times-")))
+
+
+def query_in_new_thread(engine):
+    """
+    Query an engine from a new thread, which opens its own connection to the stop times index in the uncached mode.
+    """
+    results = list()
+    today = datetime.now().date()
+    thread = threading.Thread(target=lambda: results.append(engine.create_departures_timetable(
+        "S1", datetime.combine(today, time(7)), datetime.combine(today, time(10)))))
+    thread.start()
+    thread.join()
+    assert results, "The query failed"
+    return results[0]
+
+
+@pytest.fixture
+def zip_versions(tmp_path, write_feed, zip_feed):
+    """
+    Two versions of a feed which are read from zip files, and share the directory in which derived files are stored.
+    """
+    os.makedirs(tmp_path / "versions")
+    old_zip = zip_feed(write_feed(tmp_path / "old"), tmp_path / "versions" / "20240101000000.zip")
+    new_stops = [["stop_id", "stop_name", "stop_lat", "stop_lon", "location_type", "parent_station", "platform_code"],
+                 ["S1", "Lund C", "55.705", "13.187", "1", "", ""],
+                 ["Q1", "Lund C", "55.705", "13.187", "0", "S1", "A"]]
+    new_zip = zip_feed(write_feed(tmp_path / "new", stops_txt=new_stops), tmp_path / "versions" / "20240102000000.zip")
+    return old_zip, new_zip
+
+
+@pytest.mark.parametrize("reduce_memory_usage", [False, True])
+def test_old_version_is_usable_after_new_version_is_loaded(zip_versions, realtime_fetcher, reduce_memory_usage):
+    old_zip, new_zip = zip_versions
+    old_engine = TimeTableQueryEngine(old_zip, realtime_fetcher, reduce_memory_usage=reduce_memory_usage)
+    old_files = get_derived_files(os.path.dirname(old_zip))
+    assert old_files
+
+    new_engine = TimeTableQueryEngine(new_zip, realtime_fetcher, reduce_memory_usage=reduce_memory_usage)
+
+    # Loading the new version doesn't remove the files of the version which is still being served
+    assert set(old_files) <= set(get_derived_files(os.path.dirname(old_zip)))
+    old_timetable = query_in_new_thread(old_engine)
+    assert [departure["stop"]["name"] for departure in old_timetable["departures"]] == ["Lund Centralstation"]
+    new_timetable = query_in_new_thread(new_engine)
+    assert [departure["stop"]["name"] for departure in new_timetable["departures"]] == ["Lund C"]
+
+
+def test_remove_old_versions_removes_derived_files_of_retired_versions(zip_versions, realtime_fetcher):
+    old_zip, new_zip = zip_versions
+    TimeTableQueryEngine(old_zip, realtime_fetcher)
+    TimeTableQueryEngine(old_zip, realtime_fetcher, reduce_memory_usage=True)
+    TimeTableQueryEngine(new_zip, realtime_fetcher, reduce_memory_usage=True)
+    new_engine = TimeTableQueryEngine(new_zip, realtime_fetcher)
+    directory = os.path.dirname(new_zip)
+    new_hash = GtfsCacheSnapshot.get_feed_hash(new_zip)
+
+    GtfsArchiveFetcher.remove_old_versions(new_zip, keep=1)
+
+    assert not os.path.exists(old_zip)
+    derived_files = get_derived_files(directory)
+    assert derived_files == sorted([f"cache-{new_hash}.columns", f"cache-{new_hash}.pickle",
+                                    f"stop_times-{new_hash}.sqlite"])
+    assert query_in_new_thread(new_engine)["departures"]
@@ -0,0 +1,25 @@
+from GtfsCacheHelpers import GtfsStop, GtfsStopsCache
+
+STOPS_HEADER = ["stop_id", "stop_name", "stop_lat", "stop_lon", "location_type"]
+
+
+def test_missing_optional_columns_are_empty(tmp_path, write_feed):
+    gtfs_root = write_feed(tmp_path / "gtfs", stops_txt=[STOPS_HEADER,
+                                                         ["S1", "Lund C", "55.705", "13.187", "1"],
+                                                         ["S2", "Malmö C", "55.609", "13.000"]])
+    stops = {stop.stop_id: stop for stop in GtfsStop.read_all(gtfs_root, "stops.txt")}
+    assert stops["S1"]["parent_station"] == stops["S1"]["platform_code"] == ""
+    # A short row is padded with empty values
+    assert stops["S2"]["location_type"] == stops["S2"]["parent_station"] == ""
+
+
+def test_extra_trailing_values_are_ignored(tmp_path, write_feed):
+    gtfs_root = write_feed(tmp_path / "gtfs", stops_txt=[STOPS_HEADER,
+                                                         ["S1", "Lund C", "55.705", "13.187", "1", ""],
+                                                         ["S2", "Malmö C", "55.609", "13.000", "1", "extra", "more"]])
+    stops = GtfsStopsCache(gtfs_root)
+    for stop_id in ["S1", "S2"]:
+        stop = stops.get_stop(stop_id)
+        assert stop["location_type"] == "1"
+        assert stop["parent_station"] == stop["platform_code"] == ""
+    assert not stops.get_all_quays_in_stop_place("extra")
@@ -0,0 +1,34 @@
+import sys
+
+from ResponseCache import ResponseCache
+
+
+def test_responses_are_charged_for_their_encoded_size():
+    response = '{"name": "Malmö Södra Förstaden"}'.encode("utf-8")
+    cache = ResponseCache(1024, 30)
+    cache.put("key", response)
+    assert cache.get("key") == response
+    assert cache.get_statistics()["size_bytes"] == sys.getsizeof(response)
+    # Non-ASCII characters take more than one byte in UTF-8
+    assert cache.get_statistics()["size_bytes"] > len(response.decode("utf-8"))
+
+
+def test_response_larger_than_budget_is_not_cached():
+    response = ("ö" * 100).encode("utf-8")
+    # The response has 100 characters, but takes 200 bytes
+    cache = ResponseCache(150, 30)
+    cache.put("key", response)
+    assert cache.get("key") is None
+    assert cache.get_statistics()["size_bytes"] == 0
+
+
+def test_least_recently_used_responses_are_evicted():
+    responses = {key: ("å" * 100).encode("utf-8") for key in ["a", "b", "c"]}
+    cache = ResponseCache(2 * sys.getsizeof(responses["a"]), 30)
+    cache.put("a", responses["a"])
+    cache.put("b", responses["b"])
+    assert cache.get("a") is not None
+    cache.put("c", responses["c"])
+    assert cache.get("b") is None
+    assert cache.get("a") == responses["a"] and cache.get("c") == responses["c"]
+    assert cache.get_statistics()["size_bytes"] == 2 * sys.getsizeof(responses["a"])
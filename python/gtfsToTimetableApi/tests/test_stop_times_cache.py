@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import GtfsCacheHelpers
+from GtfsCacheHelpers import GtfsStopTimesCache
+
+
+def write_stop_times_with_quoted_newlines(tmp_path, write_feed):
+    rows = [["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence", "stop_headsign"]]
+    for trip in range(50):
+        for sequence, stop_id in enumerate(["Q1", "Q2"], start=1):
+            # Some headsigns contain newlines, commas and escaped quotes, which are quoted by the csv writer
+            headsign = f'Malmö\nvia "Lund", trip {trip}' if trip % 3 == 0 else f"Malmö {trip}"
+            departure = f"{8 + trip // 6:02d}:{trip % 6 * 10 + sequence:02d}:00"
+            rows.append([f"T{trip}", departure, departure, stop_id, str(sequence), headsign])
+    trips = [["route_id", "service_id", "trip_id"]] + [["R1", "DAILY", f"T{trip}"] for trip in range(50)]
+    return write_feed(tmp_path / "gtfs", stop_times_txt=rows, trips_txt=trips)
+
+
+def get_stop_times(cache):
+    return [(stop_time['trip_id'], stop_time['stop_id'], stop_time['departure_time'], stop_time['stop_sequence'],
+             stop_time['stop_headsign']) for stop_time in cache.get_stop_times()]
+
+
+def test_parallel_parsing_keeps_quoted_newlines(tmp_path, write_feed, monkeypatch):
+    gtfs_root = write_stop_times_with_quoted_newlines(tmp_path, write_feed)
+    expected = get_stop_times(GtfsStopTimesCache(gtfs_root))
+    assert len(expected) == 100
+    assert 'Malmö\nvia "Lund", trip 0' in [stop_time[4] for stop_time in expected]
+
+    # Split the file into many small chunks, so chunk boundaries fall inside quoted fields
+    for chunk_size in [1, 37, 200, 1000]:
+        monkeypatch.setattr(GtfsCacheHelpers, "STOP_TIMES_CHUNK_SIZE", chunk_size)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            assert get_stop_times(GtfsStopTimesCache(gtfs_root, executor=executor)) == expected
@@ -0,0 +1,51 @@
+import argparse
+import json
+
+import pytest
+
+import TimeTableApi
+from GtfsTimeTable import TimeTableQueryEngine
+from ResponseCache import ResponseCache
+
+
+@pytest.fixture
+def client(tmp_path, write_feed, realtime_fetcher, monkeypatch):
+    """
+    A test client for the API, serving a small GTFS feed.
+    """
+    engine = TimeTableQueryEngine(write_feed(tmp_path / "gtfs"), realtime_fetcher, use_snapshot=False)
+    # These are normally created when the API is started from the command line
+    monkeypatch.setattr(TimeTableApi, "args", argparse.Namespace(cache_bucket_seconds=30), raising=False)
+    monkeypatch.setattr(TimeTableApi, "query_engine", engine, raising=False)
+    monkeypatch.setattr(TimeTableApi, "realtime_data_fetcher", realtime_fetcher, raising=False)
+    monkeypatch.setattr(TimeTableApi, "response_cache", ResponseCache(1024 * 1024, 30), raising=False)
+    return TimeTableApi.app.test_client()
+
+
+def test_departures_for_multiple_stops(client):
+    response = client.get("/departures?stop_id=S1,Q2")
+    assert response.status_code == 200
+    assert set(json.loads(response.data)) == {"S1", "Q2"}
+
+
+def test_departures_for_multiple_stops_with_unknown_stops(client):
+    response = client.get("/departures?stop_id=S1,UNKNOWN,Q2,MISSING")
+    assert response.status_code == 404
+    assert b"UNKNOWN, MISSING" in response.data
+
+
+def test_departures_for_unknown_stop(client):
+    assert client.get("/departures/UNKNOWN").status_code == 404
+    assert client.get("/departures/UNKNOWN?limit=5").status_code == 404
+
+
+def test_cached_departures_are_identical(client):
+    first = client.get("/departures/S2")
+    second = client.get("/departures/S2")
+    assert first.status_code == second.status_code == 200
+    assert first.data == second.data
+    assert "Malmö".encode("utf-8") in first.data
+    assert TimeTableApi.response_cache.get_statistics()["hits"] == 1
+    # Batch responses combine the cached responses
+    batch = json.loads(client.get("/departures?stop_id=S2,Q2").data)
+    assert batch["S2"] == batch["Q2"] == json.loads(first.data)
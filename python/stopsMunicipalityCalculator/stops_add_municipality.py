@@ -1,65 +1,424 @@
 #!/usr/bin/python3
+import argparse
 import csv
+import hashlib
 import json
-import sys
+import math
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, stops are processed one by one without it
+    numpy = None
 
 # This script adds the municipality to every stop in a GTFS stops.txt file.
 # If the municipality cannot be found, nothing is added.
 # This script makes use of the raycasting point in polygon algorithm: https://en.wikipedia.org/wiki/Point_in_polygon
+# The borders are indexed once: municipalities are placed in a grid based on their bounding box, and the edges of their
+# polygons are divided over latitude bands. Every stop is only tested against the edges near it.
+# When NumPy is installed, all stops are tested against a municipality at once. The results are the same either way.
+# Stops are divided over one process per CPU. The municipality of every stop location is cached next to the GeoJSON
+# file, so later runs with the same GeoJSON file only need to calculate the municipality of new or moved stops.
 #
-# Usage: python stops_insert_municipality.py <stops_file> <geojson_borders_file>
+# Usage: python stops_insert_municipality.py <stops_file> <geojson_borders_file> [--workers <n>] [--no-cache]
 # Example: python stops_insert_municipality.py stops.txt Sweden_AL7_OSM.geojson
 # Obtain a file from https://osm-boundaries.com/ (replacement of https://wambachers-osm.website/boundaries/)
 #
 # Note: Use python 3, NOT the outdated 2.7
 
-def add_municipality_to_gtfs_stops(gtfs_stops_file_path: str, geojson_file_path: str):
+# Points which lie exactly on the latitude of a vertex are moved north by this distance, see
+# intersects_with_northbound_ray
+VERTEX_NUDGE = 0.00001
+
+# The average number of polygon edges per latitude band
+EDGES_PER_BAND = 8
+
+# The number of decimals of the cached coordinates. Stops less than about a centimeter apart share their municipality.
+CACHE_PRECISION = 7
+
+# The minimum number of stops which are sent to a process at once
+MIN_CHUNK_SIZE = 1000
+
+# The index used to find municipalities in this process, set by init_municipality_finder
+_geojson_index = None
+_batch = True
+
+
+def add_municipality_to_gtfs_stops(gtfs_stops_file_path: str, geojson_file_path: str, batch: bool = True,
+                                   workers: int = None, cache_path: str = None, use_cache: bool = False):
+    """
+    :param gtfs_stops_file_path: The path to the stops.txt file.
+    :param geojson_file_path: The path to the GeoJSON file containing the municipality borders.
+    :param batch: Whether all stops should be tested against a municipality at once when NumPy is installed.
+    :param workers: The number of processes to use. Defaults to the number of CPUs.
+    :param cache_path: The path of the cache file. Defaults to a file next to the GeoJSON file.
+    :param use_cache: Whether municipalities should be cached between runs, in a file next to the GeoJSON file unless
+                      cache_path is given. The command line enables this by default.
+    :return: The path of the output file.
+    """
     output_path = gtfs_stops_file_path[0:-4] + "_with_municipalities.txt"
 
-    with open(geojson_file_path, "r", encoding="utf8") as geojson_file:
-        geojson = json.load(geojson_file)
+    with open(geojson_file_path, "rb") as geojson_file:
+        geojson_contents = geojson_file.read()
+    cache = MunicipalityCache(cache_path or geojson_file_path + ".cache.json" if use_cache else None,
+                              hashlib.sha256(geojson_contents).hexdigest())
+    geojson = json.loads(geojson_contents)
 
     with open(gtfs_stops_file_path, "r", encoding="utf8") as stops_file:
         gtfs_reader = csv.DictReader(stops_file, delimiter=',', quotechar='"')
-        with open(output_path, "w", encoding="utf8", newline='\n') as new_stops_file:
-            gtfs_writer = csv.DictWriter(new_stops_file, fieldnames=gtfs_reader.fieldnames,
-                                         delimiter=',', quotechar='"')
-            for stop in gtfs_reader:
-                write_stop_with_municipality(stop, gtfs_writer, geojson)
+        fieldnames = gtfs_reader.fieldnames
+        stops = list(gtfs_reader)
+
+    stop_coordinates = [(float(stop["stop_lon"]), float(stop["stop_lat"])) for stop in stops]
+    stop_cache_keys = [cache.get_key(lon, lat) for lon, lat in stop_coordinates]
+    # Only calculate the municipality of locations which aren't cached yet, and only once per location
+    uncached_coordinates = dict()
+    for cache_key, coordinates in zip(stop_cache_keys, stop_coordinates):
+        if cache_key not in cache and cache_key not in uncached_coordinates:
+            uncached_coordinates[cache_key] = coordinates
+    if uncached_coordinates:
+        feature_indices = find_municipalities(geojson_file_path, geojson, list(uncached_coordinates.values()),
+                                              batch, workers or os.cpu_count())
+        cache.update(zip(uncached_coordinates, feature_indices))
+    # Only keep the locations of the current stops, so moved and removed stops don't stay in the cache forever
+    cache.save(stop_cache_keys)
+
+    with open(output_path, "w", encoding="utf8", newline='\n') as new_stops_file:
+        gtfs_writer = csv.DictWriter(new_stops_file, fieldnames=fieldnames,
+                                     delimiter=',', quotechar='"')
+        # Stops are written in the same order as they were read
+        for stop, cache_key in zip(stops, stop_cache_keys):
+            feature_index = cache.get(cache_key)
+            municipality = geojson["features"][feature_index] if feature_index >= 0 else False
+            stop["stop_name"] = get_name_with_municipality(stop, municipality)
+            gtfs_writer.writerow(stop)
     return output_path
 
 
-def write_stop_with_municipality(stop, new_stops_file, geojson):
-    stop["stop_name"] = getNameWithMunicipalityForStop(stop, geojson)
-    new_stops_file.writerow(stop)
+def find_municipalities(geojson_file_path, geojson, coordinates, batch, workers):
+    """
+    Find the municipality of every location. The locations are divided into chunks, which are processed by a pool of
+    processes. Every process loads and indexes the GeoJSON file once.
+    :param geojson_file_path: The path to the GeoJSON file.
+    :param geojson: The contents of the GeoJSON file, used when no processes are started.
+    :param coordinates: A list of (longitude, latitude) tuples.
+    :param batch: Whether all locations in a chunk should be tested against a municipality at once.
+    :param workers: The number of processes to use.
+    :return: The index of the municipality in the GeoJSON features for every location, or -1 if it lies in none.
+    """
+    if workers <= 1 or len(coordinates) <= MIN_CHUNK_SIZE:
+        # Starting processes isn't worth it for a single chunk
+        global _geojson_index, _batch
+        _geojson_index = GeoJsonIndex(geojson)
+        _batch = batch
+        return find_municipalities_in_chunk(coordinates)
+    # A few chunks per process, so processes which finish early can take over work from the others
+    chunk_size = max(MIN_CHUNK_SIZE, math.ceil(len(coordinates) / (workers * 4)))
+    chunks = [coordinates[i:i + chunk_size] for i in range(0, len(coordinates), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_municipality_finder,
+                             initargs=(geojson_file_path, batch)) as executor:
+        # map returns the results in the same order as the chunks
+        return [feature_index for chunk_feature_indices in executor.map(find_municipalities_in_chunk, chunks)
+                for feature_index in chunk_feature_indices]
+
+
+def init_municipality_finder(geojson_file_path, batch):
+    """
+    Load and index the GeoJSON file in a worker process.
+    """
+    global _geojson_index, _batch
+    with open(geojson_file_path, "r", encoding="utf8") as geojson_file:
+        _geojson_index = GeoJsonIndex(json.load(geojson_file))
+    _batch = batch
+
+
+def find_municipalities_in_chunk(coordinates):
+    """
+    Find the municipality of every location in a chunk, using the index of this process.
+    :param coordinates: A list of (longitude, latitude) tuples.
+    :return: The index of the municipality in the GeoJSON features for every location, or -1 if it lies in none.
+    """
+    if _batch and numpy is not None:
+        lons = numpy.array([lon for lon, _ in coordinates], dtype=numpy.float64)
+        lats = numpy.array([lat for _, lat in coordinates], dtype=numpy.float64)
+        return _geojson_index.get_feature_indices(lons, lats)
+    return [_geojson_index.get_feature_index(lon, lat) for lon, lat in coordinates]
+
+
+class MunicipalityCache:
+    """
+    The municipality of every stop location, stored between runs. Municipalities are stored as the index of their
+    feature in the GeoJSON file. Cached municipalities are only used with the exact same GeoJSON file.
+    """
+
+    def __init__(self, path, geojson_hash):
+        """
+        :param path: The path of the cache file, or None to not store the cache.
+        :param geojson_hash: The hash of the contents of the GeoJSON file.
+        """
+        self._path = path
+        self._geojson_hash = geojson_hash
+        self._feature_indices = dict()
+        self._loaded_count = 0
+        self._updated = False
+        if path is None or not os.path.exists(path):
+            return
+        try:
+            with open(path, "r", encoding="utf8") as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            # A damaged cache is replaced after this run
+            return
+        if cache.get("geojson_hash") == geojson_hash and cache.get("precision") == CACHE_PRECISION:
+            self._feature_indices = cache["feature_indices"]
+            self._loaded_count = len(self._feature_indices)
+
+    @staticmethod
+    def get_key(lon, lat):
+        return f"{lat:.{CACHE_PRECISION}f},{lon:.{CACHE_PRECISION}f}"
 
+    def __contains__(self, key):
+        return key in self._feature_indices
 
-def getNameWithMunicipalityForStop(stop, geojson):
-    lon = float(stop["stop_lon"])
-    lat = float(stop["stop_lat"])
-    municipality = getMunicipalityForCoordinates(lon, lat, geojson)
+    def get(self, key):
+        return self._feature_indices[key]
+
+    def update(self, feature_indices):
+        self._feature_indices.update(feature_indices)
+        self._updated = True
+
+    def save(self, keys):
+        """
+        Store the cache, keeping only the given locations. The file isn't written when it wouldn't change.
+        :param keys: The keys of the locations to keep, as returned by get_key.
+        """
+        if self._path is None:
+            return
+        feature_indices = {key: self._feature_indices[key] for key in keys}
+        if not self._updated and len(feature_indices) == self._loaded_count:
+            # Every stored location is still in use, and no locations were added
+            return
+        # Write to a temporary file first, so an interrupted run never leaves a damaged cache behind
+        with open(self._path + ".tmp", "w", encoding="utf8") as cache_file:
+            json.dump({"geojson_hash": self._geojson_hash, "precision": CACHE_PRECISION,
+                       "feature_indices": feature_indices}, cache_file)
+        os.replace(self._path + ".tmp", self._path)
+
+
+def get_name_with_municipality(stop, municipality):
     if municipality:
         return stop["stop_name"] + " (" + municipality["properties"]["official_name"] + ")"
     return stop["stop_name"]
 
 
-def getMunicipalityForCoordinates(lat, lon, geojson):
-    for feature in geojson["features"]:
-        if "bbox" in feature:
+class GeoJsonIndex:
+    """
+    A spatial index over the features in a GeoJSON file. Every feature is placed in the cells of a uniform grid which
+    are covered by its bounding box, so a point only needs to be tested against the features in its cell.
+    """
+
+    def __init__(self, geojson):
+        self._features = [IndexedFeature(feature, index) for index, feature in enumerate(geojson["features"])
+                          if "geometry" in feature]
+        # Features without polygons can't contain any point
+        self._features = [feature for feature in self._features if feature.bbox is not None]
+        self._cells = defaultdict(list)
+        if not self._features:
+            return
+        self._min_lon = min(feature.bbox[0] for feature in self._features)
+        self._min_lat = min(feature.bbox[1] for feature in self._features)
+        max_lon = max(feature.bbox[2] for feature in self._features)
+        max_lat = max(feature.bbox[3] for feature in self._features)
+        # About 4 cells per feature, so most cells only contain a few features
+        self._cells_per_axis = math.ceil(math.sqrt(len(self._features)) * 2)
+        self._cell_width = (max_lon - self._min_lon) / self._cells_per_axis or 1
+        self._cell_height = (max_lat - self._min_lat) / self._cells_per_axis or 1
+        # Features are added in the order of the file, so the first matching feature in a cell is the first matching
+        # feature in the file
+        for feature in self._features:
+            min_x, min_y = self._get_cell(feature.bbox[0], feature.bbox[1])
+            max_x, max_y = self._get_cell(feature.bbox[2], feature.bbox[3])
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    self._cells[(x, y)].append(feature)
+
+    def get_feature_index(self, lon, lat):
+        """
+        Get the index of the first feature containing a point.
+        :param lon: The longitude of the point.
+        :param lat: The latitude of the point.
+        :return: The index of the feature in the GeoJSON file, or -1 if the point doesn't lie in any feature.
+        """
+        if not self._features:
+            return -1
+        for feature in self._cells.get(self._get_cell(lon, lat), ()):
+            if feature.contains(lon, lat):
+                return feature.index
+        return -1
+
+    def get_feature_indices(self, lons, lats):
+        """
+        Get the index of the first feature containing every point in a batch. All points are tested against a feature
+        at once, after which the points which lie in that feature aren't tested against the next features.
+        :param lons: A NumPy array containing the longitudes of the points.
+        :param lats: A NumPy array containing the latitudes of the points.
+        :return: A list containing the index of the feature in the GeoJSON file, or -1, for every point.
+        """
+        feature_indices = numpy.full(len(lons), -1, dtype=numpy.int64)
+        remaining_points = numpy.arange(len(lons))
+        # Features are tested in the order of the file, so every point gets the first matching feature in the file
+        for feature in self._features:
+            if len(remaining_points) == 0:
+                break
+            inside = feature.contains_all(lons[remaining_points], lats[remaining_points])
+            feature_indices[remaining_points[inside]] = feature.index
+            remaining_points = remaining_points[~inside]
+        return feature_indices.tolist()
+
+    def _get_cell(self, lon, lat):
+        # Points on the far edge of the grid belong to the last cell
+        return min(int((lon - self._min_lon) // self._cell_width), self._cells_per_axis - 1), \
+               min(int((lat - self._min_lat) // self._cell_height), self._cells_per_axis - 1)
+
+
+class IndexedFeature:
+    """
+    A GeoJSON feature, with the edges of its polygons divided over latitude bands. Only edges which overlap with the
+    latitude of a point can intersect with the ray from that point, so only the edges in a single band are tested.
+    """
+
+    def __init__(self, feature, index):
+        """
+        :param feature: The GeoJSON feature.
+        :param index: The index of the feature in the GeoJSON file.
+        """
+        self.feature = feature
+        self.index = index
+        edges = list()
+        for ring in get_rings(feature["geometry"]):
+            ring_size = len(ring)
+            for i in range(0, ring_size):
+                edges.append((ring[i], ring[(i + 1) % ring_size]))
+        self.bbox = None
+        if not edges:
+            return
+        # The bounding box included in the file is used as-is, even when it doesn't match the coordinates. Otherwise,
+        # it is calculated from the coordinates. Points which are moved north by VERTEX_NUDGE can intersect with edges
+        # just south of them, extend the bounding box to the south to include these points.
+        self._has_bbox = "bbox" in feature
+        if self._has_bbox:
             bbox = feature["bbox"]
-            if not in_bbox(lat, lon, bbox):
-                continue
+            self.bbox = [min(bbox[0], bbox[2]), min(bbox[1], bbox[3]), max(bbox[0], bbox[2]), max(bbox[1], bbox[3])]
+        else:
+            self.bbox = [min(start[0] for start, _ in edges), min(start[1] for start, _ in edges) - 2 * VERTEX_NUDGE,
+                         max(start[0] for start, _ in edges), max(start[1] for start, _ in edges)]
+        self._min_lat = min(start[1] for start, _ in edges) - 2 * VERTEX_NUDGE
+        self._max_lat = max(start[1] for start, _ in edges)
+        self._band_count = max(1, len(edges) // EDGES_PER_BAND)
+        self._band_height = (self._max_lat - self._min_lat) / self._band_count or 1
+        self._edges = edges
+        # The indices of the edges in every band
+        self._band_edges = [list() for _ in range(self._band_count)]
+        for i, (start, end) in enumerate(edges):
+            for band in range(self._get_band(min(start[1], end[1]) - 2 * VERTEX_NUDGE),
+                              self._get_band(max(start[1], end[1])) + 1):
+                self._band_edges[band].append(i)
+        self._bands = [[edges[i] for i in band_edges] for band_edges in self._band_edges]
+        # The edges as NumPy arrays, created when they are first needed
+        self._edge_arrays = None
+
+    def contains(self, lon, lat):
+        """
+        Check whether a point lies in this feature, using the raycasting algorithm.
+        :param lon: The longitude of the point.
+        :param lat: The latitude of the point.
+        :return: True if the point lies in this feature.
+        """
+        if self._has_bbox:
+            if not in_bbox(lon, lat, self.feature["bbox"]):
+                return False
+        elif not self.bbox[0] <= lon <= self.bbox[2] or not self.bbox[1] <= lat <= self.bbox[3]:
+            return False
+        if not self._min_lat <= lat <= self._max_lat:
+            # No edge overlaps with the latitude of this point
+            return False
+        inside = False
+        for start, end in self._bands[self._get_band(lat)]:
+            if intersects_with_northbound_ray(lon, lat, start, end):
+                inside = not inside
+        return inside
+
+    def contains_all(self, lons, lats):
+        """
+        Check for every point in a batch whether it lies in this feature, using the same algorithm as contains().
+        Every point is tested against all edges in its latitude band at once.
+        :param lons: A NumPy array containing the longitudes of the points.
+        :param lats: A NumPy array containing the latitudes of the points.
+        :return: A NumPy array containing True for every point which lies in this feature.
+        """
+        if self._has_bbox:
+            bbox = self.feature["bbox"]
+            candidates = (min(bbox[0], bbox[2]) < lons) & (lons < max(bbox[0], bbox[2])) \
+                         & (min(bbox[1], bbox[3]) < lats) & (lats < max(bbox[1], bbox[3]))
+        else:
+            candidates = (self.bbox[0] <= lons) & (lons <= self.bbox[2]) \
+                         & (self.bbox[1] <= lats) & (lats <= self.bbox[3])
+        candidates &= (self._min_lat <= lats) & (lats <= self._max_lat)
+        points = numpy.flatnonzero(candidates)
+        inside = numpy.zeros(len(lons), dtype=bool)
+        if len(points) == 0:
+            return inside
+        start_lons, start_lats, end_lons, end_lats, band_offsets, band_edges = self._get_edge_arrays()
+        # Pair every point with every edge in its band
+        bands = numpy.minimum((lats[points] - self._min_lat) // self._band_height, self._band_count - 1) \
+            .astype(numpy.int64)
+        edge_counts = band_offsets[bands + 1] - band_offsets[bands]
+        pair_points = numpy.repeat(numpy.arange(len(points)), edge_counts)
+        # The position of every pair within the edges of its band
+        pair_positions = numpy.arange(len(pair_points)) - numpy.repeat(numpy.cumsum(edge_counts) - edge_counts,
+                                                                       edge_counts)
+        pair_edges = band_edges[numpy.repeat(band_offsets[bands], edge_counts) + pair_positions]
+        intersections = intersects_with_northbound_ray_batch(lons[points][pair_points], lats[points][pair_points],
+                                                             start_lons[pair_edges], start_lats[pair_edges],
+                                                             end_lons[pair_edges], end_lats[pair_edges])
+        # A point lies inside the feature when its ray intersects with an odd number of edges
+        inside[points] = numpy.bincount(pair_points, weights=intersections, minlength=len(points)) % 2 == 1
+        return inside
+
+    def _get_edge_arrays(self):
+        """
+        :return: The longitudes and latitudes of the start and end of every edge, the offset of every band in the list
+                 of band edges, and the list of band edges, all as NumPy arrays.
+        """
+        if self._edge_arrays is None:
+            starts = numpy.array([start for start, _ in self._edges], dtype=numpy.float64)
+            ends = numpy.array([end for _, end in self._edges], dtype=numpy.float64)
+            band_offsets = numpy.zeros(self._band_count + 1, dtype=numpy.int64)
+            numpy.cumsum([len(band_edges) for band_edges in self._band_edges], out=band_offsets[1:])
+            band_edges = numpy.array([i for band_edges in self._band_edges for i in band_edges], dtype=numpy.int64)
+            self._edge_arrays = starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1], band_offsets, band_edges
+        return self._edge_arrays
+
+    def _get_band(self, lat):
+        # The northernmost vertex belongs to the last band
+        return min(int((lat - self._min_lat) // self._band_height), self._band_count - 1)
 
-        if "geometry" not in feature:
-            continue
 
-        geometry_type = feature["geometry"]["type"]
-        # A triple-nested list: A list of rings, where each ring is a list of coordinates, where a coordinate is a
-        # list of floats.
-        coordinates = feature["geometry"]["coordinates"]
-        if in_polygon(lon, lat, coordinates):
-            return feature
-    return False
+def get_rings(geometry):
+    """
+    Get all rings of a Polygon or MultiPolygon geometry. The raycasting algorithm tests the edges of all rings,
+    including holes, in the same way.
+    :param geometry: The GeoJSON geometry.
+    :return: A list of rings, where each ring is a list of coordinates, where a coordinate is a list of floats.
+    """
+    if geometry["type"] == "Polygon":
+        return geometry["coordinates"]
+    if geometry["type"] == "MultiPolygon":
+        return [ring for polygon in geometry["coordinates"] for ring in polygon]
+    return []
 
 
 def in_bbox(lat, lon, bbox):
@@ -71,26 +430,15 @@ def in_bbox(lat, lon, bbox):
            and min(bbox_lat1, bbox_lat2) < lat < max(bbox_lat1, bbox_lat2)
 
 
-def in_polygon(lat, lon, coordinates):
-    inside = False
-    for ring in coordinates:
-        for polygon in ring:
-            polygon_size = len(polygon)
-            for i in range(0, polygon_size):
-                coordinate = polygon[i]
-                next_coordinate = polygon[(i + 1) % polygon_size]
-                if intersects_with_northbound_ray(lon, lat, coordinate, next_coordinate):
-                    inside = not inside
-    return inside
-
-
 def intersects_with_northbound_ray(lat, lon, line_start, line_end):
+    # Coordinates are [longitude, latitude] pairs. Note that the point is passed as (longitude, latitude) as well, so
+    # despite their names, lat is compared to index 0 and lon to index 1 of the coordinates.
     if line_start[1] > line_end[1]:
-        return intersects_with_northbound_ray(lon, lat, line_end, line_start)
+        return intersects_with_northbound_ray(lat, lon, line_end, line_start)
 
     # If the longitude lies exactly on the start or end latitude, move it a bit.
     if lon == line_start[1] or lon == line_end[1]:
-        lon += 0.00001
+        lon += VERTEX_NUDGE
         # YES, this adjust our point.
         # HOWEVER, this method is internal. There will be another line, also going from this point
         # THEREFORE, both lines will get the same offset, meaning both will be added or removed from the polygon.
@@ -128,15 +476,54 @@ def intersects_with_northbound_ray(lat, lon, line_start, line_end):
     return start_of_line_to_point_slope > defined_line_slope
 
 
+def intersects_with_northbound_ray_batch(lons, lats, start_lons, start_lats, end_lons, end_lats):
+    """
+    The same test as intersects_with_northbound_ray, for many points and edges at once. Every point is tested against
+    the edge at the same position in the arrays.
+    :return: A NumPy array containing True for every point of which the ray intersects with its edge.
+    """
+    # Order the coordinates of every edge from south to north
+    swapped = start_lats > end_lats
+    south_lons = numpy.where(swapped, end_lons, start_lons)
+    south_lats = numpy.where(swapped, end_lats, start_lats)
+    north_lons = numpy.where(swapped, start_lons, end_lons)
+    north_lats = numpy.where(swapped, start_lats, end_lats)
+    # Points which lie exactly on the latitude of the start or end of an edge are moved a bit
+    nudged_lats = numpy.where((lats == south_lats) | (lats == north_lats), lats + VERTEX_NUDGE, lats)
+    overlaps = (nudged_lats <= north_lats) & (nudged_lats >= south_lats) \
+               & (lons <= numpy.maximum(south_lons, north_lons))
+    # Points to the west of the edge always intersect with it
+    west = overlaps & (lons < numpy.minimum(south_lons, north_lons))
+    between = overlaps & ~west
+    # The scalar version raises an error for points on a vertical edge, and divides by zero for points at the same
+    # longitude as the south end of the edge. Raise the same errors.
+    invalid = between & ((lons == south_lons) | (south_lons == north_lons))
+    if invalid.any():
+        i = numpy.flatnonzero(invalid)[0]
+        intersects_with_northbound_ray(float(lons[i]), float(lats[i]), [float(start_lons[i]), float(start_lats[i])],
+                                       [float(end_lons[i]), float(end_lats[i])])
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        point_slopes = (nudged_lats - south_lats) / (lons - south_lons)
+        edge_slopes = (north_lats - south_lats) / (north_lons - south_lons)
+    return west | (between & (point_slopes > edge_slopes))
+
+
 def getSlopeBetweenTwoPoints(start_point, end_point):
     return (end_point[1] - start_point[1]) / (end_point[0] - start_point[0])
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print(f"Usage: python {sys.argv[0]} <stops_file> <geojson_borders_file>")
-        exit()
-    gtfs_stops_file_path = sys.argv[1]
-    geojson_file_path = sys.argv[2]
-    output_file_path = add_municipality_to_gtfs_stops(gtfs_stops_file_path, geojson_file_path)
+    parser = argparse.ArgumentParser(description="Add the municipality to every stop in a GTFS stops.txt file")
+    parser.add_argument("stops_file", help="the stops.txt file")
+    parser.add_argument("geojson_borders_file", help="the GeoJSON file containing the municipality borders")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="the number of processes to use. Defaults to the number of CPUs.")
+    parser.add_argument("--cache", dest="cache_path",
+                        help="the file to cache municipalities in between runs. Defaults to a file next to the GeoJSON"
+                             " file.")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false",
+                        help="calculate the municipality of every stop, without using or updating the cache")
+    args = parser.parse_args()
+    output_file_path = add_municipality_to_gtfs_stops(args.stops_file, args.geojson_borders_file, workers=args.workers,
+                                                      cache_path=args.cache_path, use_cache=args.use_cache)
     print(f"Done! Output can be found at {output_file_path}")
@@ -1,84 +1,240 @@
 #!/usr/bin/python3
 import csv
+import gc
 import gzip
+import os
 import sys
 import time
 import urllib
 import zipfile
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from io import TextIOWrapper, StringIO
+from itertools import repeat
+from operator import itemgetter
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, stop times are counted one by one without it
+    numpy = None
 
 
 # This script downloads a GTFS archive and adds the average number of departures per day to each stop.
 #
-# Usage: python stops_calculate_average_departures.py
-# Example: python stops_calculate_average_departures.py
+# Usage: python stops_calculate_average_departures.py <gtfs_url_or_path> [number of processes]
+# Example: python stops_calculate_average_departures.py gtfs.zip
+#
+# stop_times.txt is split into chunks, which are counted in parallel by one process per CPU. Stops and trips are
+# encoded as integers, so every chunk is counted into an array of departures per stop. When NumPy is installed, these
+# arrays are calculated in bulk instead of one stop time at a time.
 #
 # Note: Use python 3, NOT the outdated 2.7
 
+# The size of the chunks of stop_times.txt which are counted at once, in bytes
+CHUNK_SIZE = 8 * 1024 * 1024
 
-def get_operating_days_count(gtfs_zip_file):
-    """
-    Get the number of unique days on which public transport is provided according to the GTFS file
-    :param gtfs_zip_file:
-    :return:
-    """
-    used_calendar_dates = set()
-    with gtfs_zip_file.open("calendar_dates.txt") as file:
-        calendar_dates = get_csv_dict_reader(file)
-        for row in calendar_dates:
-            used_calendar_dates.add(row["date"])
-    return len(used_calendar_dates)
+# The data needed to count stop times, set in every process by init_stop_times_counter
+_stop_indices = None
+_trip_indices = None
+_trip_frequencies = None
+_stop_and_trip_id_getter = None
 
 
-def create_service_frequency_table(gtfs_zip_file):
+def read_calendar_dates(gtfs_zip_file):
     """
-    Get a dictionary describing the number of days every service is run.
+    Read calendar_dates.txt, and get both the number of operating days and the number of days every service is run.
     :param gtfs_zip_file:
-    :return:
+    :return: A tuple containing the number of unique days on which public transport is provided according to the GTFS
+             file, and a dictionary mapping service ids to the number of days they are run.
     """
+    used_calendar_dates = set()
     service_operating_dates = {}
     with gtfs_zip_file.open("calendar_dates.txt") as file:
-        calendar_dates = get_csv_dict_reader(file)
+        calendar_dates = get_csv_reader(file)
+        header = next(calendar_dates)
+        service_id_column = header.index("service_id")
+        date_column = header.index("date")
+        exception_type_column = header.index("exception_type")
         for row in calendar_dates:
-            if row["exception_type"] == "2":
+            used_calendar_dates.add(row[date_column])
+            if row[exception_type_column] == "2":
                 # No service on this day
                 continue
-
             # Store the operating dates for each service in a set to filter out possible duplicates
-            if row["service_id"] not in service_operating_dates.keys():
-                service_operating_dates[row["service_id"]] = {row["date"]}
-            else:
-                service_operating_dates[row["service_id"]].add(row["date"])
+            service_operating_dates.setdefault(row[service_id_column], set()).add(row[date_column])
 
     # Map every set with dates to its size in order to obtain a frequency table
     service_frequency_table = \
         dict((service_id, len(dates_set)) for (service_id, dates_set) in service_operating_dates.items())
-    return service_frequency_table
+    return len(used_calendar_dates), service_frequency_table
 
 
 def create_trips_frequency_table(gtfs_zip_file, service_frequency_table):
+    """
+    Get a dictionary describing the number of days every trip is run. Trips with a service which is never run are left
+    out.
+    :param gtfs_zip_file:
+    :param service_frequency_table: A dictionary mapping service ids to the number of days they are run.
+    :return:
+    """
     trips_frequency = {}
     with gtfs_zip_file.open("trips.txt") as file:
-        trips = get_csv_dict_reader(file)
+        trips = get_csv_reader(file)
+        header = next(trips)
+        trip_id_column = header.index("trip_id")
+        service_id_column = header.index("service_id")
         for row in trips:
-            trips_frequency[row["trip_id"]] = service_frequency_table[row["service_id"]]
+            if row[service_id_column] in service_frequency_table:
+                trips_frequency[row[trip_id_column]] = service_frequency_table[row[service_id_column]]
 
     return trips_frequency
 
 
-def create_stops_frequency_table(gtfs_zip_file, trips_frequency_table):
-    stops_frequency = {}
+def create_stops_frequency_table(gtfs_zip_file, trips_frequency_table, stop_ids, workers=1):
+    """
+    Count the number of departures from every stop, over all operating days. stop_times.txt is split into chunks,
+    which are counted by a pool of processes. The counts of all chunks are added up afterwards.
+    :param gtfs_zip_file:
+    :param trips_frequency_table: A dictionary mapping trip ids to the number of days they are run.
+    :param stop_ids: The stop ids to count the departures for.
+    :param workers: The number of processes to use.
+    :return: A list containing the number of departures for every stop, in the same order as the stop ids.
+    """
+    trip_ids = list(trips_frequency_table)
     with gtfs_zip_file.open("stop_times.txt") as file:
-        stop_times = get_csv_dict_reader(file)
-        for row in stop_times:
-            if row["stop_id"] not in stops_frequency:
-                stops_frequency[row["stop_id"]] = trips_frequency_table[row["trip_id"]]
-            else:
-                stops_frequency[row["stop_id"]] += trips_frequency_table[row["trip_id"]]
-    return stops_frequency
+        header = next(csv.reader([file.readline().decode("utf-8-sig")]))
+        counter_arguments = (stop_ids, trip_ids, [trips_frequency_table[trip_id] for trip_id in trip_ids],
+                             header.index("stop_id"), header.index("trip_id"))
+        chunks = read_chunks(file)
+        if workers <= 1 or gtfs_zip_file.getinfo("stop_times.txt").file_size <= CHUNK_SIZE:
+            # Starting processes isn't worth it for a single chunk
+            init_stop_times_counter(*counter_arguments)
+            return add_counts(map(count_stop_times, chunks), len(stop_ids))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_stop_times_counter,
+                                 initargs=counter_arguments) as executor:
+            return add_counts(submit_chunks(executor, chunks, workers * 2), len(stop_ids))
+
+
+def read_chunks(file):
+    """
+    Split a file into chunks of about CHUNK_SIZE bytes. Chunks always end at the end of a line, so every chunk contains
+    complete rows. Fields containing a line break are not supported.
+    :param file: The file to read, positioned after the header.
+    :return: A generator of chunks, as bytes.
+    """
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        # Read the remainder of the last line, so it isn't split over two chunks
+        yield chunk + file.readline()
 
 
-def create_stops_with_avg_departures(gtfs_stops_file_path):
+def submit_chunks(executor, chunks, max_pending):
+    """
+    Count chunks using a process pool. Only a limited number of chunks is read ahead, so the entire file is never kept
+    in memory.
+    :param executor: The process pool.
+    :param chunks: The chunks to count.
+    :param max_pending: The maximum number of chunks which are read but not yet counted.
+    :return: A generator of the counts for every chunk.
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(count_stop_times, chunk))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def add_counts(chunk_counts, stop_count):
+    """
+    Add up the counts of all chunks.
+    :param chunk_counts: The counts of all chunks, as returned by count_stop_times.
+    :param stop_count: The number of stops.
+    :return: A list containing the number of departures for every stop.
+    """
+    totals = None
+    for counts in chunk_counts:
+        if totals is None:
+            totals = counts
+        elif numpy is not None:
+            totals += counts
+        else:
+            totals = array('q', map(int.__add__, totals, counts))
+    if totals is None:
+        return [0] * stop_count
+    # The last count is used for stops which aren't in stops.txt, which aren't included in the output
+    return [int(total) for total in totals[:stop_count]]
+
+
+def init_stop_times_counter(stop_ids, trip_ids, trip_frequencies, stop_id_column, trip_id_column):
+    """
+    Prepare a process for counting stop times. Stops and trips are encoded as their index in the given lists. Unknown
+    stops and trips are encoded as the index after the last stop or trip.
+    :param stop_ids: The stop ids to count the departures for.
+    :param trip_ids: The trip ids of all trips which are run.
+    :param trip_frequencies: The number of days every trip is run, in the same order as the trip ids.
+    :param stop_id_column: The index of the stop_id column in stop_times.txt.
+    :param trip_id_column: The index of the trip_id column in stop_times.txt.
+    """
+    global _stop_indices, _trip_indices, _trip_frequencies, _stop_and_trip_id_getter
+    _stop_indices = {stop_id: index for index, stop_id in enumerate(stop_ids)}
+    _trip_indices = {trip_id: index for index, trip_id in enumerate(trip_ids)}
+    # Stop times of unknown trips are not counted
+    if numpy is not None:
+        _trip_frequencies = numpy.array(trip_frequencies + [0], dtype=numpy.int64)
+    else:
+        _trip_frequencies = array('q', trip_frequencies + [0])
+    _stop_and_trip_id_getter = itemgetter(stop_id_column, trip_id_column)
+
+
+def count_stop_times(chunk):
+    """
+    Count the number of departures from every stop in a chunk of stop_times.txt.
+    :param chunk: The chunk of stop_times.txt, as bytes.
+    :return: An array containing the number of departures for every stop, followed by the number of departures from
+             unknown stops.
+    """
+    unknown_stop = len(_stop_indices)
+    unknown_trip = len(_trip_indices)
+    # Parsing a chunk creates a large number of objects which live until the chunk is counted, but never contain
+    # reference cycles. Pause the garbage collector, which would otherwise scan these objects over and over again.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        # Skip empty lines, like csv.DictReader does
+        stop_and_trip_ids = list(map(_stop_and_trip_id_getter,
+                                     filter(None, csv.reader(StringIO(chunk.decode("utf-8"))))))
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    if not stop_and_trip_ids:
+        return numpy.zeros(unknown_stop + 1, dtype=numpy.int64) if numpy is not None \
+            else array('q', bytes(8 * (unknown_stop + 1)))
+    stop_ids, trip_ids = zip(*stop_and_trip_ids)
+    stops = map(_stop_indices.get, stop_ids, repeat(unknown_stop))
+    trips = map(_trip_indices.get, trip_ids, repeat(unknown_trip))
+    if numpy is not None:
+        stops = numpy.fromiter(stops, dtype=numpy.int32, count=len(stop_ids))
+        trips = numpy.fromiter(trips, dtype=numpy.int32, count=len(trip_ids))
+        # Weights are summed as floats, which is exact for any realistic number of departures
+        return numpy.bincount(stops, weights=_trip_frequencies[trips], minlength=unknown_stop + 1).astype(numpy.int64)
+    counts = array('q', bytes(8 * (unknown_stop + 1)))
+    for stop, trip in zip(stops, trips):
+        counts[stop] += _trip_frequencies[trip]
+    return counts
+
+
+def create_stops_with_avg_departures(gtfs_stops_file_path, workers=None):
+    """
+    :param gtfs_stops_file_path: The url or path of the GTFS archive.
+    :param workers: The number of processes used to count the stop times. Defaults to the number of CPUs.
+    :return: The path of the output file.
+    """
     if gtfs_stops_file_path.startswith("http"):
         print(f"[{time.ctime()}] Downloading GTFS archive...")
         response = urllib.request.urlopen(gtfs_stops_file_path)
@@ -89,34 +245,34 @@ def create_stops_with_avg_departures(gtfs_stops_file_path):
 
     print(f"[{time.ctime()}] Starting calculations")
 
-    operating_days = get_operating_days_count(gtfs_zip_file)
+    operating_days, service_frequency_table = read_calendar_dates(gtfs_zip_file)
     print(f"[{time.ctime()}] {operating_days} operating days found")
-    service_frequency_table = create_service_frequency_table(gtfs_zip_file)
     print(f"[{time.ctime()}] {len(service_frequency_table.keys())} services found")
     trips_frequency_table = create_trips_frequency_table(gtfs_zip_file, service_frequency_table)
     print(f"[{time.ctime()}] {len(trips_frequency_table)} trips with traffic found")
-    stops_frequency_table = create_stops_frequency_table(gtfs_zip_file, trips_frequency_table)
-    print(f"[{time.ctime()}] {len(stops_frequency_table)} stops with traffic found")
-    average_departures_per_stop = \
-        dict((stop_id, frequency / operating_days) for (stop_id, frequency) in stops_frequency_table.items())
+
+    with gtfs_zip_file.open("stops.txt") as stops_file:
+        stops_reader = get_csv_dict_reader(stops_file)
+        fieldnames = stops_reader.fieldnames
+        stops = list(stops_reader)
+    stops_frequency = create_stops_frequency_table(gtfs_zip_file, trips_frequency_table,
+                                                   [stop["stop_id"] for stop in stops], workers or os.cpu_count())
+    print(f"[{time.ctime()}] {sum(1 for frequency in stops_frequency if frequency)} stops with traffic found")
 
     print(f"[{time.ctime()}] Writing results")
 
     output_path = "stops.txt"
-    with gtfs_zip_file.open("stops.txt") as stops_file:
-        stops = get_csv_dict_reader(stops_file)
-        fieldnames = stops.fieldnames
-        fieldnames.append("avg_stop_times")
-        with open(output_path, "w", encoding="utf8", newline='\n') as new_stops_file:
-            gtfs_writer = csv.DictWriter(new_stops_file, fieldnames=fieldnames,
-                                         delimiter=',', quotechar='"')
-            gtfs_writer.writeheader()
-            for stop in stops:
-                if stop["stop_id"] in average_departures_per_stop:
-                    stop["avg_stop_times"] = round(average_departures_per_stop[stop["stop_id"]], 4)
-                else:
-                    stop["avg_stop_times"] = "0"
-                gtfs_writer.writerow(stop)
+    fieldnames.append("avg_stop_times")
+    with open(output_path, "w", encoding="utf8", newline='\n') as new_stops_file:
+        gtfs_writer = csv.DictWriter(new_stops_file, fieldnames=fieldnames,
+                                     delimiter=',', quotechar='"')
+        gtfs_writer.writeheader()
+        for stop, frequency in zip(stops, stops_frequency):
+            if frequency:
+                stop["avg_stop_times"] = round(frequency / operating_days, 4)
+            else:
+                stop["avg_stop_times"] = "0"
+            gtfs_writer.writerow(stop)
 
     print(f"[{time.ctime()}] finished writing results")
 
@@ -127,10 +283,15 @@ def get_csv_dict_reader(zip_file_contents):
     return csv.DictReader(TextIOWrapper(zip_file_contents, 'utf-8'), delimiter=',', quotechar='"')
 
 
+def get_csv_reader(zip_file_contents):
+    return csv.reader(TextIOWrapper(zip_file_contents, 'utf-8-sig'), delimiter=',', quotechar='"')
+
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print(f"Usage: python {sys.argv[0]} <gtfs_url_or_path>")
+    if len(sys.argv) not in (2, 3):
+        print(f"Usage: python {sys.argv[0]} <gtfs_url_or_path> [number of processes]")
         exit()
     gtfs_stops_file_path = sys.argv[1]
-    output_file_path = create_stops_with_avg_departures(gtfs_stops_file_path)
+    output_file_path = create_stops_with_avg_departures(gtfs_stops_file_path,
+                                                        int(sys.argv[2]) if len(sys.argv) == 3 else None)
     print(f"Done! Output can be found at {output_file_path}")